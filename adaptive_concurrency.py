@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : adaptive_concurrency.py
+# @Usage   : 批量脚本的自适应并发（AIMD）：自动找到目标集群的吞吐拐点
+"""
+批量脚本的并发数不再手工写死，由 AIMD 限流器在运行中自适应：
+
+- 加性增：请求成功且平滑后的延迟不超过目标时，并发上限每过"一轮"（约 limit 个请求）加 1；
+- 乘性减：延迟超过目标、出现 429/5xx/超时或其他错误时，上限乘以 ``backoff``（默认 0.7），
+  同一轮内的多次拥塞信号只减一次，避免一次抖动把并发打到底；
+- 目标延迟：显式给定 ``target_latency``；否则取运行中观测到的最小平滑延迟 × ``latency_tolerance``。
+
+结束时 ``report()`` 给出收敛并发数（最近若干次调整后上限的均值），可作为该集群的推荐并发。
+
+用法（线程池）::
+
+    limiter = AdaptiveLimiter(max_limit=32)
+    with ThreadPoolExecutor(max_workers=limiter.max_limit) as executor:
+        futures = [executor.submit(limiter.call, call_image_api, p, classify=classify_result) for p in paths]
+    print(limiter.summary())
+
+协程版本为 ``AsyncAdaptiveLimiter``，接口相同（``await limiter.call(coro_fn, ...)``）。
+需要限制请求速率（而不只是并发）时再叠加 ``AsyncTokenBucket``。
+"""
+import time
+import asyncio
+import threading
+from collections import deque
+
+OK = "ok"
+OVERLOAD = "overload"  # 429 / 5xx / 超时：服务端过载
+ERROR = "error"        # 其他失败，同样按拥塞处理
+IGNORE = "ignore"      # 与负载无关的失败（如本地图片损坏），不参与调节
+
+
+def classify_result(result) -> str:
+    """批量脚本结果字典的默认分类：status 非 success 视为失败，错误信息含 429/超时视为过载"""
+    if not isinstance(result, dict) or result.get("status", "success") == "success":
+        return OK
+    error = str(result.get("error", ""))
+    if any(mark in error for mark in ("429", "Too Many Requests", "timed out", "Timeout", "503", "502")):
+        return OVERLOAD
+    if error.startswith("无效的图片路径"):
+        return IGNORE
+    return ERROR
+
+
+class _AIMDCore:
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 64,
+                 target_latency: float = None, latency_tolerance: float = 2.0,
+                 backoff: float = 0.7, smoothing: float = 0.2, history: int = 50):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._ewma = None
+        self._min_ewma = None
+        self._last_decrease = 0.0
+        self._history = deque(maxlen=history)  # 最近的上限，用于计算收敛值
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.completed = 0
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _target(self):
+        if self.target_latency is not None:
+            return self.target_latency
+        if self._min_ewma is None:
+            return None
+        return self._min_ewma * self.latency_tolerance
+
+    def _decrease(self, now: float):
+        # 一轮（约一个平滑延迟）内只减一次
+        if now - self._last_decrease < (self._ewma or 0.0):
+            return
+        self._limit = max(self.min_limit, self._limit * self.backoff)
+        self._last_decrease = now
+        self.decreases += 1
+        self._history.append(self._limit)
+
+    def on_sample(self, latency: float, outcome: str):
+        if outcome == IGNORE:
+            return
+        now = time.monotonic()
+        self.completed += 1
+        if outcome != OK:
+            self._decrease(now)
+            return
+        self._ewma = latency if self._ewma is None else (1 - self.smoothing) * self._ewma + self.smoothing * latency
+        self._min_ewma = self._ewma if self._min_ewma is None else min(self._min_ewma, self._ewma)
+        target = self._target()
+        if target is not None and self._ewma > target:
+            self._decrease(now)
+        elif self._limit < self.max_limit and self.in_flight + 1 >= self.limit:
+            # 只有并发真正用满时才加，避免空闲时上限虚涨
+            old = self.limit
+            self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+            if self.limit != old:
+                self.increases += 1
+                self._history.append(self._limit)
+
+    def report(self) -> dict:
+        converged = sum(self._history) / len(self._history) if self._history else self._limit
+        return {
+            "limit": self.limit,
+            "converged_limit": round(converged, 1),
+            "peak_in_flight": self.peak_in_flight,
+            "smoothed_latency": round(self._ewma, 3) if self._ewma is not None else None,
+            "target_latency": round(self._target(), 3) if self._target() is not None else None,
+            "completed": self.completed,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
+
+    def summary(self) -> str:
+        r = self.report()
+        return (f"🎯 自适应并发收敛于 {r['converged_limit']}（当前 {r['limit']}，峰值在途 {r['peak_in_flight']}），"
+                f"平滑延迟 {r['smoothed_latency']}s / 目标 {r['target_latency']}s，"
+                f"加 {r['increases']} 次 / 减 {r['decreases']} 次")
+
+
+class AdaptiveLimiter(_AIMDCore):
+    """线程版：超过当前上限的线程在 acquire 处等待"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def release(self, latency: float, outcome: str = OK):
+        with self._cond:
+            self.in_flight -= 1
+            self.on_sample(latency, outcome)
+            self._cond.notify_all()
+
+    def call(self, fn, *args, classify=classify_result, **kwargs):
+        """占用一个并发名额执行 fn，按耗时与结果调整上限；异常计为 ERROR 并继续抛出"""
+        self.acquire()
+        start = time.perf_counter()
+        outcome = ERROR
+        try:
+            result = fn(*args, **kwargs)
+            outcome = classify(result)
+            return result
+        finally:
+            self.release(time.perf_counter() - start, outcome)
+
+
+class AsyncAdaptiveLimiter(_AIMDCore):
+    """协程版：需在事件循环内使用"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = None
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self):
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def release(self, latency: float, outcome: str = OK):
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            self.on_sample(latency, outcome)
+            cond.notify_all()
+
+    async def call(self, coro_fn, *args, classify=classify_result, **kwargs):
+        await self.acquire()
+        start = time.perf_counter()
+        outcome = ERROR
+        try:
+            result = await coro_fn(*args, **kwargs)
+            outcome = classify(result)
+            return result
+        finally:
+            await self.release(time.perf_counter() - start, outcome)
+
+
+class AsyncTokenBucket:
+    """
+    请求速率上限（令牌桶）：每秒补充 rate 个令牌，最多积攒 burst 个。
+    与 AIMD 叠加使用时，AIMD 管"同时在途多少"，令牌桶管"每秒最多发多少"，避免重测把共享集群打满。
+    """
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, int(rate)))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = None
+        self.waited = 0.0
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # 持锁等待保证先到先得：排在后面的请求不会插队抢走刚补充的令牌
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
@@ -26,5 +26,6 @@ class User(HttpUser):
         path = '/process_image_local'
         url = f'{testServer}{path}'
         headers = {'Content-Type': 'application/json'}
-        data = {"image_path": random.choice(image_paths)}
+        # 默认按交互流量发送，与历史压测及 load_generator.py 可比；测回刷通道时设 BENCH_PRIORITY=batch
+        data = {"image_path": random.choice(image_paths), "priority": os.getenv("BENCH_PRIORITY", "interactive")}
         self.client.post(url, json=data, headers=headers)
\ No newline at end of file
@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : batch_cli.py
+# @Usage   : 统一的批量打标命令行：多种输入源 × 多种执行目标，有界并发 + 进度 + 断点续跑
+"""
+替代 main_parallel_batch*.py / badcase_improve.py / retest_low_accuracy 里各自实现的
+串行循环、``time.sleep`` 限流和一次性写文件：
+
+- 输入源（--source）：folder 图片目录 / json 结果文件 / excel 低识别率筛选 / urls 文本（每行一个 URL 或路径）；
+- 执行目标（--target）：graph 进程内 LangGraph / api 异步 HTTP 客户端 / offline 进程内 vLLM / stub CPU 替身引擎；
+- 并发：固定 ``--concurrency`` 或 ``--adaptive``（AIMD 自动寻找吞吐拐点），``--rate`` 再加每秒请求数上限（令牌桶）；
+- 结果逐条追加到 JSONL（``--output``），中断后重跑自动跳过已成功的图片；
+  结果带 ``prompt_version``，只有与当前 Prompt 版本一致的结果才算完成，``--cache`` 还可复用以往输出里同版本的结果；
+- ``--export-json`` 导出 ``ImageTagPipeline.json_to_excel`` 可直接读取的 JSON 列表。
+
+输出记录格式与原重测脚本一致::
+
+    {"image_name", "image_path", "image_url", "except_tags", "image_info", "process_result": {...}}
+
+运行示例：
+    python batch_cli.py --source folder --input /path/to/images --target api --api-url http://host:8081/process_image --adaptive
+    python batch_cli.py --source excel --input old.xlsx --threshold 0.6 --target api --export-json retest.json
+    python batch_cli.py --source folder --input /path/to/images --target offline --shard 0/4
+"""
+import os
+import glob
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+from logger import get_logger
+from adaptive_concurrency import AsyncAdaptiveLimiter, AsyncTokenBucket
+from offline_engine import failed_result
+from result_cache import is_cacheable
+
+logger = get_logger(service="batch_cli")
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg')
+DEFAULT_API_URL = "http://10.136.234.255:8081/process_image"
+
+
+@dataclass
+class BatchItem:
+    image_info: str                             # 发给打标链路的图片路径/URL，同时是断点续跑的唯一键
+    entry: dict = field(default_factory=dict)   # 输出记录里原样保留的元信息
+
+
+def _entry(image_path, image_url=None, except_tags=None) -> dict:
+    return {
+        "image_name": os.path.basename(str(image_path)),
+        "image_path": image_path,
+        "image_url": image_url,
+        "except_tags": except_tags if except_tags is not None else [],
+    }
+
+
+# ==========================================
+# 输入源
+# ==========================================
+def items_from_folder(folder: str) -> list:
+    items = []
+    for root, _, files in os.walk(folder):
+        for file in sorted(files):
+            if file.lower().endswith(IMAGE_EXTS):
+                path = os.path.join(root, file)
+                # 目录层级即期望标签，例如 "一级/二级/三级/image.jpg" -> ["一级", "二级", "三级"]
+                except_tags = os.path.relpath(root, folder).split(os.sep) if root != folder else []
+                items.append(BatchItem(path, _entry(path, None, except_tags)))
+    return sorted(items, key=lambda item: item.image_info)
+
+
+def items_from_json(path: str) -> list:
+    """读取已有结果/标注 JSON（列表，每项含 image_path / image_url / except_tags）"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    items = []
+    for row in data:
+        image_url = row.get("image_url")
+        image_path = row.get("image_path") or row.get("image_info")
+        image_info = image_url if image_url and str(image_url).strip() else image_path
+        if not image_info:
+            continue
+        items.append(BatchItem(str(image_info).strip(), _entry(image_path, image_url, row.get("except_tags"))))
+    return items
+
+
+def items_from_excel(excel_path: str, threshold: float = None, tags: list = None) -> list:
+    """
+    从 json_to_excel 生成的 Excel 中筛选图片：
+    threshold 取「识别率统计」中识别率 <= threshold 的标签，tags 直接指定路径标签，二者都不给则取全部
+    """
+    import pandas as pd
+    xls = pd.ExcelFile(excel_path, engine='openpyxl')
+    sheet_name = '原始数据' if '原始数据' in xls.sheet_names else xls.sheet_names[0]
+    df_data = pd.read_excel(xls, sheet_name=sheet_name)
+
+    target_tags = list(tags or [])
+    if threshold is not None:
+        df_stats = pd.read_excel(xls, sheet_name='识别率统计')
+        target_tags += df_stats[df_stats['识别率'] <= threshold]['路径标签'].tolist()
+    if threshold is not None or tags:
+        df_data = df_data[df_data['路径标签'].isin(target_tags)]
+
+    items = []
+    for _, row in df_data.iterrows():
+        image_url = row.get('路径URL')
+        image_path = row.get('路径名')
+        image_url = image_url if pd.notna(image_url) and str(image_url).strip() else None
+        image_info = image_url or image_path
+        if not isinstance(image_info, str) or not image_info.strip():
+            continue
+        except_tags = str(image_path).split('/')[:-1] if isinstance(image_path, str) else []
+        items.append(BatchItem(image_info.strip(), _entry(image_path, image_url, except_tags)))
+    return items
+
+
+def items_from_url_list(path: str) -> list:
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                is_url = line.lower().startswith(("http://", "https://"))
+                items.append(BatchItem(line, _entry(line, line if is_url else None)))
+    return items
+
+
+SOURCES = {
+    "folder": items_from_folder,
+    "json": items_from_json,
+    "excel": items_from_excel,
+    "urls": items_from_url_list,
+}
+
+
+# ==========================================
+# 执行目标：item -> process_single_image 同结构的结果字典
+# ==========================================
+class GraphTarget:
+    """进程内 LangGraph（与在线服务同一套节点），在独立线程池中执行"""
+    def __init__(self, max_workers: int = 16):
+        from image_uds_local_new import process_single_image
+        self._process = process_single_image
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="graph")
+
+    async def __call__(self, item: BatchItem) -> dict:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: self._process(item.image_info, time.perf_counter(), priority="batch")
+        )
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class ApiTarget:
+    """异步 HTTP 客户端调用 /process_image，以 batch 优先级发送"""
+    def __init__(self, api_url: str = DEFAULT_API_URL, timeout: float = 300, priority: str = "batch",
+                 max_connections: int = 64):
+        import httpx
+        self.api_url = api_url
+        self.priority = priority
+        # 连接池与最大并发一致，keep-alive 连接在请求间复用
+        self._client = httpx.AsyncClient(timeout=timeout, limits=httpx.Limits(
+            max_connections=max_connections, max_keepalive_connections=max_connections))
+
+    async def __call__(self, item: BatchItem) -> dict:
+        payload = {"image_info": item.image_info, "task_id": str(uuid.uuid4()), "priority": self.priority}
+        try:
+            resp = await self._client.post(self.api_url, json=payload)
+        except Exception as e:
+            return failed_result(item.image_info, f"请求失败：{type(e).__name__}: {e}")
+        if resp.status_code != 200:
+            return failed_result(item.image_info, f"HTTP {resp.status_code}")
+        body = resp.json()
+        # 本服务返回 {"res": ...}，网关返回 {"result": ...}
+        return body.get("res") or body.get("result") or body
+
+    async def close(self):
+        await self._client.aclose()
+
+
+# ==========================================
+# 结果落盘：JSONL 追加写 + 断点续跑
+# ==========================================
+class JsonlSink:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def completed(self, prompt_version: str = None) -> set:
+        """已完整处理（成功且无失败节点、未降级）的 image_info，重跑时跳过；给定 prompt_version 时只认同版本的结果"""
+        if not os.path.exists(self.path):
+            return set()
+        return set(cached_results([self.path], prompt_version))
+
+    def write(self, record: dict):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load_jsonl(path: str) -> list:
+    """读取 JSONL，同一张图片保留最后一次的结果"""
+    records = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record["image_info"]] = record
+    return list(records.values())
+
+
+def cached_results(paths: list, prompt_version: str = None) -> dict:
+    """
+    以往输出（JSON 或 JSONL）中可复用且 Prompt 版本匹配的记录：{image_info: record}，后出现的覆盖先出现的
+    可复用的标准与共享结果缓存相同（result_cache.is_cacheable）：后端故障期间返回的降级结果不算，重跑时会重新请求
+    """
+    cached = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        if path.endswith(".jsonl"):
+            records = load_jsonl(path)
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                records = json.load(f)
+        for record in records:
+            result = record.get("process_result") or {}
+            if not is_cacheable(result) or not record.get("image_info"):
+                continue
+            if prompt_version is not None and result.get("prompt_version") != prompt_version:
+                continue
+            cached[record["image_info"]] = record
+    return cached
+
+
+def resolve_prompt_version(target: str, api_url: str = DEFAULT_API_URL):
+    """
+    当前 Prompt 版本：进程内目标取本地注册表；api 目标向服务的 /ready 查询。
+    查不到（旧版本服务）时返回 None，断点续跑退化为"成功即跳过"。
+    """
+    if target != "api":
+        from node_registry import PROMPT_VERSION
+        return PROMPT_VERSION
+    import httpx
+    ready_url = api_url.rsplit("/", 1)[0] + "/ready"
+    try:
+        version = httpx.get(ready_url, timeout=10).json().get("prompt_version")
+    except Exception as e:
+        logger.warning(f"查询服务 Prompt 版本失败（{e}），不按版本过滤")
+        return None
+    return version
+
+
+def previous_outputs(pattern: str, current: str, prompt_version: str = None) -> list:
+    """
+    重测脚本可复用的以往输出（glob pattern，排除本次的 current）
+    Prompt 版本未知时无法判断旧结果是否同版本，不做跨文件复用，只保留 current 自身的断点续跑
+    """
+    if prompt_version is None:
+        logger.warning("未获取到服务的 Prompt 版本，不复用以往重测结果（仅断点续跑本次输出）")
+        return []
+    return sorted(p for p in glob.glob(pattern) if p != current)
+
+
+def export_json(jsonl_path: str, json_path: str) -> str:
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(load_jsonl(jsonl_path), f, ensure_ascii=False, indent=4)
+    return json_path
+
+
+def _record(item: BatchItem, result: dict, client_latency: float = None) -> dict:
+    record = dict(item.entry)
+    record["image_info"] = item.image_info
+    record["process_result"] = result
+    if client_latency is not None:
+        record["client_latency"] = round(client_latency, 4)
+    if result.get("status") != "success":
+        record["error"] = result.get("error", "")
+    return record
+
+
+# ==========================================
+# 调度
+# ==========================================
+async def run_items(items: list, target, concurrency: int = 8, adaptive: bool = False, max_limit: int = 64,
+                    sink: JsonlSink = None, progress: bool = True, bucket: AsyncTokenBucket = None) -> list:
+    """
+    有界并发执行 target(item)，每完成一条立即写入 sink；bucket 限制每秒发出的请求数；返回与 items 同序的记录
+    记录中的 client_latency 为客户端实测的单条耗时（含排队、HTTP、解码，不含令牌桶等待）
+    """
+    limiter = AsyncAdaptiveLimiter(initial=concurrency, max_limit=max_limit) if adaptive else None
+    n_workers = max_limit if adaptive else concurrency
+    queue = asyncio.Queue()
+    for index, item in enumerate(items):
+        queue.put_nowait((index, item))
+    records = [None] * len(items)
+    bar = tqdm(total=len(items), desc="批量打标", disable=not progress)
+
+    async def worker():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if bucket is not None:
+                await bucket.acquire()
+            start = time.perf_counter()
+            try:
+                result = await (limiter.call(target, item) if limiter else target(item))
+            except Exception as e:
+                result = failed_result(item.image_info, f"执行异常：{e}")
+            records[index] = _record(item, result, time.perf_counter() - start)
+            if sink is not None:
+                sink.write(records[index])
+            bar.update(1)
+
+    await asyncio.gather(*(worker() for _ in range(min(n_workers, len(items)) or 1)))
+    bar.close()
+    if limiter is not None:
+        logger.info(limiter.summary())
+    if bucket is not None:
+        logger.info(f"令牌桶限速 {bucket.rate}/s，累计等待 {bucket.waited:.1f}s")
+    return records
+
+
+def run_offline_items(items: list, engine_name: str, batch_size: int = 256, sink: JsonlSink = None,
+                      model_path: str = None, tensor_parallel_size: int = 1) -> list:
+    """离线引擎按批提交，每批结束后写入 sink"""
+    from offline_engine import OfflineTagger, VLLMEngine, StubEngine
+    from model import DEFAULT_LOCAL_MODEL_NAME
+    if engine_name == "offline":
+        engine = VLLMEngine(model_path or DEFAULT_LOCAL_MODEL_NAME, tensor_parallel_size=tensor_parallel_size,
+                            gpu_memory_utilization=0.85, max_model_len=10000, mm_processor_kwargs={"use_fast": True})
+    else:
+        engine = StubEngine()
+    tagger = OfflineTagger(engine, batch_size=batch_size)
+    records = []
+    for i in tqdm(range(0, len(items), batch_size), desc="离线批量打标"):
+        chunk = items[i:i + batch_size]
+        start = time.perf_counter()
+        results = tagger.run([item.image_info for item in chunk])
+        # 整批一起提交、一起返回：每条的客户端耗时就是这一批的耗时
+        chunk_latency = time.perf_counter() - start
+        for item, result in zip(chunk, results):
+            record = _record(item, result, chunk_latency)
+            records.append(record)
+            if sink is not None:
+                sink.write(record)
+    return records
+
+
+def run_batch(items: list, target: str = "api", output: str = None, resume: bool = True, concurrency: int = 8,
+              adaptive: bool = False, max_limit: int = 64, api_url: str = DEFAULT_API_URL, timeout: float = 300,
+              batch_size: int = 256, model_path: str = None, tensor_parallel_size: int = 1,
+              progress: bool = True, rate: float = None, burst: int = None, prompt_version: str = None,
+              cache: list = ()) -> list:
+    """
+    同步入口（供其他脚本调用）：跑完 items 并返回本次处理的记录
+    output 为 JSONL 路径；resume=True 时跳过其中已完整成功的图片（给定 prompt_version 时只认同版本的结果）
+    cache 为以往输出文件，其中同版本的成功结果直接写入 output，不再请求
+    """
+    sink = JsonlSink(output) if output else None
+    if sink is not None and resume:
+        done = sink.completed(prompt_version)
+        if done:
+            logger.info(f"断点续跑：跳过已完整成功的 {len(done)} 张图片（Prompt 版本 {prompt_version or '不限'}）")
+            items = [item for item in items if item.image_info not in done]
+    if sink is not None and cache:
+        reused = cached_results(cache, prompt_version)
+        remaining = []
+        for item in items:
+            if item.image_info in reused:
+                sink.write(_record(item, reused[item.image_info]["process_result"]))
+            else:
+                remaining.append(item)
+        if len(remaining) < len(items):
+            logger.info(f"复用以往结果 {len(items) - len(remaining)} 张（Prompt 版本 {prompt_version or '不限'}）")
+        items = remaining
+    logger.info(f"🚀 待处理 {len(items)} 张图片，执行目标：{target}")
+    start = time.perf_counter()
+    try:
+        if target in ("offline", "stub"):
+            records = run_offline_items(items, target, batch_size, sink, model_path, tensor_parallel_size)
+        else:
+            async def _main():
+                workers = max_limit if adaptive else concurrency
+                runner = GraphTarget(workers) if target == "graph" else ApiTarget(api_url, timeout, max_connections=workers)
+                bucket = AsyncTokenBucket(rate, burst) if rate else None
+                try:
+                    return await run_items(items, runner, concurrency, adaptive, max_limit, sink, progress, bucket)
+                finally:
+                    await runner.close()
+            records = asyncio.run(_main())
+    finally:
+        if sink is not None:
+            sink.close()
+    elapsed = time.perf_counter() - start
+    success = sum(1 for r in records if (r.get("process_result") or {}).get("status") == "success")
+    logger.info(f"✅ 完成 {success}/{len(records)}，耗时 {elapsed:.1f}s，吞吐 {len(records) / max(elapsed, 1e-9):.2f} 张/秒")
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="统一批量打标")
+    parser.add_argument("--source", choices=sorted(SOURCES), required=True)
+    parser.add_argument("--input", required=True, help="图片目录 / JSON / Excel / URL 列表文件")
+    parser.add_argument("--threshold", type=float, default=None, help="excel 源：重测识别率 <= 阈值的标签")
+    parser.add_argument("--tags", nargs="*", default=None, help="excel 源：直接指定要重测的路径标签")
+    parser.add_argument("--limit", type=int, default=None, help="只处理前 N 张")
+    parser.add_argument("--shard", default="0/1", help="形如 0/4，多机/多卡各跑一份")
+    parser.add_argument("--target", choices=["graph", "api", "offline", "stub"], default="api")
+    parser.add_argument("--api-url", default=DEFAULT_API_URL)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--concurrency", type=int, default=8, help="固定并发数；--adaptive 时为初始并发")
+    parser.add_argument("--adaptive", action="store_true", help="AIMD 自适应并发")
+    parser.add_argument("--max-concurrency", type=int, default=64)
+    parser.add_argument("--rate", type=float, default=None, help="每秒最多发出的请求数（令牌桶），默认不限")
+    parser.add_argument("--burst", type=int, default=None, help="令牌桶容量，默认等于 rate")
+    parser.add_argument("--batch-size", type=int, default=256, help="offline/stub 每批图片数")
+    parser.add_argument("--model-path", default=None)
+    parser.add_argument("--tensor-parallel-size", type=int, default=1)
+    parser.add_argument("--output", default="batch_results.jsonl", help="JSONL 结果（追加写，支持断点续跑）")
+    parser.add_argument("--no-resume", action="store_true")
+    parser.add_argument("--prompt-version", default="auto",
+                        help="auto：取当前版本（api 目标向服务查询）；any：不按版本过滤；或直接给版本号")
+    parser.add_argument("--cache", nargs="*", default=[], help="以往的结果 JSON/JSONL，同版本的成功结果直接复用")
+    parser.add_argument("--export-json", default=None, help="导出 json_to_excel 可读的 JSON 列表")
+    parser.add_argument("--excel", action="store_true", help="导出 JSON 后直接生成分析 Excel")
+    args = parser.parse_args()
+
+    if args.source == "excel":
+        items = items_from_excel(args.input, args.threshold, args.tags)
+    else:
+        items = SOURCES[args.source](args.input)
+    index, total = (int(x) for x in args.shard.split("/"))
+    items = items[index::total][:args.limit]
+    logger.info(f"📁 输入源 {args.source} 共 {len(items)} 张图片（分片 {args.shard}）")
+
+    if args.prompt_version == "auto":
+        prompt_version = resolve_prompt_version(args.target, args.api_url)
+    else:
+        prompt_version = None if args.prompt_version == "any" else args.prompt_version
+    run_batch(items, target=args.target, output=args.output, resume=not args.no_resume,
+              concurrency=args.concurrency, adaptive=args.adaptive, max_limit=args.max_concurrency,
+              api_url=args.api_url, timeout=args.timeout, batch_size=args.batch_size,
+              model_path=args.model_path, tensor_parallel_size=args.tensor_parallel_size,
+              rate=args.rate, burst=args.burst, prompt_version=prompt_version, cache=args.cache)
+
+    if args.export_json or args.excel:
+        json_path = export_json(args.output, args.export_json or os.path.splitext(args.output)[0] + ".json")
+        logger.info(f"💾 JSON 已导出：{json_path}")
+        if args.excel:
+            from result_analysis_one import ImageTagPipeline
+            ImageTagPipeline().json_to_excel(json_path)
+
+
+if __name__ == "__main__":
+    main()
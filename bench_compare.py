@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : bench_compare.py
+# @Usage   : 压测结果结构化存档 + 两次运行的性能/准确率并排对比
+"""
+每次改 Prompt、分辨率或部署参数后，把压测结果和识别率一起存成一条"运行记录"，
+再与基线对比，性能代价和准确率收益放在同一张表里看。
+
+运行记录（JSON）::
+
+    {"run_id", "label", "timestamp", "git_revision", "meta",
+     "levels": [{"scenario", "concurrency", "requests", "errors", "error_rate", "qps",
+                 "latency_ms": {"p50", "p95", "p99", "mean"}, "tokens_per_s", "gpu": {...} | null}],
+     "accuracy": {"mean": 0.83, "per_tag": {"路径标签": 识别率}} | null}
+
+``levels`` 可来自 ``benchmark_suite.py`` 的报告或 ``model/vllm_test_2.py`` 的梯度压测结果；
+``accuracy`` 来自 ``json_to_excel`` 生成的 Excel（"识别率统计" sheet）。
+
+运行示例：
+    python bench_compare.py store --input bench_report.json --label prompt_v3 --accuracy-excel retest.xlsx
+    python bench_compare.py diff bench_runs/xxx_baseline.json bench_runs/xxx_prompt_v3.json --excel diff.xlsx
+    python bench_compare.py list
+"""
+import os
+import json
+import time
+import argparse
+import threading
+import subprocess
+
+import pandas as pd
+
+DEFAULT_RUNS_DIR = "bench_runs"
+
+
+# ==========================================
+# GPU 采样（pynvml 可选）
+# ==========================================
+def _init_nvml():
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        return pynvml
+    except Exception:
+        return None
+
+
+class GpuSampler:
+    """压测期间在后台线程按固定间隔采样 GPU 利用率与显存；没有 pynvml / GPU 时 summary() 返回 None"""
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self._nvml = _init_nvml()
+        self._samples = []  # [(util%, 显存 GB)]，所有卡一起
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        nvml = self._nvml
+        for i in range(nvml.nvmlDeviceGetCount()):
+            handle = nvml.nvmlDeviceGetHandleByIndex(i)
+            self._samples.append((nvml.nvmlDeviceGetUtilizationRates(handle).gpu,
+                                  nvml.nvmlDeviceGetMemoryInfo(handle).used / 1024 ** 3))
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._sample()
+            except Exception:
+                return
+
+    def __enter__(self):
+        if self._nvml is not None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval * 2)
+
+    def summary(self):
+        if not self._samples:
+            return None
+        utils = [u for u, _ in self._samples]
+        return {
+            "avg_util": round(sum(utils) / len(utils), 1),
+            "max_util": max(utils),
+            "max_mem_gb": round(max(m for _, m in self._samples), 2),
+        }
+
+
+# ==========================================
+# 运行记录：归一化 / 存取
+# ==========================================
+def _level(scenario, concurrency, requests, errors, qps, p50, p95, p99, mean, tokens_per_s=None, gpu=None) -> dict:
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "error_rate": round(errors / requests, 4) if requests else 0.0,
+        "qps": qps,
+        "latency_ms": {"p50": p50, "p95": p95, "p99": p99, "mean": mean},
+        "tokens_per_s": tokens_per_s,
+        "gpu": gpu,
+    }
+
+
+def levels_from_benchmark_suite(report: dict) -> list:
+    return [
+        _level(r["scenario"], r["concurrency"], r["requests"], r["errors"], r["qps"],
+               r["latency_ms"]["p50"], r["latency_ms"]["p95"], r["latency_ms"]["p99"], r["latency_ms"]["mean"],
+               r.get("tokens_per_s"), r.get("gpu"))
+        for r in report["results"]
+    ]
+
+
+def levels_from_vllm_test(final_report: list, scenario: str = "vllm") -> list:
+    """model/vllm_test_2.py 的 stat_results 列表（秒），没有 p99 时用 p95 代替"""
+    to_ms = lambda s: round(s * 1000, 1) if s is not None else None
+    return [
+        _level(scenario, s["concurrent_num"], s["concurrent_num"], s["fail_num"], round(s["qps"], 2),
+               to_ms(s["median_cost"]), to_ms(s["p95_cost"]), to_ms(s.get("p99_cost", s["p95_cost"])),
+               to_ms(s["avg_cost"]), s.get("tokens_per_s"), s.get("gpu"))
+        for s in final_report
+    ]
+
+
+def load_levels(path: str) -> list:
+    """自动识别输入格式：benchmark_suite 报告 / vllm_test_2 结果列表 / 已有运行记录"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return levels_from_vllm_test(data)
+    if "levels" in data:
+        return data["levels"]
+    return levels_from_benchmark_suite(data)
+
+
+def accuracy_from_excel(excel_path: str) -> dict:
+    """读取 json_to_excel 生成的 "识别率统计" sheet；传入结果 JSON/JSONL 时直接列式计算"""
+    if excel_path.endswith(('.json', '.jsonl')):
+        from eval_core import load_run, recall_stats
+        stats = recall_stats(load_run(excel_path))
+    else:
+        stats = pd.read_excel(excel_path, sheet_name='识别率统计', engine='openpyxl')
+    per_tag = dict(zip(stats['路径标签'].astype(str), stats['识别率'].astype(float)))
+    return {"mean": round(float(stats['识别率'].mean()), 4) if len(stats) else 0.0, "per_tag": per_tag}
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def make_run(levels: list, label: str, meta: dict = None, accuracy: dict = None) -> dict:
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    return {
+        "run_id": f"{timestamp}_{label}",
+        "label": label,
+        "timestamp": timestamp,
+        "git_revision": _git_revision(),
+        "meta": meta or {},
+        "levels": levels,
+        "accuracy": accuracy,
+    }
+
+
+def save_run(run: dict, runs_dir: str = DEFAULT_RUNS_DIR) -> str:
+    os.makedirs(runs_dir, exist_ok=True)
+    path = os.path.join(runs_dir, f"{run['run_id']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(run, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def load_run(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ==========================================
+# 对比
+# ==========================================
+def _pct(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return round((new / old - 1) * 100, 1)
+
+
+def diff_performance(base: dict, new: dict) -> pd.DataFrame:
+    """按 (场景, 并发) 对齐，新旧指标并排，变化用百分比表示（延迟为正表示变慢，QPS 为正表示变快）"""
+    def _index(run):
+        return {(lv["scenario"], lv["concurrency"]): lv for lv in run["levels"]}
+
+    old_levels, new_levels = _index(base), _index(new)
+    rows = []
+    for key in sorted(set(old_levels) | set(new_levels), key=lambda k: (str(k[0]), k[1])):
+        old, cur = old_levels.get(key), new_levels.get(key)
+        row = {"场景": key[0], "并发": key[1]}
+        for name, getter in [
+            ("QPS", lambda lv: lv["qps"]),
+            ("p50(ms)", lambda lv: lv["latency_ms"]["p50"]),
+            ("p95(ms)", lambda lv: lv["latency_ms"]["p95"]),
+            ("p99(ms)", lambda lv: lv["latency_ms"]["p99"]),
+            ("tokens/s", lambda lv: lv.get("tokens_per_s")),
+            ("失败率", lambda lv: lv["error_rate"]),
+            ("GPU利用率", lambda lv: (lv.get("gpu") or {}).get("avg_util")),
+        ]:
+            old_value = getter(old) if old else None
+            new_value = getter(cur) if cur else None
+            row[f"{name}_旧"] = old_value
+            row[f"{name}_新"] = new_value
+            if name != "失败率":
+                row[f"{name}_变化%"] = _pct(old_value, new_value)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def diff_accuracy(base: dict, new: dict) -> pd.DataFrame:
+    """与 compare_two_excels 相同的口径：按路径标签内连接，improvement = 新 - 旧"""
+    if not base.get("accuracy") or not new.get("accuracy"):
+        return pd.DataFrame(columns=['路径标签', 'acc_old', 'acc_new', 'improvement'])
+    old = pd.Series(base["accuracy"]["per_tag"], name='acc_old')
+    cur = pd.Series(new["accuracy"]["per_tag"], name='acc_new')
+    merged = pd.concat([old, cur], axis=1, join='inner').rename_axis('路径标签').reset_index()
+    merged['improvement'] = merged['acc_new'] - merged['acc_old']
+    return merged.sort_values('improvement', ascending=False).reset_index(drop=True)
+
+
+def print_report(base: dict, new: dict, perf: pd.DataFrame, acc: pd.DataFrame, top_n: int = 10):
+    print(f"===== {base['label']}（{base['git_revision']}） vs {new['label']}（{new['git_revision']}） =====")
+    if base.get("accuracy") and new.get("accuracy"):
+        old_mean, new_mean = base["accuracy"]["mean"], new["accuracy"]["mean"]
+        print(f"平均识别率：{old_mean:.2%} → {new_mean:.2%}（{(new_mean - old_mean) * 100:+.2f} pp）")
+    print(f"{'场景':<12} {'并发':>4} | {'QPS 旧→新':>18} {'变化':>7} | {'p95(ms) 旧→新':>22} {'变化':>7} | "
+          f"{'p99(ms) 旧→新':>22} {'变化':>7} | {'tokens/s 变化':>12}")
+    fmt = lambda v: "-" if v is None or pd.isna(v) else f"{v:g}"
+    pct = lambda v: "-" if v is None or pd.isna(v) else f"{v:+.1f}%"
+    for _, r in perf.iterrows():
+        print(f"{str(r['场景']):<12} {r['并发']:>4} | {fmt(r['QPS_旧']) + '→' + fmt(r['QPS_新']):>18} {pct(r['QPS_变化%']):>7} | "
+              f"{fmt(r['p95(ms)_旧']) + '→' + fmt(r['p95(ms)_新']):>22} {pct(r['p95(ms)_变化%']):>7} | "
+              f"{fmt(r['p99(ms)_旧']) + '→' + fmt(r['p99(ms)_新']):>22} {pct(r['p99(ms)_变化%']):>7} | "
+              f"{pct(r['tokens/s_变化%']):>12}")
+    if not acc.empty:
+        improved, dropped = acc[acc['improvement'] > 0], acc[acc['improvement'] < 0].iloc[::-1]
+        for title, rows in [("识别率提升", improved), ("识别率下降", dropped)]:
+            print(f"\n{title} Top {min(top_n, len(rows))}：")
+            for _, r in rows.head(top_n).iterrows():
+                print(f"  {r['路径标签']}: {r['acc_old']:.2%} → {r['acc_new']:.2%}（{r['improvement'] * 100:+.1f} pp）")
+
+
+def compare_runs(base_path: str, new_path: str, excel_path: str = None, top_n: int = 10):
+    base, new = load_run(base_path), load_run(new_path)
+    perf, acc = diff_performance(base, new), diff_accuracy(base, new)
+    print_report(base, new, perf, acc, top_n)
+    if excel_path:
+        with pd.ExcelWriter(excel_path, engine='openpyxl') as writer:
+            perf.to_excel(writer, sheet_name='性能对比', index=False)
+            acc.to_excel(writer, sheet_name='识别率对比', index=False)
+        print(f"[√] 对比明细已保存: {excel_path}")
+    return perf, acc
+
+
+def main():
+    parser = argparse.ArgumentParser(description="压测运行记录存档与对比")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    store = sub.add_parser("store", help="把压测报告（+ 识别率 Excel）存成一条运行记录")
+    store.add_argument("--input", required=True, help="benchmark_suite 报告或 vllm_test_2 结果 JSON")
+    store.add_argument("--label", required=True, help="本次改动的简短名字，如 prompt_v3 / edge_1024")
+    store.add_argument("--accuracy-excel", default=None, help="json_to_excel 生成的识别率 Excel，或直接传结果 JSON/JSONL")
+    store.add_argument("--runs-dir", default=DEFAULT_RUNS_DIR)
+
+    diff = sub.add_parser("diff", help="对比两条运行记录")
+    diff.add_argument("base")
+    diff.add_argument("new")
+    diff.add_argument("--excel", default=None, help="同时导出对比明细 Excel")
+    diff.add_argument("--top-n", type=int, default=10)
+
+    listing = sub.add_parser("list", help="列出已存档的运行记录")
+    listing.add_argument("--runs-dir", default=DEFAULT_RUNS_DIR)
+    args = parser.parse_args()
+
+    if args.command == "store":
+        with open(args.input, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        meta = data.get("meta", {}) if isinstance(data, dict) else {}
+        accuracy = accuracy_from_excel(args.accuracy_excel) if args.accuracy_excel else None
+        path = save_run(make_run(load_levels(args.input), args.label, meta, accuracy), args.runs_dir)
+        print(f"✅ 运行记录已保存: {path}")
+    elif args.command == "diff":
+        compare_runs(args.base, args.new, args.excel, args.top_n)
+    else:
+        if not os.path.isdir(args.runs_dir):
+            print(f"{args.runs_dir} 下没有运行记录")
+            return
+        for name in sorted(os.listdir(args.runs_dir)):
+            if name.endswith(".json"):
+                run = load_run(os.path.join(args.runs_dir, name))
+                acc = run.get("accuracy") or {}
+                print(f"{name:<48} {run['git_revision']:<10} {len(run['levels']):>3} 档  "
+                      f"识别率 {acc.get('mean', '-')}")
+
+
+if __name__ == "__main__":
+    main()
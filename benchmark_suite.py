@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : benchmark_suite.py
+# @Usage   : 基于 mock vLLM 的可复现端到端压测，CPU 机器上即可发现编排层的性能回退
+"""
+启动若干个 ``mock_vllm_server`` 后端（固定随机种子），生成一组固定尺寸分布的合成图片，
+在固定并发档位下依次压测：
+
+- ``single``：线程池直接调用 ``process_single_image``（LangGraph + OpenAI SDK）；
+- ``api``：后台启动 ``fast_app``，httpx 异步并发调用 ``/process_image``；
+- ``batch_graph`` / ``batch_api``：``batch_cli.run_batch`` 的两种在线执行目标；
+- ``batch_stub``：离线两阶段批处理（StubEngine），只衡量编码与编排开销。
+
+每个 (场景, 并发) 输出请求数、失败数、QPS、p50/p95/p99/mean 延迟、mock 后端的输出 tokens/s
+（有 pynvml 与 GPU 时附带 GPU 利用率），写入 JSON 报告；报告可直接交给 ``bench_compare.py store`` 存档对比。
+
+运行示例：
+    python benchmark_suite.py --concurrency 1,8,32 --requests 64 --output bench_report.json
+    python benchmark_suite.py --scenarios single,api --per-token-ms 0 --error-rate 0.02
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_vllm_server import MockConfig, BackgroundServer, create_mock_app
+from bench_compare import GpuSampler
+
+SCENARIOS = ("single", "api", "batch_graph", "batch_api", "batch_stub")
+# (宽, 高, 占比)：缩略图 / 常见手机图 / 大图
+DEFAULT_IMAGE_MIX = [(480, 640, 0.3), (1080, 1440, 0.5), (3000, 4000, 0.2)]
+
+
+# ==========================================
+# 测试数据与统计
+# ==========================================
+def make_image_mix(folder: str, count: int, mix: list = None, seed: int = 0) -> list:
+    """按尺寸分布生成确定性的合成图片（噪声色块，避免被 JPEG 压到过小）"""
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_IMAGE_MIX
+    sizes = rng.choices([(w, h) for w, h, _ in mix], weights=[p for _, _, p in mix], k=count)
+    paths = []
+    for i, (width, height) in enumerate(sizes):
+        path = os.path.join(folder, f"bench_{i:05d}_{width}x{height}.jpg")
+        if not os.path.exists(path):
+            image = Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+            draw = ImageDraw.Draw(image)
+            for _ in range(20):
+                x, y = rng.randrange(width), rng.randrange(height)
+                draw.rectangle([x, y, x + width // 5, y + height // 5], fill=tuple(rng.randrange(256) for _ in range(3)))
+            image.save(path, quality=85)
+        paths.append(path)
+    return paths
+
+
+def _percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def summarize(scenario: str, concurrency: int, latencies: list, errors: int, wall: float) -> dict:
+    values = sorted(latencies)
+    total = len(values) + errors
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "wall_seconds": round(wall, 3),
+        "qps": round(total / wall, 2) if wall > 0 else 0.0,
+        "latency_ms": {
+            "p50": round(_percentile(values, 0.50) * 1000, 1),
+            "p95": round(_percentile(values, 0.95) * 1000, 1),
+            "p99": round(_percentile(values, 0.99) * 1000, 1),
+            "mean": round(sum(values) / len(values) * 1000, 1) if values else 0.0,
+        },
+    }
+
+
+def _is_success(result) -> bool:
+    return isinstance(result, dict) and result.get("status") == "success" and not result.get("failed_nodes")
+
+
+# ==========================================
+# 压测场景
+# ==========================================
+def bench_single(paths: list, concurrency: int) -> dict:
+    from image_uds_local_new import process_single_image
+
+    def _timed(path):
+        start = time.perf_counter()
+        # 与 bench_api 相同的调度类别，两个单请求场景可直接对比
+        result = process_single_image(path, priority="interactive")
+        return time.perf_counter() - start, _is_success(result)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(_timed, paths))
+    wall = time.perf_counter() - start
+    return summarize("single", concurrency, [t for t, ok in samples if ok], sum(1 for _, ok in samples if not ok), wall)
+
+
+def bench_api(paths: list, concurrency: int, api_url: str) -> dict:
+    import httpx
+
+    async def _run():
+        semaphore = asyncio.Semaphore(concurrency)
+        async with httpx.AsyncClient(timeout=300, limits=httpx.Limits(max_connections=None)) as client:
+            async def _one(path):
+                async with semaphore:
+                    start = time.perf_counter()
+                    try:
+                        response = await client.post(api_url, json={"image_info": path, "priority": "interactive"})
+                        ok = response.status_code == 200 and _is_success(response.json().get("res"))
+                    except httpx.HTTPError:
+                        ok = False
+                    return time.perf_counter() - start, ok
+            return await asyncio.gather(*(_one(p) for p in paths))
+
+    start = time.perf_counter()
+    samples = asyncio.run(_run())
+    wall = time.perf_counter() - start
+    return summarize("api", concurrency, [t for t, ok in samples if ok], sum(1 for _, ok in samples if not ok), wall)
+
+
+def bench_batch(paths: list, concurrency: int, target: str, api_url: str = None) -> dict:
+    """延迟取 run_items 记录的客户端实测耗时，与 single/api 场景口径一致"""
+    from batch_cli import BatchItem, run_batch
+    items = [BatchItem(p, {}) for p in paths]
+    kwargs = {"api_url": api_url} if api_url else {}
+    start = time.perf_counter()
+    records = run_batch(items, target=target, output=None, concurrency=concurrency, progress=False, **kwargs)
+    wall = time.perf_counter() - start
+    results = [r["process_result"] for r in records]
+    latencies = [rec["client_latency"] for rec in records if _is_success(rec["process_result"])]
+    return summarize(f"batch_{target}", concurrency, latencies, sum(1 for r in results if not _is_success(r)), wall)
+
+
+# ==========================================
+# 编排
+# ==========================================
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def start_mock_backends(config: MockConfig, count: int, base_port: int) -> list:
+    """每个后端独立的配置副本与随机种子；必须在导入 image_uds_local_new 之前调用"""
+    servers = []
+    for i in range(count):
+        backend_config = MockConfig(**{**config.__dict__, "seed": None if config.seed is None else config.seed + i})
+        servers.append(BackgroundServer(create_mock_app(backend_config), port=base_port + i).__enter__())
+    os.environ["VLM_BACKENDS"] = ",".join(f"{s.url}/v1" for s in servers)
+    os.environ.setdefault("WARMUP_ON_STARTUP", "0")
+    return servers
+
+
+def run_suite(scenarios: list, concurrency_levels: list, requests: int, config: MockConfig,
+              backends: int = 2, base_port: int = 18000, image_folder: str = None, seed: int = 0) -> dict:
+    servers = start_mock_backends(config, backends, base_port)
+    api_server = None
+    try:
+        with tempfile.TemporaryDirectory(prefix="tagging_bench_") as tmp:
+            paths = make_image_mix(image_folder or tmp, requests, seed=seed)
+            results = []
+            api_url = None
+            if {"api", "batch_api"} & set(scenarios):
+                from image_uds_local_new import fast_app, service_ready
+                api_server = BackgroundServer(fast_app, port=base_port + backends).__enter__()
+                api_url = f"{api_server.url}/process_image"
+                deadline = time.monotonic() + 30
+                while not service_ready.is_set() and time.monotonic() < deadline:
+                    time.sleep(0.05)
+
+            def _completion_tokens():
+                return sum(s.app.state.mock_stats["completion_tokens"] for s in servers)
+
+            def _run_level(scenario, concurrency):
+                if scenario == "single":
+                    return bench_single(paths, concurrency)
+                if scenario == "api":
+                    return bench_api(paths, concurrency, api_url)
+                if scenario == "batch_api":
+                    return bench_batch(paths, concurrency, "api", api_url)
+                return bench_batch(paths, concurrency, scenario[len("batch_"):])
+
+            for scenario in scenarios:
+                for concurrency in concurrency_levels:
+                    tokens_before = _completion_tokens()
+                    with GpuSampler() as sampler:
+                        summary = _run_level(scenario, concurrency)
+                    # stub 场景不经过 mock 后端，tokens/s 为 0
+                    wall = summary["wall_seconds"]
+                    summary["tokens_per_s"] = round((_completion_tokens() - tokens_before) / wall, 1) if wall > 0 else 0.0
+                    summary["gpu"] = sampler.summary()
+                    results.append(summary)
+                    lat = summary["latency_ms"]
+                    print(f"{scenario:<12} c={concurrency:<4} qps={summary['qps']:<8} p50={lat['p50']}ms "
+                          f"p95={lat['p95']}ms p99={lat['p99']}ms errors={summary['errors']}", flush=True)
+    finally:
+        if api_server is not None:
+            api_server.__exit__(None, None, None)
+        for server in servers:
+            server.__exit__(None, None, None)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "git_revision": _git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "requests_per_level": requests,
+            "backends": backends,
+            "image_mix": DEFAULT_IMAGE_MIX,
+            "seed": seed,
+            "mock_config": config.__dict__,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="基于 mock vLLM 的端到端压测")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"逗号分隔，可选 {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="逗号分隔的并发档位")
+    parser.add_argument("--requests", type=int, default=64, help="每个档位的请求数（图片数）")
+    parser.add_argument("--backends", type=int, default=2, help="mock 后端数量")
+    parser.add_argument("--base-port", type=int, default=18000)
+    parser.add_argument("--image-folder", default=None, help="合成图片缓存目录，默认临时目录")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_report.json")
+    # mock 后端参数
+    parser.add_argument("--base-ms", type=float, default=5.0)
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=20.0)
+    parser.add_argument("--per-token-ms", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--max-concurrency", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景：{','.join(sorted(unknown))}")
+    config = MockConfig(base_ms=args.base_ms, prefill_ms_per_1k=args.prefill_ms_per_1k, per_token_ms=args.per_token_ms,
+                        jitter=args.jitter, max_concurrency=args.max_concurrency, error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate, seed=args.seed)
+    report = run_suite(scenarios, [int(c) for c in args.concurrency.split(",")], args.requests, config,
+                       args.backends, args.base_port, args.image_folder, args.seed)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✅ 压测报告已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : debug_trace.py
+# @Usage   : 按请求开启的 prompt/response 调试记录（有界环形缓冲区）
+"""
+节点不再往图状态里追加 HumanMessage/AIMessage；只有请求带 ``debug=True`` 时，
+才把 (节点, prompt, 模型输出) 写进进程内的环形缓冲区，并按 trace_id 查询。
+缓冲区大小由 DEBUG_TRACE_SIZE 控制（默认 500 条），写满后自动淘汰最旧的记录。
+"""
+import os
+import time
+import threading
+from collections import deque
+
+from tracing import current_trace_id
+
+
+class DebugTraceBuffer:
+    def __init__(self, max_entries: int = 500):
+        self._entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+
+    def append(self, entry: dict):
+        with self._lock:
+            self._entries.append(entry)
+
+    def get(self, trace_id: str) -> list:
+        with self._lock:
+            return [e for e in self._entries if e["trace_id"] == trace_id]
+
+    def recent(self, limit: int = 50) -> list:
+        with self._lock:
+            return list(self._entries)[-limit:]
+
+
+debug_buffer = DebugTraceBuffer(int(os.getenv("DEBUG_TRACE_SIZE", "500")))
+
+
+def record_exchange(state: dict, node: str, prompt: str, content: str):
+    """debug 开关打开时记录一次 prompt/response，关闭时不做任何分配"""
+    if not state.get("debug_trace"):
+        return
+    debug_buffer.append({
+        "trace_id": current_trace_id(),
+        "node": node,
+        "prompt": prompt,
+        "response": content,
+        "ts": time.time(),
+    })
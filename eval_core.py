@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : eval_core.py
+# @Usage   : 列式评测核心：结果 JSON/JSONL 只解析一次（Parquet 缓存），向量化计算识别率、精确率与混淆表
+"""
+``json_to_excel`` 逐条循环做 ``target_tag in label`` 子串匹配，``compare_two_excels`` 还要从 Excel 读回统计表，
+十万级结果要跑几分钟。这里把一次运行读成列式 DataFrame（每图一行，预测标签为 list 列）：
+
+- 解析结果按 (路径, 大小, 修改时间) 缓存为 ``.eval_cache/<name>.parquet``，再次分析直接读列存；
+- 命中判断只对去重后的 (路径标签, 预测标签) 对做子串匹配，再按图片 ``any`` 回填，
+  标签词表通常只有几百个，比逐图逐标签比较少两三个数量级；
+- 统计口径与 ``json_to_excel`` 完全一致：期望标签取最后一级（去掉编号），预测标签任一包含它即命中。
+
+除识别率（即召回率）外还给出每个路径标签的精确率/F1（预测标签包含该标签的图片中，期望也是该标签的比例），
+以及未命中图片被预测成了哪些其他路径标签的混淆表。
+
+运行示例：
+    python eval_core.py run.json
+    python eval_core.py new.jsonl --compare old.json --excel diff.xlsx
+"""
+import os
+import re
+import json
+import hashlib
+import argparse
+from itertools import chain
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from logger import get_logger
+
+logger = get_logger(service="eval_core")
+
+try:
+    import pyarrow  # noqa: F401
+    CACHE_EXT = ".parquet"
+except ImportError:  # 没有 pyarrow 时退回 pickle 缓存，功能不受影响
+    pyarrow = None
+    CACHE_EXT = ".pkl"
+
+DEFAULT_CACHE_DIR = ".eval_cache"
+# 列式运行表的列
+RUN_COLUMNS = ["image_path", "image_url", "target_tag", "labels", "total_labels_count", "elapsed_time", "token_cost",
+               "status"]
+_TAG_PREFIX = r'^[\d\.\s、]+'
+
+
+def clean_tags(path_parts):
+    """
+    输入: ['10、节日与活动', '10.1 节日', '1、生日']
+    输出: ['节日与活动', '节日', '生日']
+    """
+    # 正则替换：去掉开头的数字、点、空格、顿号
+    return [re.sub(_TAG_PREFIX, '', part) for part in path_parts]
+
+
+# ==========================================
+# 加载：JSON / JSONL -> 列式运行表
+# ==========================================
+def _read_records(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def frame_from_records(records: list) -> pd.DataFrame:
+    """
+    结果记录列表 -> 运行表；这是唯一的逐条循环，只取字段不做计算。
+    取值与 json_to_excel 相同：顶层为空时取 res 下的值，两处都没有记为缺失。
+    """
+    image_paths, image_urls, last_tags, labels, counts, elapsed, costs, statuses = ([] for _ in range(8))
+    for entry in records:
+        result = entry.get("process_result") or {}
+        nested = result.get("res") or {}
+        except_tags = entry.get("except_tags") or []
+        image_paths.append(entry.get("image_path", ""))
+        image_urls.append(entry.get("image_url", ""))
+        last_tags.append(except_tags[-1] if except_tags else "")
+        labels.append(result.get("final_labels") or nested.get("final_labels") or [])
+        counts.append(result.get("total_labels_count", "") or nested.get("total_labels_count", ""))
+        elapsed.append(result.get("elapsed_time", "") or nested.get("elapsed_time", ""))
+        costs.append(result.get("token_cost", "") or nested.get("token_cost", ""))
+        statuses.append(result.get("status") or nested.get("status") or "")
+    df = pd.DataFrame({
+        "image_path": pd.Series(image_paths, dtype="string"),
+        "image_url": pd.Series(image_urls, dtype="string"),
+        "target_tag": pd.Series(last_tags, dtype="string").str.replace(_TAG_PREFIX, "", regex=True),
+        "labels": labels,
+        # "" 表示缺失，转成数值列后为 NA，导出时再还原为空
+        "total_labels_count": pd.to_numeric(pd.Series(counts, dtype=object), errors="coerce").astype("Int64"),
+        "elapsed_time": pd.to_numeric(pd.Series(elapsed, dtype=object), errors="coerce"),
+        "token_cost": pd.to_numeric(pd.Series(costs, dtype=object), errors="coerce"),
+        "status": pd.Series(statuses, dtype="string"),
+    })
+    return df[RUN_COLUMNS]
+
+
+def _cache_path(path: str, cache_dir: str) -> str:
+    stat = os.stat(path)
+    key = hashlib.md5(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}_{key}{CACHE_EXT}")
+
+
+def load_run(path: str, cache_dir: str = DEFAULT_CACHE_DIR, refresh: bool = False) -> pd.DataFrame:
+    """读取一次运行的结果（JSON 列表或 batch_cli 的 JSONL）；文件未变化时直接读缓存"""
+    cache = _cache_path(path, cache_dir) if cache_dir else None
+    if cache and not refresh and os.path.exists(cache):
+        return pd.read_parquet(cache) if pyarrow is not None else pd.read_pickle(cache)
+    df = frame_from_records(_read_records(path))
+    if cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        if pyarrow is not None:
+            df.to_parquet(cache, index=False)
+        else:
+            df.to_pickle(cache)
+        logger.info(f"已缓存 {len(df)} 条结果：{cache}")
+    return df
+
+
+# ==========================================
+# 向量化命中判断
+# ==========================================
+@dataclass
+class ExplodedRun:
+    """展开后的 (图片, 预测标签) 对，标签均编码为整数，匹配与连接都在整数列上做"""
+    rows: np.ndarray          # 每对所属运行表行号
+    labels: np.ndarray        # 每对的预测标签编号 -> label_vocab
+    row_tags: np.ndarray      # 每张图片的路径标签编号 -> tag_vocab（空标签为 -1）
+    tag_vocab: np.ndarray
+    label_vocab: np.ndarray
+
+
+def explode_labels(run: pd.DataFrame) -> ExplodedRun:
+    lengths = run["labels"].map(len).to_numpy()
+    rows = np.repeat(np.arange(len(run)), lengths)
+    labels, label_vocab = pd.factorize(pd.Series(list(chain.from_iterable(run["labels"])), dtype=object))
+    row_tags, tag_vocab = pd.factorize(run["target_tag"].replace("", pd.NA))
+    return ExplodedRun(rows, labels, row_tags, np.asarray(tag_vocab, dtype=object), np.asarray(label_vocab, dtype=object))
+
+
+def _contains(exploded: ExplodedRun, tags: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """(路径标签编号, 预测标签编号) -> 是否子串命中；只对去重后的对做一次 Python 比较"""
+    keys = tags.astype(np.int64) * len(exploded.label_vocab) + labels
+    unique, inverse = np.unique(keys, return_inverse=True)
+    tag_vocab, label_vocab = exploded.tag_vocab, exploded.label_vocab
+    hit = np.fromiter((tag_vocab[k // len(label_vocab)] in label_vocab[k % len(label_vocab)] for k in unique),
+                      dtype=bool, count=len(unique))
+    return hit[inverse]
+
+
+def hit_mask(run: pd.DataFrame, exploded: ExplodedRun = None) -> pd.Series:
+    """每张图片是否命中自己的路径标签（bool，按运行表行号对齐）"""
+    exploded = explode_labels(run) if exploded is None else exploded
+    tags = exploded.row_tags[exploded.rows]
+    valid = tags >= 0
+    matched = np.zeros(len(run), dtype=bool)
+    matched[exploded.rows[valid][_contains(exploded, tags[valid], exploded.labels[valid])]] = True
+    return pd.Series(matched, index=run.index)
+
+
+def predicted_tags(run: pd.DataFrame, exploded: ExplodedRun = None) -> pd.DataFrame:
+    """每张图片的预测标签覆盖了词表中的哪些路径标签：(row, tag) 去重，tag 为 tag_vocab 编号"""
+    exploded = explode_labels(run) if exploded is None else exploded
+    # 词表 × 出现过的预测标签，命中的 (label, tag) 映射
+    grid_tags, grid_labels = np.meshgrid(np.arange(len(exploded.tag_vocab)), np.arange(len(exploded.label_vocab)))
+    grid_tags, grid_labels = grid_tags.ravel(), grid_labels.ravel()
+    hit = _contains(exploded, grid_tags, grid_labels)
+    mapping = pd.DataFrame({"label": grid_labels[hit], "tag": grid_tags[hit]})
+    pairs = pd.DataFrame({"row": exploded.rows, "label": exploded.labels}).merge(mapping, on="label")
+    return pairs[["row", "tag"]].drop_duplicates(ignore_index=True)
+
+
+# ==========================================
+# 统计表（列名与 json_to_excel 的 sheet 一致）
+# ==========================================
+def result_table(run: pd.DataFrame, hits: pd.Series = None) -> pd.DataFrame:
+    """"原始数据" 表"""
+    hits = hit_mask(run) if hits is None else hits
+
+    def _blank(series):
+        return series.astype(object).where(series.notna(), "")
+
+    return pd.DataFrame({
+        '路径名': _blank(run["image_path"]),
+        '路径URL': _blank(run["image_url"]),
+        '预测标签': run["labels"].map(lambda labels: '|'.join(labels)),
+        '路径标签': _blank(run["target_tag"]),
+        '是否包含': hits.map({True: '是', False: '否'}),
+        '标签数量': _blank(run["total_labels_count"]),
+        '耗时': _blank(run["elapsed_time"]),
+        'Token消耗': _blank(run["token_cost"]),
+    })
+
+
+def recall_stats(run: pd.DataFrame, hits: pd.Series = None) -> pd.DataFrame:
+    """"识别率统计" 表：按路径标签统计总数、匹配数与识别率"""
+    hits = hit_mask(run) if hits is None else hits
+    frame = pd.DataFrame({'路径标签': _blank_tags(run), 'hit': hits.astype(int)})
+    stats = frame.groupby('路径标签').agg(总数=('hit', 'count'), 匹配数=('hit', 'sum')).reset_index()
+    stats['识别率'] = stats['匹配数'] / stats['总数']
+    stats['识别率(%)'] = (stats['识别率'] * 100).round(2).astype(str) + '%'
+    return stats
+
+
+def _blank_tags(run: pd.DataFrame) -> pd.Series:
+    return run["target_tag"].fillna("").astype(object)
+
+
+def precision_recall(run: pd.DataFrame, hits: pd.Series = None, exploded: ExplodedRun = None,
+                     predicted: pd.DataFrame = None) -> pd.DataFrame:
+    """每个路径标签的召回率（= 识别率）、精确率与 F1"""
+    exploded = explode_labels(run) if exploded is None else exploded
+    hits = hit_mask(run, exploded) if hits is None else hits
+    stats = recall_stats(run, hits)
+    predicted = predicted_tags(run, exploded) if predicted is None else predicted
+    predicted_count = pd.Series(np.bincount(predicted["tag"], minlength=len(exploded.tag_vocab)),
+                                index=exploded.tag_vocab, name="预测数")
+    stats = stats.merge(predicted_count, left_on='路径标签', right_index=True, how='left')
+    stats['预测数'] = stats['预测数'].fillna(0).astype(int)
+    stats = stats.rename(columns={'识别率': '召回率'}).drop(columns=['识别率(%)'])
+    stats['精确率'] = (stats['匹配数'] / stats['预测数']).where(stats['预测数'] > 0, 0.0)
+    denominator = stats['精确率'] + stats['召回率']
+    stats['F1'] = (2 * stats['精确率'] * stats['召回率'] / denominator).where(denominator > 0, 0.0)
+    return stats
+
+
+def confusion_table(run: pd.DataFrame, hits: pd.Series = None, exploded: ExplodedRun = None,
+                    predicted: pd.DataFrame = None, top_n: int = None) -> pd.DataFrame:
+    """未命中图片的预测覆盖了哪些其他路径标签：(路径标签, 预测为, 次数, 占比)，按次数降序"""
+    exploded = explode_labels(run) if exploded is None else exploded
+    hits = hit_mask(run, exploded) if hits is None else hits
+    predicted = predicted_tags(run, exploded) if predicted is None else predicted
+    rows, tags = predicted["row"].to_numpy(), predicted["tag"].to_numpy()
+    own = exploded.row_tags[rows]
+    # 只看有路径标签且未命中的图片，预测覆盖到的其他路径标签
+    keep = (own >= 0) & ~hits.to_numpy()[rows] & (own != tags)
+    missed = pd.DataFrame({'路径标签': exploded.tag_vocab[own[keep]], '预测为': exploded.tag_vocab[tags[keep]]})
+    table = missed.groupby(['路径标签', '预测为']).size().rename('次数').reset_index()
+    totals = _blank_tags(run).value_counts()
+    table['占比'] = table['次数'] / table['路径标签'].map(totals)
+    table = table.sort_values(['次数', '路径标签'], ascending=[False, True]).reset_index(drop=True)
+    return table.head(top_n) if top_n else table
+
+
+def accuracy_overview(stats):
+    """"整体概览" 表：平均准确度（各标签识别率的均值）与命中率分布"""
+    total_tags = len(stats)
+    rates = stats['识别率']
+    avg_acc = rates.mean() if total_tags > 0 else 0
+
+    def safe_rate(cond):
+        return (rates[cond].count() / total_tags) if total_tags > 0 else 0
+
+    summary_data = {
+        '统计项': ['平均准确度', '100%命中率占比', '70%-100%命中率占比', '50%-70%命中率占比', '0-50%命中率占比', '0命中率占比'],
+        '数值': [
+            avg_acc,
+            safe_rate(rates == 1.0),
+            safe_rate((rates >= 0.7) & (rates < 1.0)),
+            safe_rate((rates >= 0.5) & (rates < 0.7)),
+            safe_rate((rates > 0) & (rates < 0.5)),
+            safe_rate(rates == 0)
+        ]
+    }
+    df_summary = pd.DataFrame(summary_data)
+    df_summary['数值(格式化)'] = df_summary['数值'].apply(lambda x: f"{x:.2%}")
+    return df_summary
+
+
+def evaluate(run: pd.DataFrame) -> dict:
+    """一次算齐所有表：{"rows", "stats", "overview", "precision_recall", "confusion"}"""
+    exploded = explode_labels(run)
+    hits = hit_mask(run, exploded)
+    predicted = predicted_tags(run, exploded)
+    stats = recall_stats(run, hits)
+    return {
+        "rows": result_table(run, hits),
+        "stats": stats,
+        "overview": accuracy_overview(stats),
+        "precision_recall": precision_recall(run, hits, exploded, predicted),
+        "confusion": confusion_table(run, hits, exploded, predicted),
+    }
+
+
+def compare_stats(old_stats: pd.DataFrame, new_stats: pd.DataFrame) -> pd.DataFrame:
+    """与 compare_two_excels 相同的口径：按路径标签内连接，improvement = 新 - 旧"""
+    merged = pd.merge(old_stats[['路径标签', '识别率']].rename(columns={'识别率': 'acc_old'}),
+                      new_stats[['路径标签', '识别率']].rename(columns={'识别率': 'acc_new'}),
+                      on='路径标签', how='inner')
+    merged['improvement'] = merged['acc_new'] - merged['acc_old']
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="列式评测：识别率 / 精确率 / 混淆表")
+    parser.add_argument("input", help="结果 JSON 或 JSONL")
+    parser.add_argument("--compare", default=None, help="旧版本结果 JSON/JSONL，输出逐标签对比")
+    parser.add_argument("--excel", default=None, help="写出 Excel（原始数据/识别率统计/整体概览/精确率召回率/混淆表）")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--refresh", action="store_true", help="忽略缓存重新解析")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    tables = evaluate(load_run(args.input, args.cache_dir, args.refresh))
+    overview = tables["overview"]
+    for _, row in overview.iterrows():
+        print(f"{row['统计项']:<16} {row['数值(格式化)']}")
+    print(f"\n===== 混淆最多的 {args.top} 对 =====")
+    print(tables["confusion"].head(args.top).to_string(index=False))
+
+    comparison = None
+    if args.compare:
+        old = evaluate(load_run(args.compare, args.cache_dir, args.refresh))
+        comparison = compare_stats(old["stats"], tables["stats"])
+        print(f"\n===== 提升最多的 {args.top} 个标签 =====")
+        print(comparison.sort_values('improvement', ascending=False).head(args.top).to_string(index=False))
+
+    if args.excel:
+        with pd.ExcelWriter(args.excel, engine='openpyxl') as writer:
+            tables["rows"].to_excel(writer, sheet_name='原始数据', index=False)
+            tables["stats"].to_excel(writer, sheet_name='识别率统计', index=False)
+            overview.to_excel(writer, sheet_name='整体概览', index=False)
+            tables["precision_recall"].to_excel(writer, sheet_name='精确率召回率', index=False)
+            tables["confusion"].to_excel(writer, sheet_name='混淆表', index=False)
+            if comparison is not None:
+                comparison.to_excel(writer, sheet_name='版本对比', index=False)
+        print(f"[√] Excel 已生成: {args.excel}")
+
+
+if __name__ == "__main__":
+    main()
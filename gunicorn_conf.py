@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : gunicorn_conf.py
+# @Usage   : 打标服务的多进程部署配置（gunicorn + uvicorn worker）
+"""
+单个 uvicorn 进程里，图片下载/解码/Resize、JSON 解析与格式化都在同一个 GIL 下，CPU 侧吃不满整机。
+这里用 gunicorn 拉起多个 uvicorn worker，每个 worker 各自一份 VLM 客户端与 LangGraph：
+
+    gunicorn -c gunicorn_conf.py "image_uds_local_new:create_app()"
+
+- ``image_uds_local_new`` 的 import 没有副作用，``preload_app`` 时 master 只加载代码，模型客户端、
+  图与 SQLite 连接都在 worker fork 之后的 lifespan 启动阶段创建；
+- ``VLM_MAX_CONCURRENCY`` 未显式设置时，按 worker 数均分 ``VLM_MAX_CONCURRENCY_TOTAL``（默认 64），
+  整机打到 vLLM 后端的总并发与单进程部署一致；
+- 各 worker 的 Prometheus 指标写入 ``PROMETHEUS_MULTIPROC_DIR``，``/metrics`` 汇总全部进程；
+- 跨进程共享结果缓存默认关闭，与单进程一致；需要时设置 ``RESULT_CACHE_PATH``（如 cache/result_cache.sqlite3），
+  所有 worker 共用这一个 SQLite 文件。
+
+环境变量：BIND（默认 0.0.0.0:8081）、WEB_CONCURRENCY（worker 数，默认 min(CPU 核数, 8)）。
+"""
+import os
+import shutil
+import multiprocessing
+
+bind = os.getenv("BIND", "0.0.0.0:8081")
+workers = int(os.getenv("WEB_CONCURRENCY", str(min(multiprocessing.cpu_count(), 8))))
+try:
+    import uvicorn_worker  # noqa: F401  新版 uvicorn 把 worker 拆成了独立的包
+    worker_class = "uvicorn_worker.UvicornWorker"
+except ImportError:
+    worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+# 单请求最长等于端到端预算，再留出排队余量
+timeout = max(int(os.getenv("REQUEST_DEADLINE_MS", "30000")) // 1000, 30) * 2
+graceful_timeout = 30
+keepalive = 5
+
+# ========== 每个 worker 的 VLM 并发份额 ==========
+if "VLM_MAX_CONCURRENCY" not in os.environ:
+    total = int(os.getenv("VLM_MAX_CONCURRENCY_TOTAL", "64"))
+    os.environ["VLM_MAX_CONCURRENCY"] = str(max(total // workers, 1) if total > 0 else 0)
+
+# ========== Prometheus 多进程模式 ==========
+# 必须在 master 加载应用（import prometheus_client）之前设置
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/tagging_prometheus_multiproc")
+
+
+def on_starting(server):
+    # 上次运行残留的指标文件会被当作"已退出的 worker"继续汇总，启动前清空
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : image_downloader.py
+# @Usage   : 异步并发图片下载：按域名限流、断点续传、内容去重、可选下载时缩放
+"""
+``ImageTagPipeline.download_images`` 原来逐行 ``requests.get``，几千张 badcase 要拉很久。这里改为：
+
+- 一个 httpx 异步连接池（``max_connections``），每个域名再单独限并发（``per_host``），不把单个 OSS 域名打爆；
+- 先写临时文件再原子改名，目录里出现的文件一定是完整的；下载记录写入 ``<根目录>/.download_manifest.jsonl``，
+  重跑时已存在且大小与记录一致（``verify=True`` 时再校验哈希）的文件直接跳过；
+- 同一 URL 只下载一次；不同 URL 内容相同（sha256 一致）时只存一份，其余路径用硬链接（不支持时复制）；
+- ``max_edge`` 不为空时下载后立即缩放为长边 max_edge 的 JPEG（与 ``utils`` 中送模型的预处理一致），
+  本地调试直接用这份"模型输入同款"的小图，文件名保持不变（PIL 按内容识别格式）。
+
+运行示例：
+    python image_downloader.py --excel badcase.xlsx --output-dir downloaded_images --per-host 16
+    python image_downloader.py --excel badcase.xlsx --output-dir model_ready --max-edge 768
+"""
+import io
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import argparse
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+from tqdm import tqdm
+
+from logger import get_logger
+
+logger = get_logger(service="image_downloader")
+
+MANIFEST_NAME = ".download_manifest.jsonl"
+
+
+@dataclass
+class DownloadTask:
+    url: str
+    path: str    # 本地保存路径
+
+
+@dataclass
+class DownloadStats:
+    downloaded: int = 0
+    skipped: int = 0      # 断点续传：已存在
+    deduped: int = 0      # 同 URL / 同内容，链接到已有文件
+    failed: int = 0
+    bytes: int = 0
+    elapsed: float = 0.0
+    errors: list = field(default_factory=list)
+
+    def summary(self) -> str:
+        rate = self.bytes / 1024 / 1024 / self.elapsed if self.elapsed > 0 else 0.0
+        return (f"下载 {self.downloaded}，跳过已存在 {self.skipped}，去重 {self.deduped}，失败 {self.failed}，"
+                f"共 {self.bytes / 1024 / 1024:.1f}MB，耗时 {self.elapsed:.1f}s（{rate:.1f}MB/s）")
+
+
+def resize_image_bytes(content: bytes, max_edge: int, quality: int = 85) -> bytes:
+    """与送模型前的预处理相同：转 RGB、等比缩放长边、JPEG 编码"""
+    from PIL import Image
+    with Image.open(io.BytesIO(content)) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((max_edge, max_edge))
+        buffered = io.BytesIO()
+        img.save(buffered, format="JPEG", quality=quality)
+        return buffered.getvalue()
+
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link_or_copy(src: str, dst: str):
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    tmp = f"{dst}.part"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ImageDownloader:
+    def __init__(self, save_root: str, per_host: int = 8, max_connections: int = 64, timeout: float = 10,
+                 retries: int = 2, max_edge: int = None, quality: int = 85, verify: bool = False,
+                 progress: bool = True):
+        self.save_root = save_root
+        self.per_host = per_host
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+        self.max_edge = max_edge
+        self.quality = quality
+        self.verify = verify
+        self.progress = progress
+        self.manifest_path = os.path.join(save_root, MANIFEST_NAME)
+        self.manifest = self._load_manifest()
+        self._host_limits = {}
+        self._by_hash = {}    # 源内容 sha256 -> Future((已保存路径, 文件 sha256, 文件大小))
+        self._complete = {}   # 路径 -> is_complete 结果，每次 run 内只检查一次（--verify 时要读整个文件）
+        self._manifest_file = None
+
+    # ---------- 断点续传 ----------
+    def _load_manifest(self) -> dict:
+        manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    manifest[entry["path"]] = entry
+        return manifest
+
+    def _record(self, path: str, url: str, source_sha256: str, file_sha256: str, size: int):
+        """file_sha256 / size 由写入的字节直接给出，不回读文件"""
+        entry = {"path": os.path.relpath(path, self.save_root), "url": url, "sha256": source_sha256,
+                 "size": size, "file_sha256": file_sha256, "max_edge": self.max_edge}
+        self.manifest[entry["path"]] = entry
+        if self._manifest_file is None:
+            os.makedirs(self.save_root, exist_ok=True)
+            self._manifest_file = open(self.manifest_path, "a", encoding="utf-8")
+        self._manifest_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._manifest_file.flush()
+
+    def is_complete(self, path: str) -> bool:
+        """文件已存在且与下载记录一致；没有记录的旧文件（改造前下载的）按已完成处理"""
+        key = os.path.abspath(path)
+        if key not in self._complete:
+            self._complete[key] = self._check_complete(path)
+        return self._complete[key]
+
+    def _check_complete(self, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        entry = self.manifest.get(os.path.relpath(path, self.save_root))
+        if entry is None:
+            return os.path.getsize(path) > 0
+        if entry.get("max_edge") != self.max_edge or os.path.getsize(path) != entry["size"]:
+            return False
+        return not self.verify or _sha256_file(path) == entry["file_sha256"]
+
+    # ---------- 下载 ----------
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self._host_limits[host]
+
+    async def _fetch(self, client, url: str) -> bytes:
+        import httpx
+        async with self._host_limit(url):
+            for attempt in range(self.retries + 1):
+                try:
+                    resp = await client.get(url)
+                    if resp.status_code == 200:
+                        return resp.content
+                    if resp.status_code < 500 and resp.status_code != 429:
+                        raise ValueError(f"HTTP {resp.status_code}")
+                    error = f"HTTP {resp.status_code}"
+                except httpx.HTTPError as e:
+                    error = f"{type(e).__name__}: {e}"
+                if attempt < self.retries:
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+            raise ValueError(error)
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.part"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    async def _store(self, content: bytes, digest: str, path: str) -> tuple:
+        """缩放与写盘都放到线程里，不阻塞其他下载；返回 (文件 sha256, 文件大小)"""
+        if self.max_edge:
+            data = await asyncio.to_thread(resize_image_bytes, content, self.max_edge, self.quality)
+            file_sha256 = hashlib.sha256(data).hexdigest()
+        else:
+            data, file_sha256 = content, digest
+        await asyncio.to_thread(self._write_file, path, data)
+        return file_sha256, len(data)
+
+    async def _download_url(self, client, url: str, paths: list, stats: DownloadStats, bar):
+        """同一 URL 的所有目标路径：下载一次，首个路径落盘，其余链接过去"""
+        try:
+            content = await self._fetch(client, url)
+            digest = hashlib.sha256(content).hexdigest()
+            stats.bytes += len(content)
+            existing = self._by_hash.get(digest)
+            if existing is None:
+                # 先登记再落盘：内容相同的其他 URL 等这一份写完后直接链接
+                future = asyncio.get_running_loop().create_future()
+                self._by_hash[digest] = future
+                try:
+                    file_sha256, size = await self._store(content, digest, paths[0])
+                except Exception as e:
+                    del self._by_hash[digest]
+                    future.set_exception(e)
+                    future.exception()  # 已处理，避免未取回异常的警告
+                    raise
+                future.set_result((paths[0], file_sha256, size))
+                self._record(paths[0], url, digest, file_sha256, size)
+                stats.downloaded += 1
+                source, rest = (paths[0], file_sha256, size), paths[1:]
+            else:
+                source, rest = await existing, paths
+            source_path, file_sha256, size = source
+            for path in rest:
+                if os.path.abspath(path) != os.path.abspath(source_path):
+                    await asyncio.to_thread(_link_or_copy, source_path, path)
+                self._record(path, url, digest, file_sha256, size)
+                stats.deduped += 1
+        except Exception as e:
+            stats.failed += len(paths)
+            stats.errors.append({"url": url, "error": str(e)[:200]})
+            logger.warning(f"下载失败 {url}: {e}")
+        bar.update(len(paths))
+
+    async def run(self, tasks: list) -> DownloadStats:
+        import httpx
+        stats = DownloadStats()
+        start = time.perf_counter()
+        self._complete = {}
+        # 已登记且文件完好的内容哈希：续传时新 URL 的内容若已存在，直接链接
+        for entry in self.manifest.values():
+            path = os.path.join(self.save_root, entry["path"])
+            if entry["sha256"] not in self._by_hash and self.is_complete(path):
+                future = asyncio.get_running_loop().create_future()
+                future.set_result((path, entry["file_sha256"], entry["size"]))
+                self._by_hash[entry["sha256"]] = future
+
+        by_url = {}
+        for task in tasks:
+            if self.is_complete(task.path):
+                stats.skipped += 1
+            else:
+                by_url.setdefault(task.url, []).append(task.path)
+        # 多行指向同一路径时只处理一次
+        by_url = {url: list(dict.fromkeys(paths)) for url, paths in by_url.items()}
+
+        bar = tqdm(total=sum(len(p) for p in by_url.values()), desc="下载图片", disable=not self.progress)
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        try:
+            async with httpx.AsyncClient(timeout=self.timeout, limits=limits, follow_redirects=True) as client:
+                await asyncio.gather(*(self._download_url(client, url, paths, stats, bar)
+                                       for url, paths in by_url.items()))
+        finally:
+            bar.close()
+            if self._manifest_file is not None:
+                self._manifest_file.close()
+                self._manifest_file = None
+        stats.elapsed = time.perf_counter() - start
+        return stats
+
+    def download(self, tasks: list) -> DownloadStats:
+        """同步入口"""
+        return asyncio.run(self.run(tasks))
+
+
+def tasks_from_excel(excel_path: str, save_root: str) -> list:
+    """json_to_excel 生成的 Excel："路径URL" 为下载地址，"路径名" 为相对保存路径"""
+    import pandas as pd
+    try:
+        df = pd.read_excel(excel_path, sheet_name='原始数据', engine='openpyxl')
+    except Exception:
+        # 兼容只有一个 sheet 的情况
+        df = pd.read_excel(excel_path, index_col=None, engine='openpyxl')
+    tasks = []
+    for url, rel_path in zip(df.get('路径URL', []), df.get('路径名', [])):
+        if pd.isna(url) or pd.isna(rel_path):
+            continue
+        # 去掉开头的 / 防止变为根目录
+        tasks.append(DownloadTask(str(url).strip(), os.path.join(save_root, str(rel_path).lstrip('/'))))
+    return tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="并发下载分析 Excel 中的图片")
+    parser.add_argument("--excel", required=True)
+    parser.add_argument("--output-dir", default="downloaded_images")
+    parser.add_argument("--per-host", type=int, default=8, help="每个域名的最大并发")
+    parser.add_argument("--max-connections", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--max-edge", type=int, default=None, help="下载后缩放到该长边（JPEG），默认保存原图")
+    parser.add_argument("--verify", action="store_true", help="续传时校验已存在文件的哈希")
+    args = parser.parse_args()
+
+    downloader = ImageDownloader(args.output_dir, per_host=args.per_host, max_connections=args.max_connections,
+                                 timeout=args.timeout, retries=args.retries, max_edge=args.max_edge,
+                                 verify=args.verify)
+    stats = downloader.download(tasks_from_excel(args.excel, args.output_dir))
+    print(f"[√] {stats.summary()}")
+    for error in stats.errors[:10]:
+        print(f"    ✗ {error['url']}: {error['error']}")
+
+
+if __name__ == "__main__":
+    main()
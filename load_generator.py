@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : load_generator.py
+# @Usage   : 开环/闭环压测 /process_image，按到达率施压并修正 coordinated omission
+"""
+Locust 的 ``wait_time = between(1, 1.5)`` 是闭环压测：服务变慢时用户发得也慢，排队雪崩被掩盖。
+本脚本默认开环施压：请求按预先生成的计划时间发出，不等待前一个请求返回。
+
+- 到达过程：``constant``（等间隔）或 ``poisson``（指数间隔），按 ``--stages`` 分阶段（如 ``5x30,10x30``，
+  即 5 QPS 30 秒、10 QPS 30 秒），或用 ``--ramp 2:40:8`` 从 2 QPS 线性爬到 40 QPS、共 8 档；
+- 闭环模式（``--mode closed``）：``--users`` 个虚拟用户，返回后思考 ``--think-ms`` 再发下一个，用于和 Locust 对照；
+- 图片按像素数分为 small（<1MP）/ medium（1~4MP）/ large（>4MP），按 ``--mix`` 比例从测试目录抽样；
+- 延迟修正：开环模式的延迟从**计划发送时间**算起。客户端并发上限（``--max-in-flight``）或事件循环卡顿
+  导致的晚发都计入延迟，不会因为"没发出去"而漏记（coordinated omission）；同时给出从实际发送算起的原始延迟。
+
+每个阶段输出计划 QPS、实际完成 QPS、失败率、修正/原始 p50/p95/p99/max，并给出满足
+``完成率 >= 95%、失败率 < 1%、修正 p99 <= --slo-ms`` 的最高阶段，即可持续 QPS。
+报告格式与 benchmark_suite 一致（``concurrency`` 字段为计划 QPS），可直接 ``bench_compare.py store``。
+
+运行示例：
+    python load_generator.py --url http://127.0.0.1:8081/process_image --image-folder ./无他图片标签测试图 --ramp 2:40:8 --stage-seconds 30
+    python load_generator.py --arrival constant --stages 10x60 --mix small:0.2,medium:0.6,large:0.2
+    python load_generator.py --mode closed --users 50 --think-ms 1000 --stages 0x60
+"""
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass, field
+
+DEFAULT_API_URL = "http://127.0.0.1:8081/process_image"
+SIZE_BUCKETS = (("small", 1_000_000), ("medium", 4_000_000), ("large", float("inf")))
+DEFAULT_MIX = {"small": 0.3, "medium": 0.5, "large": 0.2}
+
+
+@dataclass
+class Stage:
+    rate: float       # 计划 QPS（闭环模式下忽略）
+    duration: float   # 秒
+
+
+@dataclass
+class Sample:
+    stage: int
+    bucket: str
+    intended: float   # 计划发送时间（相对压测开始）
+    sent: float       # 实际发送时间
+    done: float
+    ok: bool
+    error: str = ""
+
+
+@dataclass
+class ImageMix:
+    """按像素数分桶的图片池，按比例抽样"""
+    buckets: dict = field(default_factory=dict)   # {bucket: [path, ...]}
+    weights: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_folder(cls, folder: str, weights: dict = None):
+        from PIL import Image
+        buckets = {name: [] for name, _ in SIZE_BUCKETS}
+        for root, _, files in os.walk(folder):
+            for file in sorted(files):
+                if not file.lower().endswith(('.png', '.jpg', '.jpeg')):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    with Image.open(path) as img:  # 只读文件头
+                        pixels = img.width * img.height
+                except Exception:
+                    continue
+                name = next(name for name, limit in SIZE_BUCKETS if pixels < limit)
+                buckets[name].append(path)
+        if not any(buckets.values()):
+            raise ValueError(f"图片文件夹{folder}中未找到有效图片")
+        # 没有图片的分桶不参与抽样，其余按比例归一
+        weights = {k: v for k, v in (weights or DEFAULT_MIX).items() if buckets.get(k)}
+        if not weights:
+            weights = {k: 1.0 for k, v in buckets.items() if v}
+        return cls({k: v for k, v in buckets.items() if v}, weights)
+
+    def sample(self, rng: random.Random):
+        bucket = rng.choices(list(self.weights), weights=list(self.weights.values()))[0]
+        return bucket, rng.choice(self.buckets[bucket])
+
+    def describe(self) -> dict:
+        return {k: {"images": len(v), "weight": self.weights.get(k, 0.0)} for k, v in self.buckets.items()}
+
+
+# ==========================================
+# 到达计划
+# ==========================================
+def parse_stages(spec: str) -> list:
+    """'5x30,10x30' -> [Stage(5, 30), Stage(10, 30)]"""
+    stages = []
+    for part in spec.split(","):
+        rate, duration = part.strip().split("x")
+        stages.append(Stage(float(rate), float(duration)))
+    return stages
+
+
+def ramp_stages(start: float, end: float, steps: int, stage_seconds: float) -> list:
+    if steps <= 1:
+        return [Stage(start, stage_seconds)]
+    return [Stage(round(start + (end - start) * i / (steps - 1), 2), stage_seconds) for i in range(steps)]
+
+
+def arrival_schedule(stages: list, arrival: str = "poisson", seed: int = 0) -> list:
+    """[(计划发送时间, 阶段下标)]，时间相对压测开始"""
+    rng = random.Random(seed)
+    schedule, offset = [], 0.0
+    for index, stage in enumerate(stages):
+        t = 0.0
+        while stage.rate > 0:
+            t += rng.expovariate(stage.rate) if arrival == "poisson" else 1.0 / stage.rate
+            if t >= stage.duration:
+                break
+            schedule.append((offset + t, index))
+        offset += stage.duration
+    return schedule
+
+
+# ==========================================
+# 发送
+# ==========================================
+class LoadGenerator:
+    def __init__(self, url: str, mix: ImageMix, priority: str = "interactive", timeout: float = 120,
+                 max_in_flight: int = 0, seed: int = 0):
+        self.url = url
+        self.mix = mix
+        self.priority = priority
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.rng = random.Random(seed)
+        self.samples = []
+
+    async def _send(self, client, semaphore, start: float, stage: int, intended: float):
+        bucket, path = self.mix.sample(self.rng)
+        if semaphore is not None:
+            await semaphore.acquire()
+        sent = time.perf_counter() - start
+        ok, error = False, ""
+        try:
+            response = await client.post(self.url, json={
+                "image_info": path, "task_id": uuid.uuid4().hex, "priority": self.priority,
+            })
+            if response.status_code != 200:
+                error = f"HTTP {response.status_code}"
+            else:
+                res = response.json().get("res") or {}
+                ok = res.get("status") == "success"
+                error = "" if ok else str(res.get("error", ""))[:100]
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e)[:100]}"
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+        self.samples.append(Sample(stage, bucket, intended, sent, time.perf_counter() - start, ok, error))
+
+    def _client(self):
+        import httpx
+        return httpx.AsyncClient(timeout=self.timeout, limits=httpx.Limits(max_connections=None))
+
+    async def run_open(self, schedule: list):
+        """按计划时间发出，不等待返回；发送端落后于计划时立刻补发，不跳过"""
+        semaphore = asyncio.Semaphore(self.max_in_flight) if self.max_in_flight > 0 else None
+        async with self._client() as client:
+            start = time.perf_counter()
+            tasks = []
+            for intended, stage in schedule:
+                delay = intended - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(self._send(client, semaphore, start, stage, intended)))
+            await asyncio.gather(*tasks)
+
+    async def run_closed(self, users: int, duration: float, think: float):
+        """闭环：每个用户收到响应后思考 think 秒再发，计划时间即实际发送时间（无法修正 CO）"""
+        async with self._client() as client:
+            start = time.perf_counter()
+
+            async def _user():
+                while time.perf_counter() - start < duration:
+                    now = time.perf_counter() - start
+                    await self._send(client, None, start, 0, now)
+                    if think > 0:
+                        await asyncio.sleep(think)
+            await asyncio.gather(*(_user() for _ in range(users)))
+
+
+# ==========================================
+# 统计
+# ==========================================
+def _percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))]
+
+
+def _latency_ms(values: list) -> dict:
+    values = sorted(values)
+    return {
+        "p50": round(_percentile(values, 0.50) * 1000, 1),
+        "p95": round(_percentile(values, 0.95) * 1000, 1),
+        "p99": round(_percentile(values, 0.99) * 1000, 1),
+        "max": round(values[-1] * 1000, 1) if values else 0.0,
+        "mean": round(sum(values) / len(values) * 1000, 1) if values else 0.0,
+    }
+
+
+def summarize_stage(scenario: str, stage: Stage, samples: list) -> dict:
+    ok = [s for s in samples if s.ok]
+    errors = len(samples) - len(ok)
+    # 完成 QPS 以该阶段第一个计划发送到最后一个完成为窗口
+    window = (max(s.done for s in samples) - min(s.intended for s in samples)) if samples else 0.0
+    by_bucket = {}
+    for s in ok:
+        by_bucket.setdefault(s.bucket, []).append(s.done - s.intended)
+    return {
+        "scenario": scenario,
+        "concurrency": stage.rate,    # 与 benchmark_suite 报告对齐：开环时为计划 QPS
+        "offered_qps": stage.rate,
+        # 泊松到达下实际发出的速率会偏离计划值，完成率以实际到达为准
+        "arrival_qps": round(len(samples) / stage.duration, 2) if stage.duration > 0 else 0.0,
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "qps": round(len(ok) / window, 2) if window > 0 else 0.0,
+        "wall_seconds": round(window, 3),
+        # 修正延迟（从计划时间算起）作为主指标，原始延迟（从实际发送算起）用于对照
+        "latency_ms": _latency_ms([s.done - s.intended for s in ok]),
+        "raw_latency_ms": _latency_ms([s.done - s.sent for s in ok]),
+        "send_lag_ms": _latency_ms([s.sent - s.intended for s in samples]),
+        "latency_by_size_ms": {k: _latency_ms(v) for k, v in sorted(by_bucket.items())},
+        "top_errors": sorted({s.error for s in samples if not s.ok})[:5],
+    }
+
+
+def sustainable_qps(results: list, slo_ms: float) -> float:
+    """满足完成率、失败率与 p99 SLO 的最高计划 QPS；都不满足时为 0"""
+    passing = [
+        r["offered_qps"] for r in results
+        if r["offered_qps"] > 0 and r["qps"] >= 0.95 * r["arrival_qps"]
+        and r["error_rate"] < 0.01 and r["latency_ms"]["p99"] <= slo_ms
+    ]
+    return max(passing) if passing else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="开环/闭环压测 /process_image")
+    parser.add_argument("--url", default=DEFAULT_API_URL)
+    parser.add_argument("--image-folder", required=True)
+    parser.add_argument("--mode", choices=["open", "closed"], default="open")
+    parser.add_argument("--arrival", choices=["poisson", "constant"], default="poisson")
+    parser.add_argument("--stages", default="5x30", help="开环阶段 '速率x秒'，逗号分隔；闭环时只取总时长")
+    parser.add_argument("--ramp", default=None, help="START:END:STEPS，线性爬坡，覆盖 --stages")
+    parser.add_argument("--stage-seconds", type=float, default=30, help="--ramp 每档时长")
+    parser.add_argument("--mix", default=",".join(f"{k}:{v}" for k, v in DEFAULT_MIX.items()))
+    parser.add_argument("--users", type=int, default=20, help="闭环模式用户数")
+    parser.add_argument("--think-ms", type=float, default=1000, help="闭环模式思考时间")
+    parser.add_argument("--max-in-flight", type=int, default=0, help="客户端在途上限，0 表示不限（推荐）")
+    parser.add_argument("--priority", choices=["interactive", "batch"], default="interactive")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--slo-ms", type=float, default=5000, help="可持续 QPS 判定用的修正 p99 上限")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="load_report.json")
+    args = parser.parse_args()
+
+    if args.ramp:
+        start, end, steps = args.ramp.split(":")
+        stages = ramp_stages(float(start), float(end), int(steps), args.stage_seconds)
+    else:
+        stages = parse_stages(args.stages)
+    weights = {k: float(v) for k, v in (part.split(":") for part in args.mix.split(","))}
+    mix = ImageMix.from_folder(args.image_folder, weights)
+    generator = LoadGenerator(args.url, mix, args.priority, args.timeout, args.max_in_flight, args.seed)
+    print(f"图片池：{mix.describe()}")
+
+    if args.mode == "open":
+        schedule = arrival_schedule(stages, args.arrival, args.seed)
+        print(f"开环压测：{len(stages)} 个阶段，共 {len(schedule)} 个请求，到达过程 {args.arrival}")
+        asyncio.run(generator.run_open(schedule))
+        results = [
+            summarize_stage(f"open_{args.arrival}", stage, [s for s in generator.samples if s.stage == i])
+            for i, stage in enumerate(stages)
+        ]
+    else:
+        duration = sum(stage.duration for stage in stages)
+        print(f"闭环压测：{args.users} 个用户，思考 {args.think_ms}ms，持续 {duration}s")
+        asyncio.run(generator.run_closed(args.users, duration, args.think_ms / 1000))
+        results = [summarize_stage("closed", Stage(0.0, duration), generator.samples)]
+        results[0]["concurrency"] = args.users
+
+    for r in results:
+        lat, raw = r["latency_ms"], r["raw_latency_ms"]
+        print(f"计划 {r['offered_qps']:>6} QPS | 完成 {r['qps']:>6} QPS | 失败率 {r['error_rate']:.2%} | "
+              f"修正 p50/p95/p99 {lat['p50']}/{lat['p95']}/{lat['p99']}ms | 原始 p99 {raw['p99']}ms")
+    best = sustainable_qps(results, args.slo_ms) if args.mode == "open" else None
+    if best is not None:
+        print(f"✅ 可持续 QPS（p99 <= {args.slo_ms}ms）：{best}" if best else "❌ 所有阶段都未满足 SLO")
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "url": args.url,
+            "mode": args.mode,
+            "arrival": args.arrival,
+            "stages": [stage.__dict__ for stage in stages],
+            "image_mix": mix.describe(),
+            "max_in_flight": args.max_in_flight,
+            "slo_ms": args.slo_ms,
+            "sustainable_qps": best,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"压测报告已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
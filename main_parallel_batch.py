@@ -13,6 +13,7 @@ from logger import get_logger
 import os
 import time
 import pandas as pd
+from adaptive_concurrency import AdaptiveLimiter
 
 
 # 构建日志记录器
@@ -580,8 +581,12 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import time
 
-def batch_image_tagging(image_paths: list[str], max_workers: int = 3) -> list[dict]:
-    """批量处理 - 7列Excel数据"""
+def batch_image_tagging(image_paths: list[str], max_workers: int = 3, adaptive: bool = False,
+                        max_limit: int = 32) -> list[dict]:
+    """
+    批量处理 - 7列Excel数据
+    adaptive=True 时以 max_workers 为初始并发，由 AIMD 限流器在 [1, max_limit] 内自动调节
+    """
     path_state_pairs = []
     for img_path in image_paths:
         try:
@@ -624,8 +629,13 @@ def batch_image_tagging(image_paths: list[str], max_workers: int = 3) -> list[di
             # path_state_pairs.append((img_path, None))
     
     results = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_path = {executor.submit(app.invoke, state): img_path for img_path, state in path_state_pairs}
+    limiter = AdaptiveLimiter(initial=max_workers, max_limit=max_limit) if adaptive else None
+    pool_size = max_limit if adaptive else max_workers
+    with ThreadPoolExecutor(max_workers=pool_size) as executor:
+        if limiter is not None:
+            future_to_path = {executor.submit(limiter.call, app.invoke, state): img_path for img_path, state in path_state_pairs}
+        else:
+            future_to_path = {executor.submit(app.invoke, state): img_path for img_path, state in path_state_pairs}
         # 用Future对象作为字典的key，对应的图片路径作为value
         for future in tqdm(as_completed(future_to_path), total=len(future_to_path), desc="处理图片"):
             img_path = future_to_path[future]
@@ -699,6 +709,8 @@ def batch_image_tagging(image_paths: list[str], max_workers: int = 3) -> list[di
                     "error": error_msg
                 })
                 logger.error(f"❌ 处理失败 {img_path}: {error_msg}")
+    if limiter is not None:
+        logger.info(limiter.summary())
     print(results)
     return results
 # def batch_image_tagging(image_paths: list[str], max_workers: int = 5) -> list[dict]:
@@ -992,7 +1004,7 @@ if __name__ == "__main__":
     print(f"📁 发现 {len(image_paths)} 张图片")
     
     # 批量处理 + 7列Excel
-    results = batch_image_tagging(image_paths, max_workers=2)
+    results = batch_image_tagging(image_paths, max_workers=2, adaptive=True)
     excel_file = save_results_to_excel(results, output_file="图片标签7列分析.xlsx")
     
     # print(f"✅ 7列Excel完成: {excel_file}")
\ No newline at end of file
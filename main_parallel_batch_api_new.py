@@ -5,6 +5,7 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import pandas as pd
 from typing import List, Dict
+from adaptive_concurrency import AdaptiveLimiter
 
 # --------------------------
 # 配置项
@@ -13,7 +14,9 @@ API_URL = "http://10.136.234.255:8080/process_image"
 API_URL = "http://10.136.234.255:8081/process_image"
 API_URL = "http://49.7.36.149:80/process_image_local"
 
-MAX_WORKERS = 1  # 线程池大小
+MAX_WORKERS = 1  # 线程池大小（固定并发；自适应模式下为初始并发）
+ADAPTIVE_CONCURRENCY = True  # 打开后由 AIMD 限流器自动寻找集群的吞吐拐点
+ADAPTIVE_MAX_WORKERS = 32  # 自适应模式的并发上限
 REQUEST_TIMEOUT = 300  # 请求超时时间（秒）
 dir_pre = "/Users/zhipeng/Win10/LocalOneDrive/Gitee/Multi_agent_image_tagging"
 dir_pre = "/workspace/work/zhipeng16/git/Multi_agent_image_tagging"
@@ -34,7 +37,8 @@ def call_image_api(img_path: str, API_URL = API_URL) -> Dict:
     task_id = str(uuid.uuid4())  # 生成唯一task_id
     request_data = {
         "image_info": img_path,
-        "task_id": task_id
+        "task_id": task_id,
+        "priority": "batch"  # 回刷流量，让出预留容量给线上用户请求
     }
     
     # 构造请求头
@@ -121,19 +125,27 @@ def batch_call_image_api_new(image_paths: List[str], API_URL = API_URL) -> List[
 
     return results
 
-def batch_call_image_api(image_paths: List[str]) -> List[Dict]:
+def batch_call_image_api(image_paths: List[str], adaptive: bool = ADAPTIVE_CONCURRENCY) -> List[Dict]:
     """
     批量调用图片标签接口，使用线程池并发处理
+    adaptive=True 时并发数由 AIMD 限流器按延迟 / 429 / 错误自动调节
     """
     results = []
+    limiter = AdaptiveLimiter(initial=MAX_WORKERS, max_limit=ADAPTIVE_MAX_WORKERS) if adaptive else None
     
     # 使用线程池并发执行
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    with ThreadPoolExecutor(max_workers=ADAPTIVE_MAX_WORKERS if adaptive else MAX_WORKERS) as executor:
         # 提交所有任务
-        future_to_img_path = {
-            executor.submit(call_image_api, img_path): img_path 
-            for img_path in image_paths
-        }
+        if limiter is not None:
+            future_to_img_path = {
+                executor.submit(limiter.call, call_image_api, img_path): img_path
+                for img_path in image_paths
+            }
+        else:
+            future_to_img_path = {
+                executor.submit(call_image_api, img_path): img_path 
+                for img_path in image_paths
+            }
         
         # 遍历完成的任务，获取结果
         for future in tqdm(as_completed(future_to_img_path), total=len(future_to_img_path), desc="批量调用接口"):
@@ -154,6 +166,8 @@ def batch_call_image_api(image_paths: List[str]) -> List[Dict]:
                 }
                 results.append(error_result)
     
+    if limiter is not None:
+        print(limiter.summary())
     return results
 
 # --------------------------
@@ -302,7 +316,7 @@ if __name__ == "__main__":
     
     # 2. 批量调用接口
     print("\n🚀 开始批量调用图片标签接口...")
-    batch_results = batch_call_image_api_new(image_paths, API_URL)
+    batch_results = batch_call_image_api(image_paths)
     
     # 3. 保存结果到Excel
     print("\n📝 开始保存结果到Excel...")
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : metrics.py
+# @Usage   : 打标服务的耗时/Token/排队埋点，导出 Prometheus 指标
+"""
+统一埋点层：
+
+- ``instrument_node(name)``：包装 LangGraph 节点，记录节点墙钟耗时与状态；
+- ``record_vlm_call(...)``：由 ``CallVLMModel.call_qwen_new`` 调用，记录单次 VLM 调用的
+  耗时、prompt/completion tokens、后端编号、重试次数与错误；
+- ``record_queue_wait(stage, seconds)``：记录请求在线程池 / 调度器中的排队时间；
+- ``record_result_cache(result)``：记录共享结果缓存的命中情况；
+- ``render_latest()``：生成 ``/metrics`` 接口的文本。
+
+prometheus_client 未安装时全部退化为空操作，不影响主流程。
+多 worker 部署时设置 ``PROMETHEUS_MULTIPROC_DIR``（gunicorn_conf.py 会自动设置），
+各进程把指标写入该目录，``/metrics`` 由任一 worker 汇总所有进程的数据后输出。
+"""
+import os
+import time
+import contextvars
+from functools import wraps
+
+try:
+    from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+    PROMETHEUS_AVAILABLE = True
+except ImportError:  # 可选依赖
+    PROMETHEUS_AVAILABLE = False
+    CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+# 当前正在执行的图节点名，供 call_qwen_new 给 VLM 指标打上 node 标签
+current_node = contextvars.ContextVar("current_node", default="unknown")
+
+# 秒级耗时分桶：覆盖 CPU 预处理(ms 级) 到慢速 VLM 调用(数十秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+class _NoopMetric:
+    """prometheus_client 缺失时的占位对象"""
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, *args, **kwargs):
+        pass
+
+    def inc(self, *args, **kwargs):
+        pass
+
+
+if PROMETHEUS_AVAILABLE:
+    REQUEST_LATENCY = Histogram(
+        "tagging_request_latency_seconds", "单张图片端到端耗时", ["status"], buckets=LATENCY_BUCKETS
+    )
+    QUEUE_WAIT = Histogram(
+        "tagging_queue_wait_seconds", "请求排队等待时间", ["stage"], buckets=LATENCY_BUCKETS
+    )
+    NODE_LATENCY = Histogram(
+        "tagging_node_latency_seconds", "LangGraph 节点耗时", ["node", "status"], buckets=LATENCY_BUCKETS
+    )
+    VLM_LATENCY = Histogram(
+        "tagging_vlm_call_latency_seconds", "单次 VLM 调用耗时", ["node", "backend", "status"], buckets=LATENCY_BUCKETS
+    )
+    VLM_PROMPT_TOKENS = Histogram(
+        "tagging_vlm_prompt_tokens", "单次调用 prompt tokens", ["node", "backend"], buckets=TOKEN_BUCKETS
+    )
+    VLM_COMPLETION_TOKENS = Histogram(
+        "tagging_vlm_completion_tokens", "单次调用 completion tokens", ["node", "backend"], buckets=TOKEN_BUCKETS
+    )
+    VLM_RETRIES = Counter(
+        "tagging_vlm_retries_total", "VLM 调用重试次数", ["node", "backend"]
+    )
+    VLM_ERRORS = Counter(
+        "tagging_vlm_errors_total", "VLM 调用失败次数", ["node", "backend", "error_type"]
+    )
+    VLM_HEDGES = Counter(
+        "tagging_vlm_hedged_total", "发出的对冲请求数", ["node", "backend"]
+    )
+    RESULT_CACHE = Counter(
+        "tagging_result_cache_total", "共享结果缓存查询次数", ["result"]
+    )
+else:
+    REQUEST_LATENCY = QUEUE_WAIT = NODE_LATENCY = _NoopMetric()
+    VLM_LATENCY = VLM_PROMPT_TOKENS = VLM_COMPLETION_TOKENS = _NoopMetric()
+    VLM_RETRIES = VLM_ERRORS = VLM_HEDGES = RESULT_CACHE = _NoopMetric()
+
+
+def instrument_node(name: str):
+    """装饰器：记录图节点耗时（status 为 ok / skipped / error），并把节点名放进 contextvar 供下游 VLM 调用使用"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(state, *args, **kwargs):
+            token = current_node.set(name)
+            start = time.perf_counter()
+            status = "ok"
+            try:
+                result = func(state, *args, **kwargs)
+                # 门控未命中（返回 None）或预算不足跳过的节点没有真正执行，单独记为 skipped，
+                # 不把近 0 的耗时混进 ok 的分布
+                if result is None or (isinstance(result, dict) and result.get("skipped_nodes")):
+                    status = "skipped"
+                return result
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                NODE_LATENCY.labels(node=name, status=status).observe(time.perf_counter() - start)
+                current_node.reset(token)
+        return wrapper
+    return decorator
+
+
+def record_vlm_call(backend, latency: float, prompt_tokens: int = 0, completion_tokens: int = 0,
+                    retries: int = 0, error: Exception = None):
+    """记录一次 VLM 调用（含重试后的最终结果）"""
+    node = current_node.get()
+    backend = str(backend)
+    status = "error" if error is not None else "ok"
+    VLM_LATENCY.labels(node=node, backend=backend, status=status).observe(latency)
+    if retries:
+        VLM_RETRIES.labels(node=node, backend=backend).inc(retries)
+    if error is not None:
+        VLM_ERRORS.labels(node=node, backend=backend, error_type=type(error).__name__).inc()
+        return
+    VLM_PROMPT_TOKENS.labels(node=node, backend=backend).observe(prompt_tokens)
+    VLM_COMPLETION_TOKENS.labels(node=node, backend=backend).observe(completion_tokens)
+
+
+def record_hedge(backend):
+    """记录一次发往 backend 的对冲请求"""
+    VLM_HEDGES.labels(node=current_node.get(), backend=str(backend)).inc()
+
+
+def record_queue_wait(stage: str, seconds: float):
+    QUEUE_WAIT.labels(stage=stage).observe(max(seconds, 0.0))
+
+
+def record_request(latency: float, status: str):
+    REQUEST_LATENCY.labels(status=status).observe(latency)
+
+
+def record_result_cache(result: str):
+    """result: hit / miss / store"""
+    RESULT_CACHE.labels(result=result).inc()
+
+
+def render_latest() -> bytes:
+    """/metrics 接口输出；多进程模式下汇总所有 worker 的指标"""
+    if not PROMETHEUS_AVAILABLE:
+        return b"# prometheus_client not installed\n"
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import CollectorRegistry, multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
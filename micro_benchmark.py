@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : micro_benchmark.py
+# @Usage   : 单请求 CPU 侧热路径的微基准：预处理、解析、格式化、LangGraph 调度，带历史记录与回退检查
+"""
+高 QPS 下单个 API worker 的上限取决于 Python 侧开销，而不是推理。本脚本逐段计时：
+
+- ``preprocess.*``：``encode_image_resized`` / ``encode_image_variants``（大图、常见手机图），纯 base64 编码；
+- ``schema.*``：``model_json_schema()`` 现场生成 vs 注册表取回；
+- ``parse.*``：``parse_model_json``（纯 JSON / 带 markdown 围栏）；
+- ``format.*``：``format_output`` 与 ``is_tag_legal``；
+- ``graph.superstep``：完整 LangGraph 一次执行，VLM 调用替换为即时返回的桩，只剩调度与 reducer 开销。
+
+每段用 ``timeit`` 自动确定循环次数、重复 ``--repeat`` 次，取中位数（微秒/次）。
+结果追加到 ``--history``（默认 micro_benchmark_history.json），与最近 ``--baseline-runs`` 次的中位数比较，
+任一阶段变慢超过 ``--threshold``（默认 20%）时退出码为 1，可直接挂在 CI 上。
+
+运行示例：
+    python micro_benchmark.py
+    python micro_benchmark.py --stages parse,format --threshold 0.1 --no-record
+"""
+import os
+import sys
+import json
+import time
+import base64
+import timeit
+import argparse
+import platform
+import tempfile
+import statistics
+from unittest import mock
+
+from loguru import logger as _loguru
+
+DEFAULT_HISTORY = "micro_benchmark_history.json"
+# 计时期间关闭这些模块的日志，避免控制台 IO 抖动淹没被测开销
+QUIET_MODULES = ("node_registry", "tag_format", "image_uds_local_new", "schema_registry", "utils", "metrics", "tracing")
+
+
+# ==========================================
+# 测试数据
+# ==========================================
+def _make_jpeg(folder: str, width: int, height: int) -> str:
+    from PIL import Image, ImageDraw
+    path = os.path.join(folder, f"micro_{width}x{height}.jpg")
+    image = Image.new("RGB", (width, height), (90, 140, 200))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, width, max(width // 16, 1)):
+        draw.rectangle([i, 0, i + width // 32, height], fill=((i * 7) % 256, (i * 3) % 256, 120))
+    image.save(path, quality=90)
+    return path
+
+
+class Fixtures:
+    """所有阶段共用的代表性输入，构造一次"""
+    def __init__(self, folder: str):
+        from node_registry import NODE_SPECS
+        from schema_registry import schema_stub_output
+        from tagging_state import new_state
+        self.large_image = _make_jpeg(folder, 3000, 4000)
+        self.phone_image = _make_jpeg(folder, 1080, 1440)
+        with open(self.phone_image, "rb") as f:
+            self.jpeg_bytes = f.read()
+        # 每个节点一份合法输出；人像 + 场景都会命中，format_output 走最长路径
+        self.contents = {}
+        for spec in NODE_SPECS:
+            data = schema_stub_output(spec.schema_json, spec.name)
+            if spec.output_key == "first_level":
+                data["主体"] = ["人像", "动物（宠物）", "风景", "食物"]
+            self.contents[spec.name] = json.dumps(data, ensure_ascii=False)
+        self.fenced = {name: f"```json\n{content}\n```" for name, content in self.contents.items()}
+        self.state = new_state("data:image/jpeg;base64,")
+        self.state["node_results"] = {spec.output_key: json.loads(self.contents[spec.name]) for spec in NODE_SPECS}
+
+
+# ==========================================
+# 各阶段
+# ==========================================
+def build_stages(fx: Fixtures) -> dict:
+    """{阶段名: 无参可调用对象}；import 放在这里，只计被测函数本身"""
+    from utils import encode_image_resized, encode_image_variants
+    from node_registry import NODE_SPECS, MAX_EDGES, parse_model_json
+    from schema_registry import register_schema
+    from tag_format import format_output, is_tag_legal
+
+    tags = format_output(fx.state)["final_labels"] + ["人像-不存在-标签", "主体-未知"]
+
+    def parse_all(contents):
+        return lambda: [parse_model_json(c) for c in contents.values()]
+
+    return {
+        "preprocess.encode_resized_large": lambda: encode_image_resized(fx.large_image, 768),
+        "preprocess.encode_resized_phone": lambda: encode_image_resized(fx.phone_image, 768),
+        "preprocess.encode_variants_large": lambda: encode_image_variants(fx.large_image, MAX_EDGES),
+        "preprocess.base64": lambda: base64.b64encode(fx.jpeg_bytes).decode("utf-8"),
+        "schema.model_json_schema": lambda: [spec.schema.model_json_schema() for spec in NODE_SPECS],
+        "schema.registry_lookup": lambda: [register_schema(spec.schema) for spec in NODE_SPECS],
+        "parse.plain": parse_all(fx.contents),
+        "parse.fenced": parse_all(fx.fenced),
+        # format_output 的"有路人"修正是幂等的，重复调用同一个 state 不影响结果
+        "format.format_output": lambda: format_output(fx.state),
+        "format.is_tag_legal": lambda: [is_tag_legal(tag) for tag in tags],
+        "graph.superstep": _graph_stage(fx),
+    }
+
+
+def _graph_stage(fx: Fixtures):
+    """完整图执行一次；VLM 调用替换为按节点返回固定内容的桩"""
+    os.environ.setdefault("WARMUP_ON_STARTUP", "0")
+    import image_uds_local_new as service
+    from node_registry import NODE_SPECS
+    by_prompt = {spec.prompt: fx.contents[spec.name] for spec in NODE_SPECS}
+
+    def fake_call(image_info, prompt, *args, **kwargs):
+        return {"content": by_prompt[prompt], "prompt_tokens": 0, "completion_tokens": 0}
+
+    from tagging_state import new_state
+    # 基准进程内整体替换，不把 patch 本身的开销计入每次调用
+    mock.patch.object(service.model, "call_qwen_new", fake_call).start()
+    return lambda: service.app.invoke(new_state(fx.state["image_info"]))
+
+
+def time_stage(fn, repeat: int, min_time: float) -> dict:
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    samples = [t / number * 1e6 for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "median_us": round(statistics.median(samples), 2),
+        "min_us": round(min(samples), 2),
+        "stdev_us": round(statistics.stdev(samples), 2) if len(samples) > 1 else 0.0,
+        "loops": number,
+    }
+
+
+# ==========================================
+# 历史记录与回退检查
+# ==========================================
+def load_history(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def baseline_from_history(history: list, runs: int) -> dict:
+    """最近 runs 次记录中每个阶段中位数的中位数，单次抖动不会成为基线"""
+    per_stage = {}
+    for run in history[-runs:]:
+        for stage, result in run["results"].items():
+            per_stage.setdefault(stage, []).append(result["median_us"])
+    return {stage: statistics.median(values) for stage, values in per_stage.items()}
+
+
+def check_regressions(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for stage, result in results.items():
+        base = baseline.get(stage)
+        if base and result["median_us"] > base * (1 + threshold):
+            regressions.append((stage, base, result["median_us"]))
+    return regressions
+
+
+def _git_revision() -> str:
+    try:
+        import subprocess
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU 侧热路径微基准")
+    parser.add_argument("--stages", default="", help="逗号分隔的阶段名前缀，如 parse,format；默认全部")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--min-time", type=float, default=0.2, help="每次重复的最短计时（秒）")
+    parser.add_argument("--history", default=DEFAULT_HISTORY)
+    parser.add_argument("--baseline-runs", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.2, help="相对基线变慢超过该比例视为回退")
+    parser.add_argument("--no-record", action="store_true", help="只比较，不写入历史")
+    parser.add_argument("--with-logging", action="store_true", help="计时时保留节点日志")
+    args = parser.parse_args()
+
+    if not args.with_logging:
+        for module in QUIET_MODULES:
+            _loguru.disable(module)
+
+    prefixes = [p.strip() for p in args.stages.split(",") if p.strip()]
+    with tempfile.TemporaryDirectory(prefix="micro_bench_") as tmp:
+        stages = build_stages(Fixtures(tmp))
+        results = {}
+        for name, fn in stages.items():
+            if prefixes and not any(name.startswith(p) for p in prefixes):
+                continue
+            fn()  # 预热：首次 import / 编译 / 缓存
+            results[name] = time_stage(fn, args.repeat, args.min_time)
+            print(f"{name:<36} {results[name]['median_us']:>12.2f} us  (min {results[name]['min_us']:.2f}, "
+                  f"loops {results[name]['loops']})", flush=True)
+
+    history = load_history(args.history)
+    baseline = baseline_from_history(history, args.baseline_runs)
+    regressions = check_regressions(results, baseline, args.threshold)
+    baseline_count = min(len(history), args.baseline_runs)
+
+    if not args.no_record:
+        history.append({
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "git_revision": _git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "results": results,
+        })
+        with open(args.history, "w", encoding="utf-8") as f:
+            json.dump(history, f, ensure_ascii=False, indent=2)
+
+    if regressions:
+        for stage, base, current in regressions:
+            print(f"❌ {stage} 回退：基线 {base:.2f}us -> 当前 {current:.2f}us（+{(current / base - 1) * 100:.1f}%）")
+        sys.exit(1)
+    print(f"✅ 无超过 {args.threshold * 100:.0f}% 的回退（基线 {baseline_count} 次记录）"
+          if baseline else "✅ 首次运行，已记录为基线")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : mock_vllm_server.py
+# @Usage   : 本地 mock 的 OpenAI 兼容 vLLM 服务，用于 CPU 环境下的端到端压测
+"""
+模拟 vLLM 的 ``/v1/models`` 与 ``/v1/chat/completions``：
+
+- 延迟模型：``base_ms`` + 图片 token 数 × ``prefill_ms_per_1k`` / 1000 + 输出 token 数 × ``per_token_ms``，
+  图片 token 数按 Qwen-VL 的 28×28 patch 由图片分辨率估算，再叠加 ±``jitter`` 的随机抖动；
+- ``max_concurrency`` > 0 时模拟 GPU 批处理槽位，超出的请求排队；
+- guided JSON：按请求里的 ``response_format.json_schema`` 生成合法输出（与 schemas.py 一致）；
+- 错误注入：``error_rate`` 返回 500，``rate_limit_rate`` 返回 429，``slow_rate`` 额外延迟 ``slow_ms``。
+
+运行：
+    python mock_vllm_server.py --port 8000 --per-token-ms 5 --error-rate 0.01
+运行中可 ``POST /mock/config`` 修改参数，``GET /mock/stats`` 查看请求统计。
+"""
+import io
+import re
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import threading
+from dataclasses import dataclass, asdict, fields
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from schema_registry import schema_stub_output
+
+MOCK_MODEL_NAME = "mock-qwen-vl"
+
+
+@dataclass
+class MockConfig:
+    base_ms: float = 5.0             # 固定开销（调度、网络）
+    prefill_ms_per_1k: float = 20.0  # 每千个 prompt token 的 prefill 耗时
+    per_token_ms: float = 5.0        # 每个输出 token 的 decode 耗时
+    jitter: float = 0.1              # 延迟的相对随机抖动
+    max_concurrency: int = 0         # 模拟的并发槽位，0 表示不限
+    error_rate: float = 0.0          # 返回 500 的比例
+    rate_limit_rate: float = 0.0     # 返回 429 的比例
+    slow_rate: float = 0.0           # 慢请求比例（模拟长尾）
+    slow_ms: float = 2000.0          # 慢请求的额外延迟
+    seed: int = None                 # 固定随机种子，便于复现
+
+    def update(self, values: dict):
+        names = {f.name for f in fields(self)}
+        for key, value in values.items():
+            if key in names:
+                setattr(self, key, value)
+
+
+_DATA_URI = re.compile(r"^data:image/[\w.+-]+;base64,")
+
+
+def estimate_image_tokens(url: str) -> int:
+    """按 Qwen-VL 的 28x28 patch 估算视觉 token 数；URL 图片按 768px 方图估算"""
+    if not url.startswith("data:"):
+        return (768 // 28) ** 2
+    try:
+        from PIL import Image
+        raw = base64.b64decode(_DATA_URI.sub("", url, count=1))
+        width, height = Image.open(io.BytesIO(raw)).size
+        return max(1, (width // 28) * (height // 28))
+    except Exception:
+        return 256
+
+
+def _prompt_tokens(messages: list) -> int:
+    tokens = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                tokens += estimate_image_tokens(part["image_url"]["url"])
+            elif part.get("type") == "text":
+                tokens += len(part.get("text", ""))  # 中文约一字一 token
+    return tokens
+
+
+def create_mock_app(config: MockConfig = None) -> FastAPI:
+    config = config or MockConfig()
+    app = FastAPI(title="mock vLLM")
+    rng = random.Random(config.seed)
+    stats = {"requests": 0, "errors": 0, "rate_limited": 0, "in_flight": 0, "peak_in_flight": 0,
+             "prompt_tokens": 0, "completion_tokens": 0}
+    slots = {"semaphore": None, "size": None}
+
+    def _semaphore():
+        # 并发槽位随配置变化重建
+        if config.max_concurrency <= 0:
+            return None
+        if slots["size"] != config.max_concurrency:
+            slots["semaphore"] = asyncio.Semaphore(config.max_concurrency)
+            slots["size"] = config.max_concurrency
+        return slots["semaphore"]
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": MOCK_MODEL_NAME, "object": "model"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        draw = rng.random()
+        if draw < config.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return JSONResponse(status_code=429, content={"error": {"message": "mock rate limit"}})
+        if draw < config.rate_limit_rate + config.error_rate:
+            stats["errors"] += 1
+            return JSONResponse(status_code=500, content={"error": {"message": "mock internal error"}})
+
+        schema = ((body.get("response_format") or {}).get("json_schema") or {}).get("schema")
+        messages = body.get("messages", [])
+        seed = json.dumps(messages, ensure_ascii=False)
+        content = json.dumps(schema_stub_output(schema, seed) if schema else {"answer": "mock"}, ensure_ascii=False)
+        prompt_tokens = _prompt_tokens(messages)
+        completion_tokens = min(len(content), int(body.get("max_tokens") or 512))
+        content = content[:completion_tokens]
+
+        latency_ms = config.base_ms + prompt_tokens * config.prefill_ms_per_1k / 1000 + completion_tokens * config.per_token_ms
+        latency_ms *= 1 + rng.uniform(-config.jitter, config.jitter)
+        if rng.random() < config.slow_rate:
+            latency_ms += config.slow_ms
+
+        semaphore = _semaphore()
+        if semaphore is not None:
+            await semaphore.acquire()
+        stats["in_flight"] += 1
+        stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(latency_ms / 1000)
+        finally:
+            stats["in_flight"] -= 1
+            if semaphore is not None:
+                semaphore.release()
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+
+        return {
+            "id": f"chatcmpl-mock-{stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", MOCK_MODEL_NAME),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    @app.post("/mock/config")
+    async def update_config(values: dict):
+        config.update(values)
+        return asdict(config)
+
+    @app.get("/mock/stats")
+    async def get_stats():
+        return {**stats, "config": asdict(config)}
+
+    app.state.mock_config = config
+    app.state.mock_stats = stats
+    return app
+
+
+class BackgroundServer:
+    """在后台线程里运行 uvicorn，供压测脚本启动 mock 后端 / 被测服务"""
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 8000):
+        import uvicorn
+        self.app = app
+        self.url = f"http://{host}:{port}"
+        self._server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if time.monotonic() > deadline or not self._thread.is_alive():
+                raise RuntimeError(f"{self.url} 启动失败")
+            time.sleep(0.02)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mock OpenAI 兼容 vLLM 服务")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    for f in fields(MockConfig):
+        if f.name != "seed":
+            parser.add_argument(f"--{f.name.replace('_', '-')}", type=type(f.default), default=f.default)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    config = MockConfig(**{f.name: getattr(args, f.name) for f in fields(MockConfig)})
+
+    import uvicorn
+    uvicorn.run(create_mock_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,148 @@
 import os
 import sys
+import asyncio
+import threading
 from pathlib import Path
 from openai import OpenAI
 from dotenv import load_dotenv
 import random
-parent_dir = "/workspace/work/zhipeng16/git/yolo8-plus-iopaint"
-sys.path.append(parent_dir)
-from util.token_util_new import token_fresh
-
-# 路径配置和导入语句之后添加
-try:
-    # 实例化 token_fresh 验证导入成功
-    tf = token_fresh()
-    print("导入 token_fresh 成功！")
-except Exception as e:
-    print(f"导入失败：{e}")
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metrics import record_vlm_call, record_hedge, current_node
+from tracing import start_span
+from resilience import (ResiliencePolicy, LatencyTracker, DeadlineExceeded, EmptyCompletionError,
+                        AttemptTimeout, is_retriable)
+from scheduler import PriorityScheduler, INTERACTIVE
+from contextlib import nullcontext
 
 
 # 加载API Key
 load_dotenv()
 
+# 本地 vLLM 后端，可用 VLM_BACKENDS=url1,url2 覆盖；下标即 service_index
+DEFAULT_VLM_BACKENDS = "http://10.136.234.255:8000/v1,http://10.136.234.255:8001/v1"
+# 模型名查询失败时的兜底
+DEFAULT_LOCAL_MODEL_NAME = "/workspace/work/zhipeng16/git/Multi_agent_image_tagging/model/Qwen/Qwen3-VL-4B-Instruct"
+# Doubao 依赖外部仓库里的 token_fresh，只有真正调用 Doubao 时才去导入
+DEFAULT_TOKEN_UTIL_DIR = "/workspace/work/zhipeng16/git/yolo8-plus-iopaint"
+
+
+# 打标任务的采样参数，HTTP 调用与离线引擎共用
+TAGGING_TEMPERATURE = 0.1  # 打标任务建议低温
+TAGGING_TOP_P = 0.95       # 增加一点点确定性
+
+
+def build_vlm_messages(image_content: str, prompt: str) -> list:
+    """构造 OpenAI 格式的单轮图文消息（vLLM 的 HTTP 接口和 LLM.chat 都接受）"""
+    # 处理图片格式 (关键修正)
+    # vLLM/Qwen 对 base64 的要求：必须包含 "data:image/jpeg;base64," 前缀
+    content_stripped = image_content.strip()
+    if content_stripped.lower().startswith(("http://", "https://")):
+        image_url_value = content_stripped
+    elif not content_stripped.startswith("data:"):
+        # 自动补全 base64 前缀，默认假设是 jpeg，通常模型能自适应
+        image_url_value = f"data:image/jpeg;base64,{content_stripped}"
+    else:
+        image_url_value = content_stripped
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url_value
+                    }
+                },
+                {"type": "text", "text": prompt},
+            ],
+        }
+    ]
+
+
+def _load_token_fresh():
+    """按需导入外部 token_fresh（DOUBAO_TOKEN_UTIL_DIR 指定所在仓库）"""
+    parent_dir = os.getenv("DOUBAO_TOKEN_UTIL_DIR", DEFAULT_TOKEN_UTIL_DIR)
+    if parent_dir not in sys.path:
+        sys.path.append(parent_dir)
+    from util.token_util_new import token_fresh
+    tf = token_fresh()
+    print("导入 token_fresh 成功！")
+    return tf
+
 
 class CallVLMModel:
     """视觉语言模型调用，仅保留必要参数"""
     def __init__(self):
-        # 初始化各模型的客户端
-        self.qwen_client = OpenAI(
-            api_key='sk-2421657025644998a802f1a0c29e4ec5',
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-        )
-        self.qwen_local_client0 = OpenAI(
-            api_key="dummy_key",
-            base_url="http://10.136.234.255:8000/v1",
-        )
-        self.qwen_local_client1 = OpenAI(
-            api_key="dummy_key",
-            base_url="http://10.136.234.255:8001/v1",
-        )
-        self.doubao_token_helper = token_fresh()
+        # 本地 vLLM 客户端只是构造对象，不发网络请求
+        backend_urls = [u.strip() for u in os.getenv("VLM_BACKENDS", DEFAULT_VLM_BACKENDS).split(",") if u.strip()]
+        # SDK 内置重试关闭（max_retries=0），统一由 ResiliencePolicy 控制重试与对冲
+        self.local_clients = [OpenAI(api_key="dummy_key", base_url=url, max_retries=0) for url in backend_urls]
+        self.qwen_local_client0 = self.local_clients[0]
+        self.qwen_local_client1 = self.local_clients[min(1, len(self.local_clients) - 1)]
+        # 每个后端各自加载的模型名，由 startup() 发现；不假设所有后端模型一致
+        self.backend_models = [None] * len(self.local_clients)
+        # 是否真正从后端查到了模型名（失败时 backend_models 里是兜底名，由服务启动流程在后台重试）
+        self.discovered = [False] * len(self.local_clients)
+        self._discover_lock = threading.Lock()
+        self.policy = ResiliencePolicy.from_env()
+        self.latency_tracker = LatencyTracker()
+        # 所有本地后端共享的并发槽位，交互请求优先；VLM_MAX_CONCURRENCY<=0 时为 None（不限流）
+        self.scheduler = PriorityScheduler.from_env()
+        # 对冲模式下发请求的线程池，首次对冲时按调度容量创建
+        self._hedge_executor = None
+        self._hedge_executor_lock = threading.Lock()
+        # 可选的云端 provider，首次使用时才初始化
+        self._qwen_client = None
+        self._doubao_token_helper = None
+
+    @property
+    def qwen_client(self):
+        """DashScope 客户端（DASHSCOPE_API_KEY），首次使用时创建"""
+        if self._qwen_client is None:
+            self._qwen_client = OpenAI(
+                api_key=os.getenv("DASHSCOPE_API_KEY", "sk-2421657025644998a802f1a0c29e4ec5"),
+                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
+            )
+        return self._qwen_client
+
+    @property
+    def doubao_token_helper(self):
+        """Doubao 调用辅助对象，首次使用时才导入外部 token_fresh"""
+        if self._doubao_token_helper is None:
+            self._doubao_token_helper = _load_token_fresh()
+        return self._doubao_token_helper
+
+    # ==========================================
+    # 启动阶段：逐个后端发现模型名
+    # ==========================================
+    def discover_backend_model(self, backend_index: int) -> str:
+        """调用 /v1/models 获取该后端加载的模型（vLLM 通常只加载一个，取第一个）"""
+        try:
+            model_list = self.local_clients[backend_index].models.list()
+            model_name = model_list.data[0].id
+            self.discovered[backend_index] = True
+            print(f"✅ 后端 {backend_index} 自动检测到模型名称: {model_name}")
+        except Exception as e:
+            print(f"⚠️ 后端 {backend_index} 无法自动获取模型名，使用默认硬编码路径。错误: {e}")
+            model_name = DEFAULT_LOCAL_MODEL_NAME
+        self.backend_models[backend_index] = model_name
+        return model_name
+
+    async def startup(self) -> list:
+        """并发发现尚未成功发现的后端的模型名，返回本次新发现的后端下标；服务启动时调用，失败的后端可再次调用重试"""
+        pending = [idx for idx, ok in enumerate(self.discovered) if not ok]
+        await asyncio.gather(*(asyncio.to_thread(self.discover_backend_model, idx) for idx in pending))
+        return [idx for idx in pending if self.discovered[idx]]
+
+    def _backend_model(self, backend_index: int) -> str:
+        model_name = self.backend_models[backend_index]
+        if model_name is None:
+            # 未经 startup()（例如脚本里直接调用）时按后端懒加载，加锁避免并发重复查询
+            with self._discover_lock:
+                model_name = self.backend_models[backend_index] or self.discover_backend_model(backend_index)
+        return model_name
 
     # 自动判断图片类型，动态构建image_url的url值
     def is_http_https_url(self, s: str) -> bool:
@@ -158,84 +263,23 @@ class CallVLMModel:
         }
 
 
-    def call_qwen_new(self, image_content: str, prompt: str, schema: dict = None, service_index: int = None) -> dict:
-        """
-        封装 Qwen3-VL-4B-Instruct 调用
-        Args:
-            image_content: 图片路径或Base64或URL
-            prompt: 提示词
-            schema: (可选) Pydantic生成的JSON Schema，用于强制结构化输出
-            service_index: (可选) 指定服务节点索引，None 则随机
-        """
-        
-        # 1. 选择客户端 (修复 bug: if service_index 会误判 0 为 False)
-        service_index_list = [self.qwen_local_client0, self.qwen_local_client1]
-        if service_index is not None and 0 <= service_index < len(service_index_list):
-            client = service_index_list[service_index]
-        else:
-            client = random.choice(service_index_list)
-
-        # 2. 处理图片格式 (关键修正)
-        # vLLM/Qwen 对 base64 的要求：必须包含 "data:image/jpeg;base64," 前缀
-        if self.is_http_https_url(image_content):
-            image_url_value = image_content.strip()
-        else:
-            content_stripped = image_content.strip()
-            # 自动补全 base64 前缀
-            if not content_stripped.startswith("data:"):
-                # 默认假设是 jpeg，如果是 png 可以改，但通常模型能自适应
-                image_url_value = f"data:image/jpeg;base64,{content_stripped}"
-            else:
-                image_url_value = content_stripped
-
-        # 3. 构造请求参数
-        # 注意：不要硬编码模型路径，建议从 client 或 self.model_name 获取
-        # 这里假设你 self 里存了模型名，或者你确认两个端口模型一致
-        if not hasattr(self, "current_model_name") or self.current_model_name is None:
-            try:
-                # 调用 /v1/models 接口
-                model_list = client.models.list()
-                # vLLM 通常只加载一个模型，取第一个即可
-                # data[0].id 通常就是启动参数里的路径 "/workspace/.../Qwen3-VL-4B-Instruct"
-                self.current_model_name = model_list.data[0].id
-                print(f"✅ 自动检测到模型名称: {self.current_model_name}")
-            except Exception as e:
-                print(f"⚠️ 无法自动获取模型名，使用默认硬编码路径。错误: {e}")
-                # 兜底：如果查询失败，回退到硬编码
-                self.current_model_name = "/workspace/work/zhipeng16/git/Multi_agent_image_tagging/model/Qwen/Qwen3-VL-4B-Instruct"
-        
-        model_name = self.current_model_name
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": image_url_value
-                        }
-                    },
-                    {"type": "text", "text": prompt},
-                ],
-            }
-        ]
-
+    def build_request_kwargs(self, image_content: str, prompt: str, schema: dict = None, max_tokens: int = 512,
+                             temperature: float = None, model_name: str = None) -> dict:
+        """chat.completions.create 的参数（不含 model 时由 _single_attempt 按后端填入）"""
+        # 图片格式处理见 build_vlm_messages
         request_kwargs = {
-            "model": model_name,
-            "messages": messages,
-            "temperature": 0.1,  # 打标任务建议低温
-            "max_tokens": 512,  # Qwen3 上下文更长，可以给多点防止截断
-            "top_p": 0.95        # 增加一点点确定性
+            "messages": build_vlm_messages(image_content, prompt),
+            "temperature": TAGGING_TEMPERATURE if temperature is None else temperature,
+            "max_tokens": max_tokens,  # Qwen3 上下文更长，默认 512 防止截断
+            "top_p": TAGGING_TOP_P
         }
+        if model_name:
+            request_kwargs["model"] = model_name
 
-        # 4. 结构化输出 (JSON Schema)
+        # 结构化输出 (JSON Schema)
         # 你的写法是 OpenAI 格式，vLLM >= 0.6.0 完美支持
         # 但 Qwen3 有时对 `strict: True` 敏感，如果报错可以尝试去掉 strict
         if schema is not None:
-            # request_kwargs["extra_body"] = {
-            #      "guided_json": schema
-            # }
-            # 💡 备选方案：如果上面的 extra_body 不工作，再切回下面的 response_format
             request_kwargs["response_format"] = {
                 "type": "json_schema",
                 "json_schema": {
@@ -244,14 +288,63 @@ class CallVLMModel:
                     "strict": True # 如果报错，改为 False
                 }
             }
+        return request_kwargs
 
-        # 5. 发起调用
+    def warmup_attempt(self, service_index: int, image_content: str, schema: dict = None, max_tokens: int = 8):
+        """
+        预热用：直接向指定后端发一次请求，不走对冲/重试（首次 grammar 编译正是要在这个后端上完成），
+        不占调度槽位，也不计入延迟统计；失败时抛出异常
+        """
+        request_kwargs = self.build_request_kwargs(image_content, "warmup", schema=schema, max_tokens=max_tokens)
+        return self._single_attempt(service_index, request_kwargs, self.policy.timeout)
+
+    def call_qwen_new(self, image_content: str, prompt: str, schema: dict = None, service_index: int = None,
+                      max_tokens: int = 512, deadline: float = None, priority: str = INTERACTIVE,
+                      temperature: float = None, model_name: str = None) -> dict:
+        """
+        封装 Qwen3-VL-4B-Instruct 调用
+        Args:
+            image_content: 图片路径或Base64或URL
+            prompt: 提示词
+            schema: (可选) Pydantic生成的JSON Schema，用于强制结构化输出
+            service_index: (可选) 指定服务节点索引，None 则随机
+            max_tokens: (可选) 最大生成 token 数，预热请求可以给很小的值
+            deadline: (可选) 请求截止时间（time.monotonic()），每次尝试的超时不会超过剩余预算
+            priority: (可选) interactive / batch，决定在调度器中的排队优先级
+            temperature: (可选) 覆盖默认的 TAGGING_TEMPERATURE，配置扫描时使用
+            model_name: (可选) 指定模型名（后端以 --served-model-name 加载多个模型时），None 则用后端发现的模型
+        """
+        
+        # 1. 选择主后端 (修复 bug: if service_index 会误判 0 为 False)
+        n_backends = len(self.local_clients)
+        if service_index is not None and 0 <= service_index < n_backends:
+            backend_index = service_index
+        else:
+            backend_index = random.randrange(n_backends)
+
+        # 2~4. 构造请求参数（含结构化输出），模型名按后端区分，在发起调用时填入
+        request_kwargs = self.build_request_kwargs(image_content, prompt, schema, max_tokens, temperature, model_name)
+
+        # 5. 发起调用：超时受剩余预算约束，可重试错误有限次重试并轮换后端
+        call_start = time.perf_counter()
+        node = current_node.get()
+        attempt = 0
         try:
-            completion = client.chat.completions.create(**request_kwargs)
-            
-            # 增加空值检查
-            if not completion.choices:
-                raise ValueError("模型返回了空的 choices 列表")
+            while True:
+                try:
+                    # 每次尝试单独占用槽位，退避等待期间不占用 GPU 容量
+                    completion, backend_index = self._hedged_call(backend_index, request_kwargs, deadline, priority, node)
+                    break
+                except Exception as e:
+                    if attempt >= self.policy.max_retries or not is_retriable(e):
+                        raise
+                    attempt += 1
+                    delay = self.policy.backoff(attempt)
+                    if deadline is not None:
+                        delay = min(delay, max(0.0, deadline - time.monotonic()))
+                    print(f"🔁 模型调用第 {attempt} 次重试 (Service {backend_index}): {e}")
+                    time.sleep(delay)
+                    backend_index = (backend_index + 1) % n_backends
 
             response_content = completion.choices[0].message.content.strip()
             
@@ -259,6 +352,8 @@ class CallVLMModel:
             usage = getattr(completion, 'usage', None)
             prompt_tokens = usage.prompt_tokens if usage else 0
             completion_tokens = usage.completion_tokens if usage else 0
+            record_vlm_call(backend_index, time.perf_counter() - call_start,
+                            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, retries=attempt)
             
             return {
                 "content": response_content,
@@ -267,11 +362,10 @@ class CallVLMModel:
             }
 
         except Exception as e:
-            # 打印详细错误栈，方便排查是参数错还是网络错
-            import traceback
-            print(f"❌ 模型调用出错 (Service {service_index if service_index is not None else 'Random'}):")
+            # 重试耗尽仍失败：带出 error 字段，由调用方记录为失败节点，不再静默吞掉
+            record_vlm_call(backend_index, time.perf_counter() - call_start, retries=attempt, error=e)
+            print(f"❌ 模型调用出错 (Service {backend_index}, 重试 {attempt} 次):")
             print(f"   Error: {e}")
-            # traceback.print_exc() # 调试时打开
             return {
                 "content": "{}", 
                 "prompt_tokens": 0,
@@ -279,6 +373,115 @@ class CallVLMModel:
                 "error": str(e) # 把错误信息带出去
             }
 
+    def _attempt_timeout(self, deadline: float) -> float:
+        """单次尝试超时 = min(策略上限, 剩余预算)，预算耗尽直接抛出"""
+        if deadline is None:
+            return self.policy.timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded("请求预算已耗尽")
+        return min(self.policy.timeout, remaining)
+
+    def _slot(self, priority: str, deadline: float):
+        if self.scheduler is None:
+            return nullcontext()
+        return self.scheduler.slot(priority, deadline)
+
+    def _single_attempt(self, backend_index: int, request_kwargs: dict, timeout: float):
+        """向指定后端发起一次请求"""
+        model_name = request_kwargs.get("model") or self._backend_model(backend_index)
+        with start_span("vlm.chat_completion", {"backend": backend_index, "model": model_name}) as span:
+            completion = self.local_clients[backend_index].chat.completions.create(
+                timeout=timeout, **{**request_kwargs, "model": model_name}
+            )
+            # 增加空值检查
+            if not completion.choices:
+                raise EmptyCompletionError("模型返回了空的 choices 列表")
+            if completion.usage:
+                span.set_attribute("prompt_tokens", completion.usage.prompt_tokens)
+                span.set_attribute("completion_tokens", completion.usage.completion_tokens)
+        return completion
+
+    def _executor(self) -> ThreadPoolExecutor:
+        """
+        线程数至少为调度容量的 2 倍：在途任务都持有槽位（最多 capacity 个），
+        提交后总能立刻拿到线程，不会出现超时时钟已经开始、任务还在线程池里排队的情况
+        """
+        if self._hedge_executor is None:
+            with self._hedge_executor_lock:
+                if self._hedge_executor is None:
+                    capacity = self.scheduler.capacity if self.scheduler else 32
+                    workers = max(int(os.getenv("VLM_HEDGE_WORKERS", "0")), 2 * capacity)
+                    self._hedge_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vlm")
+        return self._hedge_executor
+
+    def _submit(self, backend_index: int, request_kwargs: dict, timeout: float, slot_priority: str = None):
+        """
+        槽位随任务走：HTTP 调用无法取消，落后/超时的请求在后端仍占着算力，
+        直到它真正结束才释放槽位，VLM_MAX_CONCURRENCY 始终约束实际在途的后端请求数
+        """
+        # 每个任务复制一份 context，保证 span 父子关系和节点名在线程里可见
+        ctx = contextvars.copy_context()
+
+        def _run():
+            try:
+                return self._single_attempt(backend_index, request_kwargs, timeout)
+            finally:
+                if slot_priority is not None:
+                    self.scheduler.release(slot_priority)
+        return self._executor().submit(ctx.run, _run)
+
+    def _hedged_call(self, primary: int, request_kwargs: dict, deadline: float, priority: str, node: str):
+        """
+        主请求超过该节点 p95 耗时仍未返回时，向另一个后端发对冲请求，先成功者胜出
+        对冲请求同样要占一个槽位，没有空闲槽位时不发
+        返回 (completion, 实际胜出的后端下标)
+        """
+        if not self.policy.hedge or len(self.local_clients) < 2:
+            # 不对冲：在调用线程上直接请求
+            with self._slot(priority, deadline):
+                timeout = self._attempt_timeout(deadline)
+                attempt_start = time.perf_counter()
+                completion = self._single_attempt(primary, request_kwargs, timeout)
+            self.latency_tracker.record(node, time.perf_counter() - attempt_start)
+            return completion, primary
+
+        slot = self.scheduler.acquire(priority, deadline) if self.scheduler else None
+        try:
+            timeout = self._attempt_timeout(deadline)
+        except DeadlineExceeded:
+            if slot is not None:
+                self.scheduler.release(slot)
+            raise
+        attempt_start = time.perf_counter()
+        futures = {self._submit(primary, request_kwargs, timeout, slot): primary}
+        hedge_delay = self.latency_tracker.hedge_delay(node, self.policy)
+        done, _ = wait(futures, timeout=min(hedge_delay, timeout))
+        if not done:
+            secondary = (primary + 1) % len(self.local_clients)
+            remaining = timeout - (time.perf_counter() - attempt_start)
+            hedge_slot = self.scheduler.try_acquire(priority) if self.scheduler else None
+            if remaining > 0 and (self.scheduler is None or hedge_slot is not None):
+                record_hedge(secondary)
+                futures[self._submit(secondary, request_kwargs, remaining, hedge_slot)] = secondary
+            elif hedge_slot is not None:
+                self.scheduler.release(hedge_slot)
+
+        last_error = None
+        pending = set(futures)
+        while pending:
+            remaining = timeout - (time.perf_counter() - attempt_start)
+            done, pending = wait(pending, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    self.latency_tracker.record(node, time.perf_counter() - attempt_start)
+                    return future.result(), futures[future]
+                last_error = error
+        raise last_error or AttemptTimeout(f"单次调用超过 {timeout:.1f}s 未返回")
+
     def call_qwen_vl_32b(self,image_content: str, prompt: str) -> str:
         """封装qwen2.5-vl-7b-instruct调用，保留必要参数"""
         
@@ -3,6 +3,14 @@ from fastapi.responses import JSONResponse
 from modelscope import Qwen2_5_VLForConditionalGeneration, AutoProcessor
 from qwen_vl_utils import process_vision_info
 from PIL import Image
+from typing import List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import hashlib
+import asyncio
+import time
+import os
 import io
 import torch
 
@@ -30,30 +38,41 @@ processor = AutoProcessor.from_pretrained(
     MODEL_PATH,
     trust_remote_code=True
 )
+# 批量生成必须左填充，否则短 prompt 的生成位置会落在 pad 之后
+processor.tokenizer.padding_side = "left"
+
+# 动态批处理参数
+MAX_BATCH_SIZE = int(os.getenv("QWEN_MAX_BATCH_SIZE", "8"))     # 单次 generate 的最大请求数
+MAX_WAIT_MS = float(os.getenv("QWEN_MAX_WAIT_MS", "10"))        # 凑批最长等待时间（毫秒）
+MAX_NEW_TOKENS = 128  # 可根据需求调整
 
 # 定义推理核心函数
-def infer(image: Image.Image, question: str) -> str:
+def infer_batch(images: List[Image.Image], questions: List[str]) -> List[str]:
     """
-    核心推理函数：接收图片和问题，返回模型回答
+    批量推理：多组 (图片, 问题) 填充后一次 generate，按输入顺序返回回答
     """
     # 构建对话格式
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "image", "image": image},  # 传入PIL图片对象
-                {"type": "text", "text": question}
-            ],
-        }
+    messages_list = [
+        [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": image},  # 传入PIL图片对象
+                    {"type": "text", "text": question}
+                ],
+            }
+        ]
+        for image, question in zip(images, questions)
     ]
 
     # 预处理输入
-    text = processor.apply_chat_template(
-        messages, tokenize=False, add_generation_prompt=True
-    )
-    image_inputs, video_inputs = process_vision_info(messages)
+    texts = [
+        processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        for messages in messages_list
+    ]
+    image_inputs, video_inputs = process_vision_info(messages_list)
     inputs = processor(
-        text=[text],
+        text=texts,
         images=image_inputs,
         videos=video_inputs,
         padding=True,
@@ -65,7 +84,7 @@ def infer(image: Image.Image, question: str) -> str:
     with torch.no_grad():  # 禁用梯度，节省显存
         generated_ids = model.generate(
             **inputs,
-            max_new_tokens=128,  # 可根据需求调整
+            max_new_tokens=MAX_NEW_TOKENS,
             # do_sample=False,  # 贪心解码，速度快
             # temperature=0.0
         )
@@ -79,7 +98,214 @@ def infer(image: Image.Image, question: str) -> str:
         skip_special_tokens=True,
         clean_up_tokenization_spaces=False
     )
-    return output_text[0]
+    return output_text
+
+
+def infer(image: Image.Image, question: str) -> str:
+    """
+    核心推理函数：接收图片和问题，返回模型回答
+    """
+    return infer_batch([image], [question])[0]
+
+
+# ==========================================
+# 视觉特征复用：同一张图片的多个问题只跑一次视觉编码
+# ==========================================
+VISION_CACHE_SIZE = int(os.getenv("QWEN_VISION_CACHE_SIZE", "64"))  # 缓存的图片数（视觉特征留在显存里）
+
+
+class VisionEmbeddingCache:
+    """按图片内容哈希缓存 (视觉特征, image_grid_thw)，LRU 淘汰"""
+    def __init__(self, max_entries: int = VISION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+vision_cache = VisionEmbeddingCache()
+
+
+def _vision_tower():
+    # 不同版本 transformers 中视觉塔的位置不同
+    return getattr(model, "visual", None) or model.model.visual
+
+
+def encode_vision(image: Image.Image, cache_key: str):
+    """预处理 + 视觉编码，只对缓存未命中的图片执行一次"""
+    entry = vision_cache.get(cache_key)
+    if entry is not None:
+        return entry
+    messages = [{"role": "user", "content": [{"type": "image", "image": image}]}]
+    image_inputs, _ = process_vision_info(messages)
+    vision_inputs = processor.image_processor(images=image_inputs, return_tensors="pt")
+    visual = _vision_tower()
+    pixel_values = vision_inputs["pixel_values"].to(visual.device, dtype=visual.dtype)
+    image_grid_thw = vision_inputs["image_grid_thw"].to(visual.device)
+    with torch.no_grad():
+        image_embeds = visual(pixel_values, grid_thw=image_grid_thw)
+    if not torch.is_tensor(image_embeds):
+        pooled = getattr(image_embeds, "pooler_output", None)
+        image_embeds = pooled if pooled is not None else image_embeds[0]
+    entry = (image_embeds, image_grid_thw)
+    vision_cache.put(cache_key, entry)
+    return entry
+
+
+def infer_multi(image: Image.Image, questions: List[str], cache_key: str) -> List[str]:
+    """
+    同一张图片回答多个问题：视觉特征只计算一次，所有问题填充后一次 generate
+    文本侧把 image_pad 展开成与视觉特征等长的占位符，再把特征写回 inputs_embeds 对应位置
+    """
+    image_embeds, image_grid_thw = encode_vision(image, cache_key)
+    merge_size = processor.image_processor.merge_size
+    n_image_tokens = int(image_grid_thw.prod(-1).sum()) // (merge_size ** 2)
+    image_token = processor.image_token
+
+    texts = []
+    for question in questions:
+        messages = [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": question}]}]
+        text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        texts.append(text.replace(image_token, image_token * n_image_tokens, 1))
+    inputs = processor.tokenizer(texts, padding=True, return_tensors="pt").to(model.device)
+
+    with torch.no_grad():
+        inputs_embeds = model.get_input_embeddings()(inputs.input_ids)
+        image_mask = inputs.input_ids == model.config.image_token_id
+        batch_embeds = image_embeds.to(inputs_embeds.dtype).repeat(len(questions), 1)
+        inputs_embeds[image_mask] = batch_embeds
+        # input_ids 仍然传入，用于计算 M-RoPE 位置；不传 pixel_values，模型不会再跑视觉塔
+        generated_ids = model.generate(
+            input_ids=inputs.input_ids,
+            inputs_embeds=inputs_embeds,
+            attention_mask=inputs.attention_mask,
+            image_grid_thw=image_grid_thw.repeat(len(questions), 1),
+            max_new_tokens=MAX_NEW_TOKENS,
+        )
+
+    generated_ids_trimmed = [
+        out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+    ]
+    return processor.batch_decode(
+        generated_ids_trimmed,
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=False
+    )
+
+
+# ==========================================
+# 动态批处理：请求入队 -> 凑批（满 MAX_BATCH_SIZE 或等满 MAX_WAIT_MS）-> 一次 generate -> 分发结果
+# ==========================================
+class DynamicBatcher:
+    def __init__(self, batch_fn, max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_WAIT_MS):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self._task = None
+        # GPU 推理放到单独的线程里执行，事件循环不会被 generate 阻塞；单线程保证同一时刻只有一个 batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
+        self.batches = 0
+        self.requests = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._executor.shutdown(wait=False)
+
+    async def run_exclusive(self, fn, *args):
+        """在 generate 线程里执行其他推理任务，与批处理共享同一块 GPU 的执行顺序"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def submit(self, image: Image.Image, question: str) -> str:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, question, future))
+        return await future
+
+    async def _collect(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # 客户端断开的请求不再参与推理
+            batch = [item for item in batch if not item[2].cancelled()]
+            if not batch:
+                continue
+            images, questions, futures = zip(*batch)
+            try:
+                answers = await loop.run_in_executor(self._executor, self.batch_fn, list(images), list(questions))
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            for future, answer in zip(futures, answers):
+                if not future.done():
+                    future.set_result(answer)
+
+
+batcher = DynamicBatcher(infer_batch)
+
+
+@app.on_event("startup")
+async def start_batcher():
+    batcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    await batcher.stop()
+
+
+async def read_image_bytes(file: UploadFile) -> bytes:
+    # 验证文件格式
+    allowed_extensions = {"jpg", "jpeg", "png"}
+    file_ext = file.filename.split(".")[-1].lower()
+    if file_ext not in allowed_extensions:
+        raise HTTPException(status_code=400, detail="仅支持jpg/jpeg/png格式的图片")
+    return await file.read()
+
+
+async def read_image(file: UploadFile) -> Image.Image:
+    # 读取图片文件并转为PIL对象
+    contents = await read_image_bytes(file)
+    return Image.open(io.BytesIO(contents)).convert("RGB")
 
 # 定义POST接口：接收图片和问题
 @app.post("/chat", summary="Qwen2.5-VL多模态对话")
@@ -88,18 +314,11 @@ async def chat(
     question: str = Form(..., description="针对图片的问题文本")
 ):
     try:
-        # 1. 验证文件格式
-        allowed_extensions = {"jpg", "jpeg", "png"}
-        file_ext = file.filename.split(".")[-1].lower()
-        if file_ext not in allowed_extensions:
-            raise HTTPException(status_code=400, detail="仅支持jpg/jpeg/png格式的图片")
-
-        # 2. 读取图片文件并转为PIL对象
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
+        # 1~2. 验证文件格式并读取图片
+        image = await read_image(file)
 
-        # 3. 调用推理函数
-        result = infer(image, question)
+        # 3. 交给动态批处理，与并发的其他请求合并为一次 generate
+        result = await batcher.submit(image, question)
 
         # 4. 返回结果
         return JSONResponse(
@@ -112,14 +331,70 @@ async def chat(
             }
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         # 异常处理
         raise HTTPException(status_code=500, detail=f"推理失败：{str(e)}")
 
+@app.post("/chat_batch", summary="Qwen2.5-VL多模态对话（批量）")
+async def chat_batch(
+    files: List[UploadFile] = File(..., description="多张图片（支持jpg/png/jpeg）"),
+    questions: List[str] = Form(..., description="问题列表：与图片一一对应，或只给一个问题用于所有图片")
+):
+    if len(questions) not in (1, len(files)):
+        raise HTTPException(status_code=400, detail="questions 数量必须为 1 或与图片数量一致")
+    try:
+        images = [await read_image(file) for file in files]
+        if len(questions) == 1:
+            questions = questions * len(images)
+        answers = await asyncio.gather(*(batcher.submit(image, q) for image, q in zip(images, questions)))
+        return JSONResponse(
+            status_code=200,
+            content={
+                "code": 0,
+                "msg": "success",
+                "results": [{"question": q, "answer": a} for q, a in zip(questions, answers)]
+            }
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"推理失败：{str(e)}")
+
+@app.post("/chat_multi", summary="Qwen2.5-VL多模态对话（单图多问题，视觉特征复用）")
+async def chat_multi(
+    file: UploadFile = File(..., description="上传的图片文件（支持jpg/png/jpeg）"),
+    questions: List[str] = Form(..., description="针对同一张图片的多个问题，例如各打标节点的 Prompt")
+):
+    try:
+        contents = await read_image_bytes(file)
+        image = Image.open(io.BytesIO(contents)).convert("RGB")
+        cache_key = hashlib.sha256(contents).hexdigest()
+        answers = await batcher.run_exclusive(infer_multi, image, questions, cache_key)
+        return JSONResponse(
+            status_code=200,
+            content={
+                "code": 0,
+                "msg": "success",
+                "results": [{"question": q, "answer": a} for q, a in zip(questions, answers)]
+            }
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"推理失败：{str(e)}")
+
 # 健康检查接口（可选）
 @app.get("/health", summary="服务健康检查")
 async def health():
-    return {"status": "healthy", "gpu_available": torch.cuda.is_available()}
+    return {
+        "status": "healthy",
+        "gpu_available": torch.cuda.is_available(),
+        "queued": batcher.queue.qsize() if batcher.queue is not None else 0,
+        "avg_batch_size": round(batcher.requests / batcher.batches, 2) if batcher.batches else 0.0,
+        "vision_cache": {"hits": vision_cache.hits, "misses": vision_cache.misses},
+    }
 
 # 启动服务（直接运行该脚本时触发）
 if __name__ == "__main__":
@@ -129,6 +404,6 @@ if __name__ == "__main__":
         "qwen_vl_api:app",
         host="0.0.0.0",
         port=8000,
-        workers=4,  # 单进程（模型加载在全局，多进程会重复加载显存不足）
+        workers=1,  # 单进程：模型加载在全局，多进程会重复加载显存；并发由动态批处理承接
         reload=False  # 生产环境关闭热重载
     )
\ No newline at end of file
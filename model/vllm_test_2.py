@@ -1,12 +1,18 @@
 import base64
+import json
 import time
 import os
+import sys
 import random
 import psutil
 import pynvml
 from openai import OpenAI
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from statistics import median, quantiles
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from bench_compare import GpuSampler
 
 # ===================== 全局配置（按需修改） =====================
 # VLLM服务配置
@@ -41,6 +47,7 @@ PROMPT_TEMPLATES = [  # 不同的问题模板（随机选）
 CONCURRENT_NUM_LIST = [50, 60, 100, 150, 200]  # 最高20并发（3张图各复用6-7次）
 MAX_WORKERS = 200  # 线程池最大线程数（≥最大并发数）
 REQUEST_TIMEOUT = 30  # 单请求超时时间（秒）
+REPORT_PATH = "vllm_bench_report.json"  # 汇总结果，可用 bench_compare.py store --input 存档对比
 
 # ===================== 工具函数 =====================
 # 初始化GPU监控（pynvml）
@@ -123,6 +130,7 @@ def send_request(request_id, client, image_path, prompt_templates):
             "cost_time": cost_time,
             "success": True,
             "result": completion.choices[0].message.content.strip(),
+            "completion_tokens": completion.usage.completion_tokens if completion.usage else 0,
             "error": None
         }
     except Exception as e:
@@ -149,6 +157,7 @@ def stat_results(results, total_time, concurrent_num):
     avg_cost = sum(cost_times) / len(cost_times) if cost_times else 0
     p95_cost = quantiles(cost_times, n=20)[18] if len(cost_times)>=20 else (max(cost_times) if cost_times else 0)
     median_cost = median(cost_times) if cost_times else 0
+    p99_cost = quantiles(cost_times, n=100)[98] if len(cost_times)>=100 else (max(cost_times) if cost_times else 0)
 
     return {
         "concurrent_num": concurrent_num,
@@ -159,7 +168,9 @@ def stat_results(results, total_time, concurrent_num):
         "qps": qps,
         "avg_cost": avg_cost,
         "median_cost": median_cost,
-        "p95_cost": p95_cost
+        "p95_cost": p95_cost,
+        "p99_cost": p99_cost,
+        "tokens_per_s": sum(r.get("completion_tokens", 0) for r in results) / total_time if total_time > 0 else 0
     }
 
 if __name__ == "__main__":
@@ -229,7 +240,7 @@ if __name__ == "__main__":
         # 执行并发请求
         start_total_time = time.time()
         results = []
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        with GpuSampler() as gpu_sampler, ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
             futures = [
                 executor.submit(send_request, i, client, test_image_paths[i], PROMPT_TEMPLATES)
                 for i in range(concurrent_num)
@@ -240,6 +251,7 @@ if __name__ == "__main__":
         # 统计结果
         total_time = time.time() - start_total_time
         stat = stat_results(results, total_time, concurrent_num)
+        stat["gpu"] = gpu_sampler.summary()  # 压测期间的平均/峰值利用率
         final_report.append(stat)
 
         # 修改点4：添加图片多样性指标到统计结果
@@ -321,6 +333,10 @@ if __name__ == "__main__":
         if max_qps_stat['concurrent_num'] < last_stat['concurrent_num']:
             print(f"  📉 QPS在{max_qps_stat['concurrent_num']}并发时达到峰值{max_qps_stat['qps']:.2f}，之后开始下降")
 
+    with open(REPORT_PATH, "w", encoding="utf-8") as f:
+        json.dump(final_report, f, ensure_ascii=False, indent=2)
+    print(f"\n汇总结果已写入 {REPORT_PATH}")
+
     # 清理GPU监控资源
     if nvml:
         nvml.nvmlShutdown()
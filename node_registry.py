@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : node_registry.py
+# @Usage   : 声明式的打标节点注册表 + 节点工厂
+"""
+每个 VLM 打标节点由一条 ``NodeSpec`` 描述：
+
+    (节点名, 一级主体门控, Prompt, Schema, node_results 的输出 key, 输入分辨率, 标签前缀)
+
+``make_vlm_node`` 按 spec 生成图节点，所有节点共用同一条热路径：
+主体门控 -> 预算检查 -> 选取对应分辨率的图片 -> 调用 VLM（Schema JSON 在 import 时已生成）
+-> 调试记录 -> 统一 JSON 解析。新增一个标签族只需要在 ``NODE_SPECS`` 里加一行。
+
+``optional=True`` 的节点在请求剩余预算不足 ``OPTIONAL_NODE_MIN_BUDGET`` 秒时直接跳过，
+已在执行中的可选节点被截止时间打断时同样记为跳过，结果标记为降级（degraded）。
+"""
+import os
+import json
+import time
+import hashlib
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Optional, Type
+
+from pydantic import BaseModel, create_model
+
+from logger import get_logger
+from debug_trace import record_exchange
+from tagging_state import Usage
+from schema_registry import register_schema
+from scheduler import INTERACTIVE
+from schemas import (
+    FirstLevelSchema,
+    PortraitDetailsSchema,
+    ClothingDetailsSchema,
+    PetDetailsSchema,
+    FoodDetailsSchema,
+    SceneryDetailsSchema,
+    SceneTypeSchema
+)
+
+logger = get_logger(service="lg_builder")
+
+DEFAULT_MAX_EDGE = 768  # Qwen-VL 分类任务 768px 足够
+# 剩余预算低于该值（秒）时不再启动可选节点，大约是一次细节节点调用的典型耗时
+OPTIONAL_NODE_MIN_BUDGET = float(os.getenv("OPTIONAL_NODE_MIN_BUDGET", "2.0"))
+
+
+# ==========================================
+# Prompt 定义（只描述业务规则，JSON 格式由 Schema 约束）
+# ==========================================
+FIRST_LEVEL_PROMPT = """
+    任务：判断图片的核心主体，仅从以下一级分类的七个分类中选择（可以多选，不新增，如果都不含有就选其他）。
+    
+    【重要判别标准】：
+    1. **人像**：必须包含清晰的人物主体（面部或半身/全身清晰）。
+       - ❌ 排除情况：仅出现手部、脚部等局部肢体（如手持物品图）；人物极小（如大风景中的微小人影）；极度模糊或黑暗的剪影。
+       - ✅ 只有当人物是画面的视觉中心时，才选“人像”。
+    2. **动物（宠物）**：狗、猫、鸟、鱼、兔子等。
+    3. **植物**：花卉、树木、盆栽、绿植等明确的植物特写。
+       - ⚠️ 区分注意：如果是特写或单株植物选“植物”；如果是大面积的森林、花海、草原，请选“风景”。
+    4. **风景**：自然景观（包含森林/花海等大面积植被）、城市风光、蓝天、雪景等。
+    5. **食物**：餐饮、饮料、零食。
+    6. **建筑**：明显的建筑物外观或室内空间主体结构。
+    7. **其他**：完全无法归入以上六类的物品或主体不明。
+    
+    如果一张图片同时含有了 人像，动物，植物 等多个明确主体，请全部列出。
+    """
+
+PORTRAIT_PROMPT = """
+        任务：基于图片，提取“人像”的二级标签，仅从以下预设选项中选择（可多选，不确定的标签坚决不选）：
+        - 性别：男性、女性
+        - 年龄：儿童（0-10岁）、少年（11-18岁）、青年（19-35岁）、中年（36-59岁）、老年（60岁及以上）【重要：年龄标签仅能从这5个选项中选择，严禁自创任何其他表述（如“青壮年”“青少年”“成年”“中老年”等）】
+        - 人数：单人、多人（画面里出现≥2个人物）
+        - 拍摄方式：自拍（含手持手机、露出手臂、自拍杆、高角度近距离俯拍任一特征）、他拍（非自拍非合影的单人拍摄）、合影（两人及以上同框）；
+        - 构图：全身（完整呈现人物头顶至脚底）、半身（头顶至大腿中部 / 腰部）、面部特写（仅头部或完整面部，主体占比≤30%）；
+        - 角度：正面（人脸对称正对镜头）、侧面（单侧脸颊 / 眼睛为主）、背影（仅看到背部无面部）
+        - 用途：生活照（日常随拍）、证件照（背景纯色无杂物红 / 蓝 / 白，人物正面头部 / 肩部特写居中，着装正式整洁免冠无夸张饰品，光线均匀无明显阴影，为身份证 / 护照 / 毕业证等官方证件专用）、情侣照（画面中有两名异性人物距离较近、身体靠近或紧挨，或有牵手、拥抱、依偎、对视、搭肩等情侣互动，氛围浪漫甜蜜）
+        - 发型长度：长发（头发长度过肩，或垂落至背部、胸前，整体发长≥30cm）、短发（头发长度≤下巴，常见寸头、波波头、齐耳短发等，整体发长＜15cm）
+        - 发型直卷：卷发（头发呈自然卷/烫卷形态，有明显波浪、螺旋或羊毛卷纹理，非拉直状态）、直发（头发整体顺直无明显卷曲，垂落形态顺滑，无卷度或仅有轻微弧度）
+        - 发型形式：扎发（头发被束起固定，含马尾、丸子头、麻花辫、高颅顶束发、半扎发等形态，非完全散开）、披发（头发完全自然散开，无束起、绑扎的痕迹，整体呈垂落/蓬松散开状态）
+        - 表情：微笑（嘴角上扬，露出牙齿或不露齿均可，整体面部表情愉悦）、大笑（哈哈大笑，笑的豁然开朗，漏出牙齿的笑）严肃（面部表情平静，无明显笑容，嘴唇紧闭或微张，眼神专注有神）、闭眼（双眼稍微眯眼，注意稍微眯眼，不是正常的看镜头）
+        - 姿态：坐姿（人物以坐着的姿势出现，含椅子、地面、沙发等多种坐姿场景）、站立（人物以站立的姿势出现，含自然站立、摆拍等多种站姿场景）
+        """
+
+CLOTHING_PROMPT = """
+        任务：基于图片，提取“人像”的服饰与造型标签，仅从以下预设选项中选择（可多选，可为空，不确定的标签坚决不选）：
+        
+        1. 【核心着装】：
+        - 基本款式：西装、职业装、T恤、衬衫、毛衣、羽绒服、裙子、运动装、睡衣、校服、婚纱、泳装
+        - 题材：cosplay、lolita、jk、旗袍、新中式、民族服装、夏装、冬装、春秋装
+        - 风格：休闲风、街头风、正式风、学院风
+        
+        2. 【配饰细节】：
+        - 饰品：帽子、口罩、耳环、项链、发饰、围巾
+          （注意：细小的耳环和项链请仔细辨别；帽子包含鸭舌帽、草帽、贝雷帽等）
+          
+        3. 【面部细节】：
+        - 眼镜：眼镜、否
+        """
+
+PET_PROMPT = """
+        任务：基于图片，提取“动物”的二级标签，仅从以下预设选项中选择（可多选，不确定的标签坚决不选）：
+        - 种类：狗、猫、鸟、鱼、兔子、其他（注意只涉及这5种动物，不确定的话就选 其他）
+        - 数量：单只、多只
+        - 视角与状态：宠物正面、宠物全身、室内宠物图、户外宠物图
+        输出要求：严格用JSON格式返回，key为二级分类类型（如“种类”“数量”），value为标签列表（空列表不显示），不添加任何额外文字、解释或标点。
+        再次声明：仅限于上述5种动物（狗、猫、鸟、鱼、兔子）分类，不是这5中动物的其他种类。就选 其他。
+        错误示例（禁止）：{"种类":["犀牛"], "数量":["单人"], "备注":"图片为室内自拍"}
+        正确示例（必须遵循）：{"种类":["狗"], "数量":["单只"], "视角与状态":["宠物正面","室内宠物图"]}
+        """
+
+SCENERY_PROMPT = """
+        【核心规则（优先级最高）】：
+        1. 仅标注图片中**明确可见、100%确定**的元素，无则完全不标注该类别，坚决杜绝猜测、虚构标签；
+        2. 即使只有1个标签也可，无需凑数；不确定的标签直接忽略，宁少勿错；
+        3. 所有标签必须从预设选项中选择，禁止新增任何未列出的标签。
+        任务：基于图片，提取“风景”的二级标签，仅从以下预设选项中选择（可多选，不确定的标签坚决不选）：
+        - 地貌场景：海边、山脉、森林、草原、沙漠、瀑布、湖泊、花海、峡谷
+        - 城市天空：天空（注意：如果含蓝天白云，一定要加上天空这个标签）、城市夜景、日落、星空
+        - 季节相关：春季（含有樱花、桃花、梨花、嫩芽、柳树、蒲公英、油菜花、洋甘菊等）、夏季（含有荷花、荷叶、浓绿树荫、繁茂草丛、烈日、西瓜等，如果图片中有人穿短袖，泳装，或者佩戴太阳镜，黑色墨镜也可以判断为夏季）、秋季（含有枫叶、银杏、落叶、枯草、麦浪等）、冬季（首先可以根据如果图片中含有积雪、飘雪、冰雕、冰凌、雾凇、枯枝、梅花来判断，其次如果人像穿了羽绒服、冬季棉袄之类的都可以判定为冬季）
+        输出要求：严格用JSON格式返回，key为二级分类类型（如“种类”“数量”），value为标签列表（空列表不显示），不添加任何额外文字、解释或标点。
+        错误示例（禁止）：{"地貌场景":["海边"], "城市天空":["天空"], "备注":"图片为室内自拍"}
+        正确示例（必须遵循）：{"地貌场景":["海边"], "城市天空":["水面"], "季节相关":["春季"]}
+        """
+
+FOOD_PROMPT = """
+        任务：基于图片，提取“食物细节”的二级标签，仅从以下预设选项中选择（可多选，不确定的标签坚决不选）：
+        - 食物类型：中餐、西餐、甜品、奶茶、火锅、水果、烧烤、主菜、小吃、饮品
+        - 拍摄场景：桌面摆盘、俯拍、特写、居家烹饪、餐厅环境
+        输出要求：严格用JSON格式返回，key为二级分类类型（如“食物类型”“拍摄场景”），value为标签列表（空列表不显示），不添加任何额外文字、解释或标点。
+        错误示例（禁止）：{"食物类型":["饮品"], "拍摄场景":["单人"], "备注":"图片为室内自拍"}
+        正确示例（必须遵循）：{"食物类型":["火锅"], "拍摄场景":["俯拍"]}
+        """
+
+SCENE_TYPE_PROMPT = """
+    【核心规则（优先级最高）】：
+    1. **先写[场景分析]**：简明扼要地描述画面整体环境。
+    2. **所见即所得**：仅标注明确可见的实体，不确定的直接忽略，宁少勿错。
+    3. **【防复读死循环指令】**：每种标签在列表中**绝对只允许出现一次**！即使画面中有 10 棵圣诞树，在“特殊元素”中也只能输出一次 "圣诞树"，严禁重复枚举！
+
+    任务：基于图片提取场景类型，仅从以下预设选项中选择（无则不选）：
+    - 空间：室内（封闭空间）、室外（开放空间）
+    - 场所类型：自然、家居、餐厅、健身房、游乐园、音乐节、KTV、演唱会
+    - 时间：白天（可见自然光）、夜晚（天黑/人工照明）
+    - 天气：晴天、阴天、多云、雨天、雪天、雾天、彩虹
+    - 光线：逆光（光源在主体后方）、自然光
+    - 特殊元素（必须是实体）：烟花、圣诞树、气球、彩带、蛋糕、粽子、元宵、月饼、礼物盒
+    - 水印：[必选] 发现文字/ID/Logo/时间戳选'水印'；干净选'无水印'
+    - 图片质量：无路人、有路人、老照片
+    - 节日：生日、婚礼、圣诞、春节、中秋、端午、万圣节、国庆
+    """
+
+
+# ==========================================
+# 节点注册表
+# ==========================================
+@dataclass(frozen=True)
+class NodeSpec:
+    name: str                                  # 图节点名
+    output_key: str                            # 写入 node_results 的 key
+    prompt: str
+    schema: Type[BaseModel]
+    subjects: tuple = ()                       # 一级主体门控，命中任一才执行；为空表示不依赖一级分类
+    tag_prefix: Optional[str] = None           # format_output 拼接标签的前缀，None 表示不直接产出标签
+    max_edge: int = DEFAULT_MAX_EDGE           # 该节点输入图片的长边
+    optional: bool = False                     # 预算紧张时可跳过的节点
+    schema_json: dict = field(init=False, repr=False, compare=False)
+    schema_hash: str = field(init=False, repr=False, compare=False)
+
+    def is_gated_in(self, node_results: dict) -> bool:
+        """一级主体门控：没有门控或命中任一主体时执行"""
+        if not self.subjects:
+            return True
+        main_labels = node_results.get("first_level", {}).get("主体", [])
+        return any(subject in main_labels for subject in self.subjects)
+
+    def __post_init__(self):
+        # Schema JSON 只在 import 时经注册表生成一次，避免每次调用都跑 model_json_schema()
+        entry = register_schema(self.schema)
+        object.__setattr__(self, "schema_json", entry.schema)
+        object.__setattr__(self, "schema_hash", entry.hash)
+
+
+FIRST_LEVEL_SPEC = NodeSpec(
+    name="first_level_classification", output_key="first_level",
+    prompt=FIRST_LEVEL_PROMPT, schema=FirstLevelSchema,
+)
+
+NODE_SPECS = [
+    FIRST_LEVEL_SPEC,
+    NodeSpec(name="second_level_person", output_key="second_level_person",
+             prompt=PORTRAIT_PROMPT, schema=PortraitDetailsSchema,
+             subjects=("人像",), tag_prefix="人像"),
+    NodeSpec(name="third_level_person_cloth", output_key="second_level_person_cloth",
+             prompt=CLOTHING_PROMPT, schema=ClothingDetailsSchema,
+             subjects=("人像",), tag_prefix="人像-服饰", optional=True),
+    NodeSpec(name="second_level_pet", output_key="second_level_pet",
+             prompt=PET_PROMPT, schema=PetDetailsSchema,
+             subjects=("动物（宠物）",), tag_prefix="动物（宠物）"),
+    NodeSpec(name="second_level_scenery", output_key="second_level_scenery",
+             prompt=SCENERY_PROMPT, schema=SceneryDetailsSchema,
+             subjects=("风景",), tag_prefix="风景"),
+    NodeSpec(name="second_level_food", output_key="second_level_food",
+             prompt=FOOD_PROMPT, schema=FoodDetailsSchema,
+             subjects=("食物",), tag_prefix="食物"),
+    NodeSpec(name="all_scene_type", output_key="all_scene_type",
+             prompt=SCENE_TYPE_PROMPT, schema=SceneTypeSchema,
+             tag_prefix="场景", optional=True),
+]
+
+# 依赖一级分类结果的节点 / 与一级分类并行的节点
+GATED_SPECS = [spec for spec in NODE_SPECS if spec.subjects]
+ROOT_SPECS = [spec for spec in NODE_SPECS if spec is not FIRST_LEVEL_SPEC and not spec.subjects]
+MAX_EDGES = sorted({spec.max_edge for spec in NODE_SPECS})
+
+
+def compute_prompt_version(specs: list = None) -> str:
+    """Prompt / Schema / 分辨率 / 标签前缀的内容摘要，任一节点改动都会得到新版本"""
+    digest = hashlib.md5()
+    for spec in specs or NODE_SPECS:
+        digest.update(json.dumps([spec.name, spec.prompt, spec.schema_json, spec.max_edge, spec.tag_prefix,
+                                  list(spec.subjects)], ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+# 写入每条结果，批量重测据此跳过已用当前 Prompt 跑过的图片；可用环境变量显式指定
+PROMPT_VERSION = os.getenv("PROMPT_VERSION") or compute_prompt_version()
+
+
+# ==========================================
+# One-Pass：所有节点合并成一次调用（README 方案一，配置扫描时与多节点对比）
+# ==========================================
+ONE_PASS_PROMPT_HEADER = """
+    任务：一次性完成以下所有子任务，按 Schema 输出一个 JSON，每个字段对应一个子任务。
+    先完成【first_level】的主体判断；细节子任务只有在主体命中其适用范围时才填写，否则所有列表留空。
+    """
+
+
+@lru_cache(maxsize=None)
+def build_one_pass_spec(specs: tuple = None) -> NodeSpec:
+    """合并 specs（默认全部节点）的 Prompt 与 Schema，字段名即各节点的 output_key；首次调用时才注册 Schema"""
+    specs = specs or tuple(NODE_SPECS)
+    schema = create_model("OnePassSchema", **{spec.output_key: (spec.schema, ...) for spec in specs})
+    sections = []
+    for spec in specs:
+        scope = f"（仅当主体含{'/'.join(spec.subjects)}时填写）" if spec.subjects else ""
+        sections.append(f"【{spec.output_key}】{scope}\n{spec.prompt}")
+    return NodeSpec(name="one_pass", output_key="one_pass", prompt=ONE_PASS_PROMPT_HEADER + "\n".join(sections),
+                    schema=schema, max_edge=max(spec.max_edge for spec in specs))
+
+
+def split_one_pass_result(data: dict, specs: tuple = None) -> dict:
+    """One-Pass 输出 -> node_results；门控不满足的细节节点即使模型填了也丢弃，与多节点链路口径一致"""
+    specs = specs or tuple(NODE_SPECS)
+    first_key = FIRST_LEVEL_SPEC.output_key
+    node_results = {first_key: data.get(first_key) or {}}
+    for spec in specs:
+        if spec.output_key != first_key and spec.is_gated_in(node_results):
+            node_results[spec.output_key] = data.get(spec.output_key) or {}
+    return node_results
+
+
+# ==========================================
+# 共享解析与节点工厂
+# ==========================================
+def parse_model_json(content: str) -> dict:
+    """
+    Guided Decoding 下模型输出基本都是纯 JSON，直接 loads；
+    偶尔带 markdown 围栏时去掉围栏；被截断时用 json_repair 补全。
+    """
+    clean_content = content.strip()
+    if not clean_content.startswith("{"):
+        clean_content = clean_content.replace("```json", "").replace("```", "").strip()
+    try:
+        return json.loads(clean_content)
+    except Exception:
+        try:
+            from json_repair import repair_json
+            data = json.loads(repair_json(clean_content))
+            logger.warning(f"⚠️ JSON被截断，已自动修复。原始内容：{clean_content}")
+            return data if isinstance(data, dict) else {}
+        except Exception as e:
+            logger.info(f"⚠️ JSON解析失败：{str(e)}")
+            return {}
+
+
+def select_image(state, spec: NodeSpec) -> str:
+    """取该节点分辨率对应的图片，没有单独的分辨率时用默认图"""
+    return state.get("image_variants", {}).get(spec.max_edge) or state["image_info"]
+
+
+def response_update(spec: NodeSpec, response: dict) -> dict:
+    """把一次 VLM 调用的返回转换成状态更新（在线节点与离线引擎共用）"""
+    update = {"usage": Usage.from_response(response)}
+    if "error" in response:
+        # 重试耗尽：不写空结果，记为失败节点，由调用方决定是否重跑
+        logger.warning(f"{spec.name} 调用失败：{response['error']}")
+        update["failed_nodes"] = [spec.name]
+        return update
+    data = parse_model_json(response["content"])
+    if not data:
+        # 解析失败（Schema 都有必填字段，合法输出不会是空对象）：同样记为失败节点，不缓存、重跑时重新请求
+        logger.warning(f"{spec.name} 输出无法解析：{response['content'][:200]}")
+        update["failed_nodes"] = [spec.name]
+        return update
+    logger.info(f"{spec.name} 标签：{data}")
+    update["node_results"] = {spec.output_key: data}
+    return update
+
+
+def make_vlm_node(spec: NodeSpec, model):
+    """按 spec 生成 LangGraph 节点函数"""
+    def node(state):
+        if not spec.is_gated_in(state["node_results"]):
+            return None
+        deadline = state.get("deadline")
+        if spec.optional and deadline is not None and deadline - time.monotonic() < OPTIONAL_NODE_MIN_BUDGET:
+            logger.warning(f"{spec.name} 剩余预算不足，跳过可选节点")
+            return {"skipped_nodes": [spec.name]}
+        image_info = select_image(state, spec)
+        logger.info(f"-----{spec.name} (Guided)-----")
+        response = model.call_qwen_new(image_info, spec.prompt, schema=spec.schema_json, deadline=deadline,
+                                       priority=state.get("priority", INTERACTIVE))
+        record_exchange(state, spec.name, spec.prompt, response["content"])
+        if "error" in response and spec.optional and deadline is not None and time.monotonic() >= deadline:
+            # 可选节点被截止时间打断，按跳过处理
+            logger.warning(f"{spec.name} 超出请求预算，已放弃")
+            return {"usage": Usage.from_response(response), "skipped_nodes": [spec.name]}
+        return response_update(spec, response)
+
+    node.__name__ = spec.name
+    return node
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : offline_engine.py
+# @Usage   : 批量打标的离线模式：进程内 vLLM 引擎，大批量提交所有节点请求
+"""
+在线链路每个节点一次 HTTP 请求，批量回刷时 HTTP/JSON 开销和逐条调度都是浪费。
+离线模式直接在进程内加载模型（与 model/keep_alive.py 相同的 ``vllm.LLM``），
+对一个分片的图片分两轮提交：
+
+1. 一级分类 + 不依赖一级分类的根节点（场景），整批一次 ``LLM.chat``；
+2. 按一级主体门控筛出的细节节点，再整批一次 ``LLM.chat``。
+
+节点的 Prompt / Schema / 门控 / 解析全部来自 ``node_registry``，最终标签由同一个
+``tag_format.format_output`` 生成，与在线服务的 ``final_labels`` 一致。
+CPU 环境下可用 ``StubEngine`` 按 Schema 生成确定性的合法输出联调整条流程，
+``--check-parity`` 用同一个替身分别跑离线模式与 LangGraph 在线链路，校验两者的 ``final_labels`` 一致。
+
+运行示例：
+    python offline_engine.py --engine offline --image-folder /path/to/images --shard 0/4 --output shard0.json
+    python offline_engine.py --engine stub --image-folder /path/to/images
+    python offline_engine.py --check-parity --image-folder /path/to/images   # 校验离线与在线 final_labels 一致
+"""
+import os
+import json
+import time
+import argparse
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import get_logger
+from model import build_vlm_messages, TAGGING_TEMPERATURE, TAGGING_TOP_P, DEFAULT_LOCAL_MODEL_NAME
+from utils import encode_image_variants
+from node_registry import FIRST_LEVEL_SPEC, ROOT_SPECS, GATED_SPECS, MAX_EDGES, DEFAULT_MAX_EDGE, PROMPT_VERSION, select_image, response_update
+from tagging_state import Usage, DEFAULT_PRICING, merge_node_results, new_state
+from tag_format import format_output
+from schema_registry import schema_stub_output
+
+logger = get_logger(service="offline_engine")
+
+
+@dataclass
+class ChatRequest:
+    messages: list
+    schema: dict
+    schema_key: str  # Schema 哈希，用于复用 SamplingParams
+    max_tokens: int = 512
+
+
+# ==========================================
+# 引擎：vLLM 进程内引擎 / CPU 替身
+# ==========================================
+def _structured_output_kwargs(schema: dict) -> dict:
+    """兼容新旧版本 vLLM 的 guided decoding 参数"""
+    try:
+        from vllm.sampling_params import StructuredOutputsParams  # vLLM >= 0.11
+        return {"structured_outputs": StructuredOutputsParams(json=schema)}
+    except ImportError:
+        from vllm.sampling_params import GuidedDecodingParams
+        return {"guided_decoding": GuidedDecodingParams(json=schema)}
+
+
+class VLLMEngine:
+    """进程内 vLLM 引擎，一次 generate 调用提交整批请求"""
+    def __init__(self, model_path: str, **llm_kwargs):
+        from vllm import LLM  # 可选依赖：只有离线模式需要
+        logger.info(f"正在加载离线引擎：{model_path}")
+        self.llm = LLM(model=model_path, **llm_kwargs)
+        self._sampling_cache = {}
+
+    def _sampling_params(self, request: ChatRequest):
+        key = (request.schema_key, request.max_tokens)
+        params = self._sampling_cache.get(key)
+        if params is None:
+            from vllm import SamplingParams
+            kwargs = {"temperature": TAGGING_TEMPERATURE, "top_p": TAGGING_TOP_P, "max_tokens": request.max_tokens}
+            if request.schema is not None:
+                kwargs.update(_structured_output_kwargs(request.schema))
+            params = self._sampling_cache[key] = SamplingParams(**kwargs)
+        return params
+
+    def generate(self, requests: list) -> list:
+        outputs = self.llm.chat(
+            [r.messages for r in requests],
+            sampling_params=[self._sampling_params(r) for r in requests],
+            use_tqdm=True,
+        )
+        return [
+            {
+                "content": out.outputs[0].text.strip(),
+                "prompt_tokens": len(out.prompt_token_ids or []),
+                "completion_tokens": len(out.outputs[0].token_ids),
+            }
+            for out in outputs
+        ]
+
+
+class StubEngine:
+    """CPU 替身引擎：不加载模型，按 Schema 产出确定性的合法 JSON"""
+    def __init__(self, responder=None):
+        # responder(request) -> dict，默认按 (图片, prompt) 的哈希从 Schema 中取值
+        self.responder = responder or (
+            lambda r: schema_stub_output(r.schema or {}, json.dumps(r.messages, ensure_ascii=False))
+        )
+        self.batch_sizes = []
+
+    def generate(self, requests: list) -> list:
+        self.batch_sizes.append(len(requests))
+        return [
+            {"content": json.dumps(self.responder(r), ensure_ascii=False), "prompt_tokens": 0, "completion_tokens": 0}
+            for r in requests
+        ]
+
+
+# ==========================================
+# 两阶段批量打标
+# ==========================================
+def apply_update(state: dict, update: dict):
+    """与 LangGraph reducer 相同的合并规则"""
+    state["node_results"] = merge_node_results(state["node_results"], update.get("node_results"))
+    state["usage"] = state["usage"] + update.get("usage", Usage())
+    state["failed_nodes"] = state["failed_nodes"] + update.get("failed_nodes", [])
+
+
+def failed_result(img_path: str, error: str) -> dict:
+    return {
+        "image_info": img_path,
+        "final_labels": [],
+        "total_labels_count": 0,
+        "elapsed_time": 0.0,
+        "token_cost": 0.0,
+        "status": "failed",
+        "failed_nodes": [],
+        "skipped_nodes": [],
+        "degraded": False,
+        "error": error[:200],
+    }
+
+
+class OfflineTagger:
+    def __init__(self, engine, batch_size: int = 256, max_tokens: int = 512, encode_workers: int = 8):
+        self.engine = engine
+        self.batch_size = batch_size      # 每批图片数，一批内的所有节点请求一起提交
+        self.max_tokens = max_tokens
+        self.encode_workers = encode_workers
+
+    def _encode(self, img_path: str):
+        try:
+            return img_path, encode_image_variants(img_path.strip(), MAX_EDGES), None
+        except Exception as e:
+            return img_path, None, str(e)
+
+    def _run_phase(self, states: dict, specs: list):
+        jobs = [(key, spec) for key, state in states.items() for spec in specs
+                if spec.is_gated_in(state["node_results"])]
+        if not jobs:
+            return
+        requests = [
+            ChatRequest(build_vlm_messages(select_image(states[key], spec), spec.prompt),
+                        spec.schema_json, spec.schema_hash, self.max_tokens)
+            for key, spec in jobs
+        ]
+        try:
+            responses = self.engine.generate(requests)
+        except Exception as e:
+            logger.error(f"离线引擎批量调用失败（{len(requests)} 条）：{e}")
+            responses = [{"content": "{}", "prompt_tokens": 0, "completion_tokens": 0, "error": str(e)}] * len(requests)
+        for (key, spec), response in zip(jobs, responses):
+            apply_update(states[key], response_update(spec, response))
+
+    def _run_chunk(self, image_paths: list) -> list:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.encode_workers) as executor:
+            encoded = list(executor.map(self._encode, image_paths))
+
+        results, states = {}, {}
+        for img_path, variants, error in encoded:
+            if error is not None:
+                logger.error(f"处理失败 {img_path}: {error[:200]}")
+                results[img_path] = failed_result(img_path, error)
+                continue
+            state = new_state(variants.get(DEFAULT_MAX_EDGE) or variants[MAX_EDGES[-1]])
+            if len(variants) > 1:
+                state["image_variants"] = variants
+            states[img_path] = state
+
+        # 第一轮：一级分类 + 根节点；第二轮：门控后的细节节点
+        self._run_phase(states, [FIRST_LEVEL_SPEC] + ROOT_SPECS)
+        self._run_phase(states, GATED_SPECS)
+
+        # 离线模式下单图耗时取本批次的平均值
+        per_image = (time.perf_counter() - start) / max(len(image_paths), 1)
+        for img_path, state in states.items():
+            state.update(format_output(state))
+            results[img_path] = {
+                "image_info": img_path,
+                "final_labels": state["final_labels"],
+                "total_labels_count": len(state["final_labels"]),
+                "elapsed_time": round(per_image, 2),
+                "token_cost": round(DEFAULT_PRICING.cost(state["usage"]), 4),
+                "status": "success",
+                "failed_nodes": state["failed_nodes"],
+                "skipped_nodes": [],
+                "degraded": state["degraded"],
+                "prompt_version": PROMPT_VERSION,
+                "error": "",
+            }
+        return [results[p] for p in image_paths]
+
+    def run(self, image_paths: list) -> list:
+        results = []
+        start = time.perf_counter()
+        for i in range(0, len(image_paths), self.batch_size):
+            results.extend(self._run_chunk(image_paths[i:i + self.batch_size]))
+            elapsed = time.perf_counter() - start
+            logger.info(f"离线打标进度 {len(results)}/{len(image_paths)}，吞吐 {len(results) / elapsed:.2f} 张/秒")
+        return results
+
+
+# ==========================================
+# 命令行入口
+# ==========================================
+def collect_image_paths(image_folder: str) -> list:
+    image_paths = []
+    for root, _, files in os.walk(image_folder):
+        for file in files:
+            if file.lower().endswith(('.png', '.jpg', '.jpeg')):
+                image_paths.append(os.path.join(root, file))
+    return sorted(image_paths)
+
+
+def select_shard(items: list, shard: str) -> list:
+    """shard 形如 "0/4"：取第 0 份（共 4 份），多卡/多机各跑一份"""
+    index, total = (int(x) for x in shard.split("/"))
+    return items[index::total]
+
+
+def run_graph(image_paths: list, max_workers: int) -> list:
+    """在线链路（LangGraph + HTTP vLLM），用于与离线模式对比"""
+    from image_uds_local_new import process_single_image
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda p: process_single_image(p, priority="batch"), image_paths))
+
+
+def check_parity(image_paths: list, max_workers: int = 8) -> list:
+    """
+    同一批图片分别走 OfflineTagger(StubEngine()) 与 LangGraph 在线链路（模型调用换成同一个替身，
+    不发 HTTP、不走结果缓存），返回 final_labels 不一致的图片列表
+    """
+    import image_uds_local_new
+
+    offline = OfflineTagger(StubEngine(), encode_workers=max_workers).run(image_paths)
+
+    stub = StubEngine()
+    model = image_uds_local_new.get_runtime().model
+
+    def stub_call(image_content, prompt, schema=None, max_tokens=512, **kwargs):
+        return stub.generate([ChatRequest(build_vlm_messages(image_content, prompt), schema, "", max_tokens)])[0]
+
+    model.call_qwen_new = stub_call
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            online = list(executor.map(lambda p: image_uds_local_new._process_single_image(p, priority="batch"),
+                                       image_paths))
+    finally:
+        del model.call_qwen_new
+
+    mismatches = []
+    for img_path, off, on in zip(image_paths, offline, online):
+        if off["status"] != on["status"] or off["final_labels"] != on["final_labels"]:
+            mismatches.append({"image_info": img_path,
+                               "offline": {"status": off["status"], "final_labels": off["final_labels"]},
+                               "graph": {"status": on["status"], "final_labels": on["final_labels"]}})
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量图片打标（在线图 / 离线 vLLM 引擎）")
+    parser.add_argument("--engine", choices=["graph", "offline", "stub"], default="offline")
+    parser.add_argument("--image-folder", required=True)
+    parser.add_argument("--shard", default="0/1")
+    parser.add_argument("--output", default="offline_tagging_results.json")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--max-workers", type=int, default=8, help="graph 模式并发数 / 离线模式图片解码线程数")
+    parser.add_argument("--model-path", default=DEFAULT_LOCAL_MODEL_NAME)
+    parser.add_argument("--tensor-parallel-size", type=int, default=1)
+    parser.add_argument("--gpu-memory-utilization", type=float, default=0.85)
+    parser.add_argument("--max-model-len", type=int, default=10000)
+    parser.add_argument("--check-parity", action="store_true",
+                        help="CPU 自检：替身引擎下对比离线模式与在线图的 final_labels，不一致时以非零状态退出")
+    args = parser.parse_args()
+
+    image_paths = select_shard(collect_image_paths(args.image_folder), args.shard)
+    if args.check_parity:
+        mismatches = check_parity(image_paths, args.max_workers)
+        for item in mismatches[:10]:
+            logger.error(f"final_labels 不一致：{json.dumps(item, ensure_ascii=False)}")
+        if mismatches:
+            raise SystemExit(f"❌ {len(mismatches)}/{len(image_paths)} 张图片离线与在线结果不一致")
+        logger.info(f"✅ {len(image_paths)} 张图片离线与在线 final_labels 一致")
+        return
+    logger.info(f"📁 分片 {args.shard} 共 {len(image_paths)} 张图片，引擎：{args.engine}")
+
+    start = time.perf_counter()
+    if args.engine == "graph":
+        results = run_graph(image_paths, args.max_workers)
+    else:
+        if args.engine == "offline":
+            engine = VLLMEngine(
+                args.model_path,
+                tensor_parallel_size=args.tensor_parallel_size,
+                gpu_memory_utilization=args.gpu_memory_utilization,
+                max_model_len=args.max_model_len,
+                mm_processor_kwargs={"use_fast": True},
+            )
+        else:
+            engine = StubEngine()
+        results = OfflineTagger(engine, batch_size=args.batch_size, encode_workers=args.max_workers).run(image_paths)
+    elapsed = time.perf_counter() - start
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    success = sum(1 for r in results if r["status"] == "success")
+    logger.info(f"✅ 完成 {success}/{len(results)}，总耗时 {elapsed:.1f}s，"
+                f"吞吐 {len(results) / max(elapsed, 1e-9):.2f} 张/秒，结果写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
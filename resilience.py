@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : resilience.py
+# @Usage   : VLM 调用的超时 / 重试 / 对冲请求策略
+"""
+``call_qwen_new`` 的容错策略：
+
+1. 每次尝试的超时 = min(单次超时上限, 请求剩余预算)，预算耗尽立即放弃；
+2. 只对可重试错误（超时、连接失败、429、5xx、空 choices）做有限次重试，
+   退避时间使用 full jitter，重试时轮换到下一个后端；
+3. 对冲请求（``VLM_HEDGE=1`` 开启）：主请求超过该节点历史 p95 耗时仍未返回时，向另一个后端再发一份，
+   先成功的结果胜出；对冲请求需要调度器有空闲槽位，HTTP 调用无法真正取消，落后的请求
+   结束前一直占着自己的槽位。
+
+参数由环境变量配置：VLM_TIMEOUT / VLM_MAX_RETRIES / VLM_HEDGE / VLM_HEDGE_QUANTILE。
+"""
+import os
+import random
+import threading
+from collections import deque, defaultdict
+from dataclasses import dataclass
+
+import openai
+
+
+class DeadlineExceeded(TimeoutError):
+    """请求预算已耗尽"""
+
+
+class EmptyCompletionError(ValueError):
+    """模型返回了空的 choices 列表"""
+
+
+class AttemptTimeout(TimeoutError):
+    """单次尝试（含对冲）在超时时间内没有任何后端返回"""
+
+
+@dataclass(frozen=True)
+class ResiliencePolicy:
+    timeout: float = 30.0             # 单次尝试超时上限（秒）
+    max_retries: int = 2              # 首次之外的最多重试次数
+    backoff_base: float = 0.2         # 退避基数（秒）
+    backoff_max: float = 2.0          # 单次退避上限（秒）
+    hedge: bool = False               # 是否启用对冲请求（默认关闭，额外请求会占用后端容量）
+    hedge_quantile: float = 0.95      # 对冲触发延迟取该节点耗时的分位数
+    hedge_min_delay: float = 0.3      # 对冲延迟下限，避免样本偏小时过度对冲
+    hedge_default_delay: float = 5.0  # 样本不足时的对冲延迟
+    min_samples: int = 20             # 计算分位数所需的最少样本数
+
+    @classmethod
+    def from_env(cls) -> "ResiliencePolicy":
+        return cls(
+            timeout=float(os.getenv("VLM_TIMEOUT", "30")),
+            max_retries=int(os.getenv("VLM_MAX_RETRIES", "2")),
+            hedge=os.getenv("VLM_HEDGE", "0") == "1",
+            hedge_quantile=float(os.getenv("VLM_HEDGE_QUANTILE", "0.95")),
+        )
+
+    def backoff(self, attempt: int) -> float:
+        """full jitter：[0, min(上限, base * 2^attempt)] 内均匀随机"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+class LatencyTracker:
+    """按 key（节点名）维护最近 window 次成功调用的耗时，用于计算对冲延迟"""
+    def __init__(self, window: int = 500):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def record(self, key: str, latency: float):
+        with self._lock:
+            self._samples[key].append(latency)
+
+    def quantile(self, key: str, q: float, min_samples: int = 20):
+        with self._lock:
+            samples = sorted(self._samples[key])
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_delay(self, key: str, policy: ResiliencePolicy) -> float:
+        value = self.quantile(key, policy.hedge_quantile, policy.min_samples)
+        if value is None:
+            return policy.hedge_default_delay
+        return max(policy.hedge_min_delay, value)
+
+
+def is_retriable(error: Exception) -> bool:
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError,
+                          openai.InternalServerError, EmptyCompletionError, AttemptTimeout)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
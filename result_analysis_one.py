@@ -1,5 +1,4 @@
 import pandas as pd
-import requests
 import json
 import os
 import time
@@ -7,7 +6,11 @@ import uuid
 import datetime
 import numpy as np
 import matplotlib.pyplot as plt
-import re  # <--- [新增] 引入正则模块
+from image_downloader import ImageDownloader, tasks_from_excel
+from batch_cli import items_from_excel, run_batch, export_json, resolve_prompt_version, previous_outputs
+from eval_core import (clean_tags, accuracy_overview, result_table, recall_stats, load_run,
+                       compare_stats)
+
 
 class ImageTagPipeline:
     def __init__(self, api_url="http://49.7.36.149:80/process_image_local"):
@@ -18,16 +21,7 @@ class ImageTagPipeline:
 
     # --- [辅助方法] 清洗标签 ---
     def _clean_tags(self, path_parts):
-        """
-        输入: ['10、节日与活动', '10.1 节日', '1、生日']
-        输出: ['节日与活动', '节日', '生日']
-        """
-        cleaned = []
-        for part in path_parts:
-            # 正则替换：去掉开头的数字、点、空格、顿号
-            new_part = re.sub(r'^[\d\.\s、]+', '', part)
-            cleaned.append(new_part)
-        return cleaned
+        return clean_tags(path_parts)
     # =========================================================================
     # 核心功能 1: JSON -> Excel (包含 3 个 Sheet: 原始数据, 统计, 概览)
     # =========================================================================
@@ -41,82 +35,20 @@ class ImageTagPipeline:
             return None
 
         try:
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            # 列式加载（解析结果带 Parquet 缓存），命中判断与统计均为向量化
+            run = load_run(json_path)
         except Exception as e:
             print(f"Error: 读取 JSON 失败 - {e}")
             return None
 
-        processed_rows = []
-        for entry in data:
-            image_path = entry.get('image_path', '')
-            image_url = entry.get('image_url', '')
-
-            # 解析 Level 3 标签
-            except_tags = self._clean_tags(entry.get('except_tags', []))
-            target_tag = except_tags[-1] if except_tags else ''
-
-            # 解析预测结果
-            process_result = entry.get('process_result') or {}
-            final_labels = process_result.get('final_labels') or process_result.get("res", {}).get("final_labels", [])
-            # 判断是否命中
-            is_included = '否'
-            if target_tag:
-                for label in final_labels:
-                    if target_tag in label:
-                        is_included = '是'
-                        break
-
-            total_labels_count = process_result.get('total_labels_count', "") or  process_result.get("res", {}).get("total_labels_count", "")
-            elapsed_time = process_result.get('elapsed_time', "") or process_result.get("res", {}).get("elapsed_time", "")
-            token_cost = process_result.get('token_cost', "") or process_result.get("res", {}).get("token_cost", "")
-            row = {
-                '路径名': image_path,
-                '路径URL': image_url,
-                '预测标签': '|'.join(final_labels),
-                '路径标签': target_tag,
-                '是否包含': is_included,
-                '标签数量': total_labels_count,
-                '耗时': elapsed_time,
-                'Token消耗': token_cost
-            }
-            processed_rows.append(row)
-
-        df_original = pd.DataFrame(processed_rows)
-
-        if df_original.empty:
+        if run.empty:
             print("Warning: 数据为空")
             return None
 
-        # --- 生成统计 Sheet ---
-        stats = df_original.groupby('路径标签').agg(
-            总数=('是否包含', 'count'),
-            匹配数=('是否包含', lambda x: (x == '是').sum())
-        ).reset_index()
-        stats['识别率'] = stats['匹配数'] / stats['总数']
-        stats['识别率(%)'] = (stats['识别率'] * 100).round(2).astype(str) + '%'
-
-        # --- 生成概览 Sheet ---
-        total_tags = len(stats)
-        rates = stats['识别率']
-        avg_acc = rates.mean() if total_tags > 0 else 0
-
-        def safe_rate(cond):
-            return (rates[cond].count() / total_tags) if total_tags > 0 else 0
-
-        summary_data = {
-            '统计项': ['平均准确度', '100%命中率占比', '70%-100%命中率占比', '50%-70%命中率占比', '0-50%命中率占比', '0命中率占比'],
-            '数值': [
-                avg_acc,
-                safe_rate(rates == 1.0),
-                safe_rate((rates >= 0.7) & (rates < 1.0)),
-                safe_rate((rates >= 0.5) & (rates < 0.7)),
-                safe_rate((rates > 0) & (rates < 0.5)),
-                safe_rate(rates == 0)
-            ]
-        }
-        df_summary = pd.DataFrame(summary_data)
-        df_summary['数值(格式化)'] = df_summary['数值'].apply(lambda x: f"{x:.2%}")
+        # --- 生成原始数据 / 统计 / 概览 Sheet ---
+        df_original = result_table(run)
+        stats = recall_stats(run, df_original['是否包含'] == '是')
+        df_summary = accuracy_overview(stats)
 
         # --- 保存 ---
         output_excel = os.path.splitext(json_path)[0] + '.xlsx'
@@ -134,133 +66,54 @@ class ImageTagPipeline:
     # =========================================================================
     # 核心功能 2: 下载图片
     # =========================================================================
-    def download_images(self, excel_path, save_root_dir='downloaded_images'):
+    def download_images(self, excel_path, save_root_dir='downloaded_images', per_host=8, max_edge=None):
         """
-        从 Excel 下载图片到本地。
+        从 Excel 并发下载图片到本地（按域名限流、断点续传、内容去重，见 image_downloader）。
+        max_edge 不为空时保存缩放后的模型输入同款图片。
         """
         print(f"[-] 开始下载图片: {excel_path}")
         if not os.path.exists(excel_path):
             return
 
-        try:
-            # 关键：使用 engine='openpyxl'
-            df = pd.read_excel(excel_path, sheet_name='原始数据', engine='openpyxl')
-        except Exception as e:
-            # 兼容如果只有一个 sheet 的情况
-            df = pd.read_excel(excel_path, index_col=None, engine='openpyxl')
-
-        if not os.path.exists(save_root_dir):
-            os.makedirs(save_root_dir)
-
-        count, fail = 0, 0
-        for _, row in df.iterrows():
-            url = row.get('路径URL')
-            rel_path = row.get('路径名')
-
-            if pd.isna(url) or pd.isna(rel_path): continue
-
-            # 构建本地路径 (去掉开头的 / 防止变为根目录)
-            local_path = os.path.join(save_root_dir, str(rel_path).lstrip('/'))
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
-
-            if os.path.exists(local_path): continue  # 跳过已下载
-
-            try:
-                resp = requests.get(url, timeout=10)
-                if resp.status_code == 200:
-                    with open(local_path, 'wb') as f:
-                        f.write(resp.content)
-                    count += 1
-                    if count % 10 == 0: print(f"    已下载 {count} 张...")
-                else:
-                    fail += 1
-            except:
-                fail += 1
-
-        print(f"[√] 下载完成: 成功 {count}, 失败 {fail}")
+        downloader = ImageDownloader(save_root_dir, per_host=per_host, max_edge=max_edge)
+        stats = downloader.download(tasks_from_excel(excel_path, save_root_dir))
+        print(f"[√] 下载完成: {stats.summary()}")
+        return stats
 
     # =========================================================================
     # 核心功能 3: 筛选低分标签并重测 (生成新 JSON)
     # =========================================================================
-    def retest_low_accuracy(self, excel_path = "images_result_with_labels_20260129_match_result.xlsx", threshold=0.6):
+    def retest_low_accuracy(self, excel_path = "images_result_with_labels_20260129_match_result.xlsx", threshold=0.6,
+                            rate=20):
         """
         筛选识别率 < threshold 的标签，调用接口重测，保存为新 JSON。
+        rate 为每秒最多请求数（默认 20，与原先逐条 sleep(0.05) 的节奏一致，None 表示不限）；
+        以往重测中已用当前 Prompt 版本跑过的图片直接复用，服务查不到版本时不复用。
         """
         print(f"[-] 开始重测流程 (阈值 < {threshold:.0%})")
         if not os.path.exists(excel_path): return None
 
         try:
-            # 读取统计表和原始数据，关键：engine='openpyxl'
-            df_stats = pd.read_excel(excel_path, sheet_name='识别率统计', engine='openpyxl')
-
-            # 尝试读取原始数据
-            xls = pd.ExcelFile(excel_path, engine='openpyxl')
-            sheet_name = '原始数据' if '原始数据' in xls.sheet_names else xls.sheet_names[0]
-            df_data = pd.read_excel(excel_path, sheet_name=sheet_name, engine='openpyxl')
-
+            # 筛选识别率 <= threshold 的标签对应的图片
+            items = items_from_excel(excel_path, threshold=threshold)
         except Exception as e:
             print(f"Error: 读取 Excel 失败 - {e}")
             return None
 
-        # 筛选标签
-        target_tags = df_stats[df_stats['识别率'] <= threshold]['路径标签'].tolist()
-        if not target_tags:
+        if not items:
             print("    没有低于该阈值的标签。")
             return None
+        print(f"    共需重测 {len(items)} 张图片。")
 
-        print(f"    目标标签 ({len(target_tags)}个): {target_tags[:5]}...")
-        target_rows = df_data[df_data['路径标签'].isin(target_tags)]
-        print(f"    共需重测 {len(target_rows)} 张图片。")
-
-        results_list = []
-        headers = {"Content-Type": "application/json"}
-
-        for idx, row in target_rows.iterrows():
-            image_url = row.get('路径URL')
-            image_path = row.get('路径名')
-
-            # 接口请求参数构造
-            image_info = image_url if pd.notna(image_url) and str(image_url).strip() else image_path
-
-            # 还原 except_tags 用于保持 JSON 结构
-            except_tags = str(image_path).split('/')[:-1] if isinstance(image_path, str) else []
-
-            payload = {
-                "image_info": image_info,
-                "task_id": str(uuid.uuid4())
-            }
-
-            entry = {
-                "image_name": os.path.basename(str(image_path)),
-                "image_path": image_path,
-                "image_url": image_url,
-                "except_tags": except_tags,
-                "process_result": {}
-            }
-
-            try:
-                # 调用接口
-                # print(f"    POST {self.api_url}...") 
-                resp = requests.post(self.api_url, json=payload, headers=headers, timeout=30)
-                if resp.status_code == 200:
-                    api_res = resp.json()
-                    entry['process_result'] = api_res.get('result', api_res)
-                else:
-                    entry['error'] = f"HTTP {resp.status_code}"
-            except Exception as e:
-                entry['error'] = str(e)
-
-            results_list.append(entry)
-            time.sleep(0.05)  # 限流
-
-            if len(results_list) % 10 == 0:
-                print(f"    进度: {len(results_list)}/{len(target_rows)}")
-
-        # 保存结果
+        # 并发 + 限速调用接口，结果逐条写入 .jsonl（支持断点续跑），再汇总为 JSON
         today = datetime.datetime.now().strftime('%Y%m%d')
         output_json = f"images_result_with_labels_{today}_retest.json"
-        with open(output_json, 'w', encoding='utf-8') as f:
-            json.dump(results_list, f, ensure_ascii=False, indent=4)
+        jsonl_path = output_json + "l"
+        prompt_version = resolve_prompt_version("api", self.api_url)
+        previous = previous_outputs("images_result_with_labels_*_retest.jsonl", jsonl_path, prompt_version)
+        run_batch(items, target="api", api_url=self.api_url, timeout=30, adaptive=True, output=jsonl_path, rate=rate,
+                  prompt_version=prompt_version, cache=previous)
+        export_json(jsonl_path, output_json)
 
         print(f"[√] 重测完成，结果已保存: {output_json}")
         return output_json
@@ -268,7 +121,20 @@ class ImageTagPipeline:
     # =========================================================================
     # 核心功能 4: 双 Excel 对比可视化
     # =========================================================================
+    def _load_stats(self, path):
+        """(识别率统计, 整体概览)；结果 JSON/JSONL 直接列式计算，不经过 Excel"""
+        if path.endswith(('.json', '.jsonl')):
+            stats = recall_stats(load_run(path))
+            return stats, accuracy_overview(stats)
+        stats = pd.read_excel(path, sheet_name='识别率统计', engine='openpyxl')
+        try:
+            summary = pd.read_excel(path, sheet_name='整体概览', engine='openpyxl')
+        except:
+            summary = None
+        return stats, summary
+
     def compare_two_excels(self, old_excel_path, new_excel_path, top_n=30):
+        """两个参数既可以是 json_to_excel 生成的 Excel，也可以直接是结果 JSON/JSONL"""
         print(f"[-] 开始对比分析: {old_excel_path} vs {new_excel_path}")
 
         if not (os.path.exists(old_excel_path) and os.path.exists(new_excel_path)):
@@ -276,24 +142,14 @@ class ImageTagPipeline:
             return
 
         try:
-            df_old_stats = pd.read_excel(old_excel_path, sheet_name='识别率统计', engine='openpyxl')
-            df_new_stats = pd.read_excel(new_excel_path, sheet_name='识别率统计', engine='openpyxl')
-
-            try:
-                df_old_summary = pd.read_excel(old_excel_path, sheet_name='整体概览', engine='openpyxl')
-                df_new_summary = pd.read_excel(new_excel_path, sheet_name='整体概览', engine='openpyxl')
-                has_summary = True
-            except:
-                has_summary = False
+            df_old_stats, df_old_summary = self._load_stats(old_excel_path)
+            df_new_stats, df_new_summary = self._load_stats(new_excel_path)
+            has_summary = df_old_summary is not None and df_new_summary is not None
         except Exception as e:
             print(f"Error: 读取 Excel 失败 - {e}")
             return
 
-        df_old_stats = df_old_stats[['路径标签', '识别率']].rename(columns={'识别率': 'acc_old'})
-        df_new_stats = df_new_stats[['路径标签', '识别率']].rename(columns={'识别率': 'acc_new'})
-
-        merged = pd.merge(df_old_stats, df_new_stats, on='路径标签', how='inner')
-        merged['improvement'] = merged['acc_new'] - merged['acc_old']
+        merged = compare_stats(df_old_stats, df_new_stats)
 
         detail_file = "comparison_full_detail.xlsx"
         merged.to_excel(detail_file, index=False, engine='openpyxl')
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : result_cache.py
+# @Usage   : 打标结果的跨进程共享缓存（SQLite WAL），多 worker 部署时共用一份
+"""
+同一张图片（同一 URL / 同一本地文件）在同一版 Prompt 下的打标结果可以直接复用。
+多 worker 部署时各进程内存不共享，这里用一个本地 SQLite 文件做共享缓存：
+
+- WAL 模式，读不阻塞写；每个进程、每个线程各自一个连接（fork 之后重新打开，不复用父进程的连接）；
+- 键为 ``sha256(PROMPT_VERSION | 图片来源)``，本地文件额外带上 mtime 与大小，Prompt/Schema 变化后自动失效；
+  URL 只按字符串匹配，同一 URL 的内容被替换时无法感知，因此所有记录都必须有过期时间；
+- 只缓存完整成功（非降级、无失败节点，输出解析失败的节点也记为失败）的结果；SQLite 出错时按未命中处理，缓存问题不影响请求。
+
+环境变量：
+    RESULT_CACHE_PATH         缓存文件路径，为空（默认）表示不启用
+    RESULT_CACHE_TTL          过期时间（秒），默认 86400，必须大于 0
+    RESULT_CACHE_MAX_ENTRIES  最多保留条数，默认 200000，超出时淘汰最旧的记录
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from logger import get_logger
+
+logger = get_logger(service="result_cache")
+
+PRUNE_EVERY = 1000  # 每个进程每写入这么多条清理一次过期/超量记录
+
+
+def cache_key(image_info: str, prompt_version: str) -> str:
+    source = image_info.strip()
+    if not source.lower().startswith(("http://", "https://")) and os.path.exists(source):
+        stat = os.stat(source)
+        source = f"{os.path.abspath(source)}|{stat.st_mtime_ns}|{stat.st_size}"
+    return hashlib.sha256(f"{prompt_version}|{source}".encode("utf-8")).hexdigest()
+
+
+def is_cacheable(result: dict) -> bool:
+    return result.get("status") == "success" and not result.get("degraded") and not result.get("failed_nodes")
+
+
+class ResultCache:
+    def __init__(self, path: str, ttl: float = 86400, max_entries: int = 200000):
+        if ttl <= 0:
+            raise ValueError("RESULT_CACHE_TTL 必须大于 0：同一 URL 的内容可能变化，缓存不能永不过期")
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._puts = 0
+
+    @classmethod
+    def from_env(cls):
+        """RESULT_CACHE_PATH 为空时返回 None（不启用缓存）"""
+        path = os.getenv("RESULT_CACHE_PATH", "")
+        if not path:
+            return None
+        return cls(path, ttl=float(os.getenv("RESULT_CACHE_TTL", "86400")),
+                   max_entries=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "200000")))
+
+    def _conn(self) -> sqlite3.Connection:
+        # 连接按 (进程, 线程) 隔离：fork 出来的 worker 不能沿用父进程打开的连接
+        pid, conn = getattr(self._local, "conn", (None, None))
+        if pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, prompt_version TEXT, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_results_created_at ON results(created_at)")
+            self._local.conn = (os.getpid(), conn)
+        return conn
+
+    def get(self, key: str):
+        try:
+            row = self._conn().execute("SELECT value, created_at FROM results WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"结果缓存读取失败，按未命中处理：{e}")
+            return None
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key: str, prompt_version: str, value: dict):
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO results (key, prompt_version, value, created_at) VALUES (?, ?, ?, ?)",
+                (key, prompt_version, json.dumps(value, ensure_ascii=False), time.time()),
+            )
+            self._puts += 1
+            if self._puts % PRUNE_EVERY == 0:
+                self.prune()
+        except sqlite3.Error as e:
+            logger.warning(f"结果缓存写入失败：{e}")
+
+    def prune(self) -> int:
+        """删除过期记录，并只保留最新的 max_entries 条"""
+        conn = self._conn()
+        removed = conn.execute("DELETE FROM results WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+        if self.max_entries > 0:
+            removed += conn.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        if removed:
+            logger.info(f"结果缓存清理 {removed} 条")
+        return removed
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM results").fetchone()[0]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : scheduler.py
+# @Usage   : VLM 后端前的优先级调度：交互流量预留容量 + 加权公平排队
+"""
+同一个 ``/process_image`` 既服务用户实时上传，也服务批量回刷脚本。
+``PriorityScheduler`` 管理 VLM 调用的并发槽位（所有后端共享）：
+
+- ``interactive`` 可以使用全部 ``capacity`` 个槽位；
+- ``batch`` 最多使用 ``capacity - reserved`` 个，剩下的槽位始终留给交互请求；
+- 两类请求都在排队时，按权重做 stride 调度（默认 4:1），batch 不会被完全饿死；
+- 某一类空闲时，另一类可以吃满自己的上限，夜间回刷能把 GPU 跑满。
+
+排队时间按类别记录到 ``tagging_queue_wait_seconds{stage="scheduler.<priority>"}``。
+"""
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import record_queue_wait
+from resilience import DeadlineExceeded
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+DEFAULT_WEIGHTS = {INTERACTIVE: 4, BATCH: 1}
+
+
+class _Waiter:
+    __slots__ = ("priority", "event", "granted")
+
+    def __init__(self, priority: str):
+        self.priority = priority
+        self.event = threading.Event()
+        self.granted = False
+
+
+class PriorityScheduler:
+    def __init__(self, capacity: int, reserved_interactive: int = 0, weights: dict = None):
+        if capacity <= 0:
+            raise ValueError("capacity 必须大于 0")
+        self.capacity = capacity
+        self.reserved = min(max(reserved_interactive, 0), capacity - 1)
+        self.weights = dict(weights or DEFAULT_WEIGHTS)
+        self._lock = threading.Lock()
+        self._queues = {p: deque() for p in self.weights}
+        self._in_use = {p: 0 for p in self.weights}
+        self._pass = {p: 0.0 for p in self.weights}
+        self._vtime = 0.0
+
+    @classmethod
+    def from_env(cls):
+        """VLM_MAX_CONCURRENCY<=0 时返回 None，表示不调度"""
+        capacity = int(os.getenv("VLM_MAX_CONCURRENCY", "64"))
+        if capacity <= 0:
+            return None
+        reserved = int(os.getenv("VLM_INTERACTIVE_RESERVED", str(capacity // 4)))
+        return cls(capacity, reserved)
+
+    def _limit(self, priority: str) -> int:
+        return self.capacity if priority == INTERACTIVE else self.capacity - self.reserved
+
+    def _dispatch(self):
+        """在锁内调用：把空闲槽位按权重分给排队者"""
+        while sum(self._in_use.values()) < self.capacity:
+            eligible = [p for p, q in self._queues.items() if q and self._in_use[p] < self._limit(p)]
+            if not eligible:
+                return
+            priority = min(eligible, key=lambda p: self._pass[p])
+            waiter = self._queues[priority].popleft()
+            self._in_use[priority] += 1
+            self._vtime = self._pass[priority]
+            self._pass[priority] += 1.0 / self.weights[priority]
+            waiter.granted = True
+            waiter.event.set()
+
+    def _release(self, priority: str):
+        with self._lock:
+            self._in_use[priority] -= 1
+            self._dispatch()
+
+    def acquire(self, priority: str = INTERACTIVE, deadline: float = None) -> str:
+        """
+        阻塞直到拿到一个槽位，返回实际使用的类别（未知类别按 interactive 处理），用完后调用 release
+        deadline 为 time.monotonic() 时间戳，排队到截止时间仍未轮到则抛出 DeadlineExceeded
+        """
+        if priority not in self._queues:
+            priority = INTERACTIVE
+        waiter = _Waiter(priority)
+        start = time.perf_counter()
+        with self._lock:
+            queue = self._queues[priority]
+            if not queue and not self._in_use[priority]:
+                # 空闲后重新进入的类别不能攒下"历史额度"
+                self._pass[priority] = max(self._pass[priority], self._vtime)
+            queue.append(waiter)
+            self._dispatch()
+
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not waiter.event.wait(timeout):
+            with self._lock:
+                if not waiter.granted:
+                    self._queues[priority].remove(waiter)
+                    raise DeadlineExceeded("排队等待 VLM 槽位超出请求预算")
+        record_queue_wait(f"scheduler.{priority}", time.perf_counter() - start)
+        return priority
+
+    def try_acquire(self, priority: str = INTERACTIVE):
+        """不排队：有空闲槽位且本类别没人在等时立即占用并返回类别，否则返回 None（对冲请求用）"""
+        if priority not in self._queues:
+            priority = INTERACTIVE
+        with self._lock:
+            if (self._queues[priority] or self._in_use[priority] >= self._limit(priority)
+                    or sum(self._in_use.values()) >= self.capacity):
+                return None
+            self._in_use[priority] += 1
+            return priority
+
+    def release(self, priority: str):
+        self._release(priority)
+
+    @contextmanager
+    def slot(self, priority: str = INTERACTIVE, deadline: float = None):
+        """占用一个 VLM 并发槽位，退出时释放"""
+        priority = self.acquire(priority, deadline)
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "reserved_interactive": self.reserved,
+                "in_use": dict(self._in_use),
+                "queued": {p: len(q) for p, q in self._queues.items()},
+            }
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : schema_registry.py
+# @Usage   : Guided Decoding 用的 JSON Schema 注册表 + 后端 grammar 预热
+"""
+每个 Pydantic Schema 在启动时只序列化一次，并按规范化 JSON 计算稳定哈希：
+
+- 节点调用时直接复用同一个 dict，不再每次跑 ``model_json_schema()``；
+- 哈希可用于日志、缓存 key 和 prompt 版本号，Schema 任意字段变化都会改变它；
+- ``schema_stub_output`` 按 Schema 生成确定性的合法输出，供离线替身引擎和 mock vLLM 服务使用。
+
+vLLM 对每个后端、每种 Schema 第一次请求时才编译 guided-decoding grammar，
+上线后的首批请求会明显变慢。``warmup_guided_decoding`` 在服务启动时
+向每个后端把每种 Schema 各发一次极小的请求，让 grammar 缓存提前就绪。
+"""
+import io
+import json
+import base64
+import hashlib
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import get_logger
+from metrics import current_node
+
+logger = get_logger(service="schema_registry")
+
+
+@dataclass(frozen=True)
+class SchemaEntry:
+    name: str
+    schema: dict
+    canonical: str
+    hash: str
+
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def register_schema(schema_cls) -> SchemaEntry:
+    """注册（或取回已注册的）Schema，同一个类只序列化一次"""
+    entry = _registry.get(schema_cls)
+    if entry is not None:
+        return entry
+    with _lock:
+        entry = _registry.get(schema_cls)
+        if entry is None:
+            schema = schema_cls.model_json_schema()
+            canonical = json.dumps(schema, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+            entry = SchemaEntry(
+                name=schema_cls.__name__,
+                schema=schema,
+                canonical=canonical,
+                hash=hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16],
+            )
+            _registry[schema_cls] = entry
+    return entry
+
+
+def registered_schemas() -> list:
+    return list(_registry.values())
+
+
+def schema_stub_output(schema: dict, seed: str, _root: dict = None) -> dict:
+    """按 Schema 生成确定性的合法输出：数组枚举按 seed 取一个值，字符串固定为 stub，嵌套对象（$ref）递归生成"""
+    root = _root or schema
+    digest = int(hashlib.md5(seed.encode("utf-8")).hexdigest(), 16)
+    data = {}
+    for i, (name, prop) in enumerate(schema.get("properties", {}).items()):
+        if "$ref" in prop:
+            # 只有本地引用 "#/$defs/Name"
+            prop = root.get("$defs", {}).get(prop["$ref"].rsplit("/", 1)[-1], {})
+        enum = prop.get("items", {}).get("enum") if prop.get("type") == "array" else None
+        if enum:
+            data[name] = [enum[(digest >> i) % len(enum)]]
+        elif "properties" in prop:
+            data[name] = schema_stub_output(prop, f"{seed}/{name}", root)
+        elif prop.get("type") == "string":
+            data[name] = "stub"
+        else:
+            data[name] = prop.get("default", [])
+    return data
+
+
+def _warmup_image() -> str:
+    """64x64 灰图，视觉 token 极少，只为触发 grammar 编译"""
+    from PIL import Image
+    buffered = io.BytesIO()
+    Image.new("RGB", (64, 64), (128, 128, 128)).save(buffered, format="JPEG")
+    return f"data:image/jpeg;base64,{base64.b64encode(buffered.getvalue()).decode('utf-8')}"
+
+
+def warmup_guided_decoding(model, entries=None, max_workers: int = 8, backends: list = None) -> dict:
+    """
+    对 model 的每个本地后端（或 backends 指定的后端）、每个 Schema 各发一次请求（单次尝试，结果只归属该后端）
+    返回 {(backend_index, schema_name): 是否成功}
+    """
+    entries = entries if entries is not None else registered_schemas()
+    image = _warmup_image()
+    backends = backends if backends is not None else range(len(model.local_clients))
+    jobs = [(idx, entry) for idx in backends for entry in entries]
+
+    def _run(job):
+        idx, entry = job
+        token = current_node.set("warmup")
+        try:
+            # 单次直连该后端，结果只归属该后端
+            model.warmup_attempt(idx, image, schema=entry.schema, max_tokens=8)
+            return job, True
+        except Exception as e:
+            logger.warning(f"grammar 预热失败 backend={idx} schema={entry.name}: {e}")
+            return job, False
+        finally:
+            current_node.reset(token)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for (idx, entry), ok in executor.map(_run, jobs):
+            results[(idx, entry.name)] = ok
+            logger.info(f"{'✅' if ok else '⚠️'} grammar 预热 backend={idx} schema={entry.name}({entry.hash})")
+    return results
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : sweep_eval.py
+# @Usage   : 配置网格扫描：同一评测集上对比各配置的识别率与延迟/Token/成本，输出 Pareto 前沿
+"""
+调参不再靠"改 Prompt -> 跑批 -> json_to_excel -> 肉眼看"。本脚本在评测集上跑一组配置网格：
+
+- ``max_edge``：所有节点统一的输入长边（不指定时用各节点自己的 max_edge）；
+- ``one_pass``：多节点（一级分类 -> 门控细节，与线上一致）或 One-Pass（所有节点合并成一次调用，README 方案一）；
+- 逐节点模型：``--node-model second_level_person=ModelA|ModelB``，后端需以 ``--served-model-name`` 加载这些模型；
+- ``temperature`` 与 ``max_tokens``（单节点预算，One-Pass 按节点数放大）。
+
+识别率的口径与 ``ImageTagPipeline.json_to_excel`` 完全一致（共用 ``eval_core`` 中的统计函数）：
+期望标签取最后一级，预测标签任一包含它即命中，"平均准确度"为各标签识别率的均值。
+同时统计单图延迟 p50/p95、Token 与成本，在 (平均准确度↑, 延迟↓) 上求 Pareto 前沿，
+并给出满足 ``--target-accuracy`` 的最快配置。
+
+每个配置的逐图结果保存为 ``<output-dir>/<配置名>.json``（与重测 JSON 同格式，可直接 json_to_excel），
+重跑时已有结果的配置直接复用。
+
+运行示例：
+    python sweep_eval.py --source folder --input ./评测集 --max-edges 512,768,1024 --one-pass both --target-accuracy 0.8
+    python sweep_eval.py --source json --input eval.json --temperatures 0,0.1,0.7 --max-tokens 256,512 \\
+        --node-model second_level_person=Qwen3-VL-4B|Qwen3-VL-8B
+"""
+import os
+import json
+import time
+import argparse
+import itertools
+from dataclasses import dataclass, replace
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from logger import get_logger
+from model import TAGGING_TEMPERATURE
+from node_registry import (NODE_SPECS, FIRST_LEVEL_SPEC, PROMPT_VERSION, select_image, response_update,
+                           parse_model_json, build_one_pass_spec, split_one_pass_result)
+from resilience import LatencyTracker
+from tagging_state import Usage, DEFAULT_PRICING, new_state
+from tag_format import format_output
+from offline_engine import apply_update, failed_result
+from utils import encode_image_variants
+from batch_cli import SOURCES
+from eval_core import frame_from_records, hit_mask, recall_stats, accuracy_overview
+
+logger = get_logger(service="sweep_eval")
+
+# 节点级调用共用的线程池（外层按图片并发，内层按节点并发）
+_node_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SWEEP_NODE_WORKERS", "64")), thread_name_prefix="sweep")
+
+
+@dataclass(frozen=True)
+class SweepConfig:
+    max_edge: int = None              # None：各节点用自己的 max_edge
+    one_pass: bool = False
+    node_models: tuple = ()           # ((节点名, 模型名), ...)；One-Pass 时节点名为 "one_pass"
+    temperature: float = TAGGING_TEMPERATURE
+    max_tokens: int = 512
+
+    @property
+    def name(self) -> str:
+        parts = [f"edge{self.max_edge or 'default'}", "onepass" if self.one_pass else "multi",
+                 f"t{self.temperature:g}", f"tok{self.max_tokens}"]
+        parts += [f"{node}={os.path.basename(model.rstrip('/'))}" for node, model in self.node_models]
+        return "_".join(parts)
+
+    def model_for(self, node: str):
+        return dict(self.node_models).get(node)
+
+
+def expand_grid(max_edges: list, one_pass_modes: list, temperatures: list, max_tokens: list,
+                node_model_options: dict = None) -> list:
+    """笛卡尔积；One-Pass 只有一次调用，只保留 "one_pass" 的模型选项，重复配置去重"""
+    node_model_options = node_model_options or {}
+    nodes = sorted(node_model_options)
+    configs = []
+    for edge, one_pass, temperature, tokens in itertools.product(max_edges, one_pass_modes, temperatures, max_tokens):
+        for models in itertools.product(*(node_model_options[n] for n in nodes)):
+            pairs = tuple((n, m) for n, m in zip(nodes, models) if (n == "one_pass") == one_pass)
+            config = SweepConfig(edge, one_pass, pairs, temperature, tokens)
+            if config not in configs:
+                configs.append(config)
+    return configs
+
+
+# ==========================================
+# 单配置打标
+# ==========================================
+class ConfigTagger:
+    """按配置对单张图片打标，返回与 process_single_image 同结构的结果（另含 Token 明细）"""
+    def __init__(self, config: SweepConfig, model):
+        self.config = config
+        self.model = model
+        self.specs = [replace(spec, max_edge=config.max_edge) if config.max_edge else spec for spec in NODE_SPECS]
+        self.first = next(s for s in self.specs if s.output_key == FIRST_LEVEL_SPEC.output_key)
+        self.roots = [s for s in self.specs if s is not self.first and not s.subjects]
+        self.gated = [s for s in self.specs if s.subjects]
+        self.one_pass_spec = build_one_pass_spec(tuple(self.specs)) if config.one_pass else None
+        self.max_edges = sorted({s.max_edge for s in self.specs})
+
+    def _call(self, state: dict, spec) -> dict:
+        # max_tokens 是单节点预算；One-Pass 一次输出所有节点，预算按节点数放大，避免 JSON 被截断
+        max_tokens = self.config.max_tokens * (len(self.specs) if spec is self.one_pass_spec else 1)
+        return self.model.call_qwen_new(
+            select_image(state, spec), spec.prompt, schema=spec.schema_json, max_tokens=max_tokens,
+            priority="batch", temperature=self.config.temperature, model_name=self.config.model_for(spec.name),
+        )
+
+    def _run_phase(self, state: dict, specs: list):
+        specs = [s for s in specs if s.is_gated_in(state["node_results"])]
+        for spec, response in zip(specs, _node_executor.map(lambda s: self._call(state, s), specs)):
+            apply_update(state, response_update(spec, response))
+
+    def _run_one_pass(self, state: dict):
+        spec = self.one_pass_spec
+        response = self._call(state, spec)
+        state["usage"] = state["usage"] + Usage.from_response(response)
+        if "error" in response:
+            state["failed_nodes"] = state["failed_nodes"] + [spec.name]
+            return
+        state["node_results"] = split_one_pass_result(parse_model_json(response["content"]), tuple(self.specs))
+
+    def tag(self, image_info: str) -> dict:
+        start = time.perf_counter()
+        try:
+            variants = encode_image_variants(image_info.strip(), self.max_edges)
+        except Exception as e:
+            return failed_result(image_info, str(e))
+        state = new_state(variants[self.first.max_edge], priority="batch")
+        if len(variants) > 1:
+            state["image_variants"] = variants
+        if self.one_pass_spec is not None:
+            self._run_one_pass(state)
+        else:
+            self._run_phase(state, [self.first] + self.roots)
+            self._run_phase(state, self.gated)
+        state.update(format_output(state))
+        usage = state["usage"]
+        return {
+            "image_info": image_info,
+            "final_labels": state["final_labels"],
+            "total_labels_count": len(state["final_labels"]),
+            "elapsed_time": round(time.perf_counter() - start, 3),
+            "token_cost": round(DEFAULT_PRICING.cost(usage), 6),
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "calls": usage.calls,
+            "status": "success",
+            "failed_nodes": state["failed_nodes"],
+            "degraded": state["degraded"],
+            "prompt_version": PROMPT_VERSION,
+            "error": "",
+        }
+
+
+def _is_current(records: list) -> bool:
+    """已有结果是否由当前 Prompt 版本产出（旧文件没有 prompt_version 字段，一律视为过期）"""
+    return all((r.get("process_result") or {}).get("prompt_version") == PROMPT_VERSION for r in records)
+
+
+def evaluate_config(config: SweepConfig, items: list, model, concurrency: int = 8,
+                    output_dir: str = "sweep_results", resume: bool = True) -> list:
+    """
+    跑完一个配置，逐图记录写入 <output_dir>/<配置名>.json
+    已存在且 resume 时，只有全部记录的 prompt_version 与当前一致才复用，改过 Prompt/Schema 后自动重跑
+    """
+    path = os.path.join(output_dir, f"{config.name}.json")
+    if resume and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+        if _is_current(records):
+            logger.info(f"复用已有结果：{path}")
+            return records
+        logger.info(f"已有结果不是当前 Prompt 版本 {PROMPT_VERSION}，重新跑：{path}")
+    # 每个配置的耗时分布不同（分辨率、模型），不沿用上一个配置学到的延迟分位数
+    model.latency_tracker = LatencyTracker()
+    tagger = ConfigTagger(config, model)
+    logger.info(f"🚀 配置 {config.name}：{len(items)} 张图片")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda item: tagger.tag(item.image_info), items))
+    records = [{**item.entry, "image_info": item.image_info, "process_result": result}
+               for item, result in zip(items, results)]
+    os.makedirs(output_dir, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False, indent=2)
+    return records
+
+
+# ==========================================
+# 汇总与 Pareto 前沿
+# ==========================================
+def summarize_config(config: SweepConfig, records: list) -> tuple:
+    """返回 (汇总行, 识别率统计表)；识别率口径与 json_to_excel 相同"""
+    run = frame_from_records(records)
+    hits = hit_mask(run)
+    stats = recall_stats(run, hits)
+    overview = accuracy_overview(stats)
+    results = [r["process_result"] for r in records]
+    ok = [r for r in results if r.get("status") == "success"]
+    latencies = pd.Series([r["elapsed_time"] for r in ok], dtype=float)
+    row = {
+        "配置": config.name,
+        "max_edge": config.max_edge or "default",
+        "one_pass": config.one_pass,
+        "temperature": config.temperature,
+        "max_tokens": config.max_tokens,
+        "节点模型": ";".join(f"{n}={m}" for n, m in config.node_models),
+        "图片数": len(records),
+        "失败数": len(results) - len(ok),
+        "降级数": sum(1 for r in ok if r.get("degraded")),
+        "平均准确度": float(overview.loc[overview['统计项'] == '平均准确度', '数值'].iloc[0]),
+        "整体命中率": float(hits.mean()) if len(hits) else 0.0,
+        "p50延迟(s)": round(float(latencies.quantile(0.5)), 3) if len(latencies) else None,
+        "p95延迟(s)": round(float(latencies.quantile(0.95)), 3) if len(latencies) else None,
+        "平均延迟(s)": round(float(latencies.mean()), 3) if len(latencies) else None,
+        "平均调用数": round(sum(r.get("calls", 0) for r in ok) / max(len(ok), 1), 2),
+        "平均输入Token": round(sum(r.get("prompt_tokens", 0) for r in ok) / max(len(ok), 1), 1),
+        "平均输出Token": round(sum(r.get("completion_tokens", 0) for r in ok) / max(len(ok), 1), 1),
+        "平均成本": round(sum(r.get("token_cost", 0.0) for r in ok) / max(len(ok), 1), 6),
+    }
+    return row, stats
+
+
+def pareto_frontier(summary: pd.DataFrame, accuracy_col: str = "平均准确度", latency_col: str = "p50延迟(s)") -> pd.Series:
+    """不被任何配置支配（准确度不低且延迟不高、至少一项严格更好）的配置为 True"""
+    values = summary[[accuracy_col, latency_col]].to_numpy(dtype=float)
+    flags = []
+    for acc, lat in values:
+        dominated = any(
+            (a >= acc and l <= lat) and (a > acc or l < lat)
+            for a, l in values
+        )
+        flags.append(not dominated)
+    return pd.Series(flags, index=summary.index)
+
+
+def run_sweep(configs: list, items: list, model, concurrency: int = 8, output_dir: str = "sweep_results",
+              resume: bool = True, latency_metric: str = "p50", target_accuracy: float = None) -> tuple:
+    # 对冲会把慢请求转到另一个后端，各配置的延迟不再只取决于配置本身，扫描时关闭
+    model.policy = replace(model.policy, hedge=False)
+    rows, per_tag = [], {}
+    for config in configs:
+        row, stats = summarize_config(config, evaluate_config(config, items, model, concurrency, output_dir, resume))
+        rows.append(row)
+        per_tag[config.name] = stats.set_index('路径标签')['识别率']
+        logger.info(f"✅ {config.name}：平均准确度 {row['平均准确度']:.2%}，p50 {row['p50延迟(s)']}s，"
+                    f"平均成本 {row['平均成本']}")
+
+    latency_col = {"p50": "p50延迟(s)", "p95": "p95延迟(s)", "mean": "平均延迟(s)"}[latency_metric]
+    summary = pd.DataFrame(rows)
+    summary["Pareto"] = pareto_frontier(summary, latency_col=latency_col)
+    summary = summary.sort_values(latency_col).reset_index(drop=True)
+    tag_matrix = pd.DataFrame(per_tag).rename_axis('路径标签').reset_index()
+
+    best = None
+    if target_accuracy is not None:
+        qualified = summary[summary["平均准确度"] >= target_accuracy]
+        best = qualified.iloc[0]["配置"] if not qualified.empty else None
+    return summary, tag_matrix, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="打标配置网格扫描（识别率 vs 延迟/成本）")
+    parser.add_argument("--source", choices=sorted(SOURCES), default="folder")
+    parser.add_argument("--input", required=True, help="评测集：图片目录 / 标注 JSON / 分析 Excel")
+    parser.add_argument("--limit", type=int, default=None, help="只取评测集前 N 张，快速试跑")
+    parser.add_argument("--max-edges", default="", help="逗号分隔，如 512,768,1024；默认用各节点自己的配置")
+    parser.add_argument("--one-pass", choices=["off", "on", "both"], default="off")
+    parser.add_argument("--temperatures", default=str(TAGGING_TEMPERATURE))
+    parser.add_argument("--max-tokens", default="512")
+    parser.add_argument("--node-model", action="append", default=[],
+                        help="节点=模型1|模型2，可重复；One-Pass 的节点名为 one_pass")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时处理的图片数")
+    parser.add_argument("--output-dir", default="sweep_results")
+    parser.add_argument("--no-resume", action="store_true", help="忽略已有结果，全部重跑")
+    parser.add_argument("--latency-metric", choices=["p50", "p95", "mean"], default="p50")
+    parser.add_argument("--target-accuracy", type=float, default=None)
+    parser.add_argument("--excel", default=None, help="汇总 Excel 路径，默认 <output-dir>/sweep_summary.xlsx")
+    args = parser.parse_args()
+
+    items = SOURCES[args.source](args.input)
+    if args.limit:
+        items = items[:args.limit]
+    max_edges = [int(e) for e in args.max_edges.split(",") if e.strip()] or [None]
+    one_pass_modes = {"off": [False], "on": [True], "both": [False, True]}[args.one_pass]
+    node_model_options = {}
+    for spec in args.node_model:
+        node, models = spec.split("=", 1)
+        node_model_options[node.strip()] = [m.strip() for m in models.split("|") if m.strip()]
+    configs = expand_grid(max_edges, one_pass_modes, [float(t) for t in args.temperatures.split(",")],
+                          [int(t) for t in args.max_tokens.split(",")], node_model_options)
+    logger.info(f"评测集 {len(items)} 张图片，共 {len(configs)} 个配置")
+
+    from model import CallVLMModel
+    summary, tag_matrix, best = run_sweep(configs, items, CallVLMModel(), args.concurrency, args.output_dir,
+                                          not args.no_resume, args.latency_metric, args.target_accuracy)
+
+    excel_path = args.excel or os.path.join(args.output_dir, "sweep_summary.xlsx")
+    with pd.ExcelWriter(excel_path, engine='openpyxl') as writer:
+        summary.to_excel(writer, sheet_name='配置汇总', index=False)
+        summary[summary["Pareto"]].to_excel(writer, sheet_name='Pareto前沿', index=False)
+        tag_matrix.to_excel(writer, sheet_name='标签识别率', index=False)
+
+    print("\n===== Pareto 前沿（按延迟排序）=====")
+    for _, r in summary[summary["Pareto"]].iterrows():
+        print(f"{r['配置']:<48} 平均准确度 {r['平均准确度']:.2%}  p50 {r['p50延迟(s)']}s  "
+              f"p95 {r['p95延迟(s)']}s  平均成本 {r['平均成本']}")
+    if args.target_accuracy is not None:
+        print(f"\n满足平均准确度 ≥ {args.target_accuracy:.0%} 的最快配置：{best or '无'}")
+    print(f"[√] 汇总已保存: {excel_path}")
+
+
+if __name__ == "__main__":
+    main()
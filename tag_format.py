@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : tag_format.py
+# @Usage   : 标签白名单 + 节点结果到最终标签的格式化
+"""
+``format_output`` 只依赖图状态里的 ``node_results`` / ``failed_nodes`` / ``skipped_nodes``，
+在线服务（LangGraph 汇聚节点）和离线批量引擎（offline_engine.py）共用同一份实现，
+保证两条链路产出的 ``final_labels`` 一致。
+"""
+from logger import get_logger
+from node_registry import NODE_SPECS
+from tagging_state import ImageTaggingState
+
+logger = get_logger(service="lg_builder")
+
+# 白名单保持不变，用于最后的合法性校验
+TAG_WHITELIST = {
+    "主体": ["人像", "动物（宠物）", "植物", "风景", "食物", "建筑"],
+    "人像": {
+        "性别": ["男性", "女性"],
+        "年龄": ["儿童", "少年", "青年", "中年", "老年"],
+        "人数": ["单人", "多人"],
+        "拍摄方式": ["自拍", "他拍", "合影"],
+        "构图": ["全身", "半身", "面部特写"],
+        "角度": ["正面", "侧面", "背影"],
+        "用途": ["生活照", "证件照", "情侣照"],
+        "发型长度": ["长发", "短发"],
+        "发型直卷": ["卷发", "直发"],
+        "发型形式": ["扎发", "披发"],
+        "表情": ["微笑", "大笑", "严肃", "闭眼"],
+        "姿态": ["坐姿", "站立"],
+        "服饰": {
+            "基本款式": ["西装", "职业装", "T恤", "衬衫", "毛衣", "羽绒服", "裙子", "运动装", "睡衣", "校服", "婚纱", "泳装"],
+            "题材": ["cosplay", "lolita", "jk", "旗袍", "新中式", "民族服装", "夏装", "冬装", "春秋装"],
+            "风格": ["休闲风", "街头风", "正式风", "学院风"],
+            # === 新增：饰品和眼镜全归类到服饰下 ===
+            "饰品": ["帽子", "口罩", "耳环", "项链", "发饰", "围巾"],
+            "眼镜": ["眼镜", "否"]
+        }
+    },
+    "动物（宠物）": {
+        "种类": ["狗", "猫", "鸟", "鱼", "兔子", "其他"],
+        "数量": ["单只", "多只"],
+        "视角与状态": ["宠物正面", "宠物全身", "室内宠物图", "户外宠物图"]
+    },
+    "食物": {
+        "食物类型": ["中餐", "西餐", "甜品", "奶茶", "火锅", "水果", "烧烤", "主菜", "小吃", "饮品"],
+        "拍摄场景": ["桌面摆盘", "俯拍", "特写", "居家烹饪", "餐厅环境"]
+    },
+    "风景": {
+        "地貌场景": ["海边", "山脉", "森林", "草原", "沙漠", "瀑布", "湖泊", "花海", "峡谷"],
+        "城市天空": ["天空", "城市夜景", "日落", "星空"],
+        "季节相关": ["春季", "夏季", "秋季", "冬季"]
+    },
+    "场景": {
+        "空间": ["室内", "室外"],
+        "场所类型": ["自然", "家居", "餐厅", "健身房", "游乐园", "音乐节", "KTV", "演唱会"],
+        "时间": ["白天", "夜晚"],
+        "天气": ["晴天", "阴天", "多云", "雨天", "雪天", "雾天", "彩虹"],
+        "光线": ["自然光", "逆光"],
+        "特殊元素": ["烟花", "圣诞树", "气球", "彩带", "蛋糕", "粽子", "元宵", "月饼", "礼物盒"],
+        "水印": ["水印"],
+        "图片质量": ["无路人", "有路人", "老照片"],
+        "节日": ["生日", "婚礼", "圣诞", "春节", "中秋", "端午", "万圣节", "国庆"]
+    }
+}
+
+
+# ==========================================
+# 标签校验与格式化
+# ==========================================
+def is_tag_legal(tag_str: str) -> bool:
+    tag_parts = tag_str.split("-")
+    if len(tag_parts) < 2: return False
+    
+    if tag_parts[0] == "主体" and len(tag_parts) == 2:
+        return tag_parts[1] in TAG_WHITELIST.get("主体", [])
+    
+    if tag_parts[0] == "人像" and tag_parts[1] == "服饰" and len(tag_parts) == 4:
+        _, _, cloth_type, cloth_value = tag_parts
+        return TAG_WHITELIST["人像"]["服饰"].get(cloth_type, []).count(cloth_value) > 0
+    
+    if len(tag_parts) == 3:
+        main_type, sub_type, value = tag_parts
+        if main_type not in TAG_WHITELIST: return False
+        if main_type == "人像" and sub_type != "服饰":
+            return TAG_WHITELIST["人像"].get(sub_type, []).count(value) > 0
+        return TAG_WHITELIST[main_type].get(sub_type, []).count(value) > 0
+    return False
+
+def format_output(state: ImageTaggingState) -> ImageTaggingState:
+    final_labels = []
+    node_results = state.get("node_results", {})
+    
+    # 1. 主体
+    first_level = node_results.get("first_level", {})
+    second_level_person = node_results.get("second_level_person", {})
+    all_scene_type = node_results.get("all_scene_type", {})
+    
+    # ================= 核心修正逻辑 =================
+    # 逻辑：如果场景检测到“有路人”，则人像数量强制修正为“多人”
+    # 原因：场景节点对背景路人更敏感，以此为准解决冲突
+    scene_quality = all_scene_type.get("图片质量", [])
+    if "有路人" in scene_quality:
+        # 检查当前是否标记了单人，如果是，则修正
+        if "单人" in second_level_person.get("人数", []):
+            logger.info("逻辑修正：检测到'有路人'，将人像'单人'修正为'多人'")
+            second_level_person["人数"] = ["多人"]
+    
+    for subject in first_level.get("主体", []):
+        tag = f"主体-{subject}"
+        if is_tag_legal(tag): final_labels.append(tag)
+
+    # 2. 各细节节点：按注册表里的 tag_prefix 拼接 "前缀-类别-值"
+    for spec in NODE_SPECS:
+        if spec.tag_prefix is None:
+            continue
+        for label_type, values in node_results.get(spec.output_key, {}).items():
+            if isinstance(values, list):
+                for value in values:
+                    tag = f"{spec.tag_prefix}-{label_type}-{value}"
+                    if is_tag_legal(tag): final_labels.append(tag)
+
+    final_labels = sorted(list(set(final_labels)))
+    # 有节点失败或因预算被跳过时，返回已有的部分标签并标记降级
+    degraded = bool(state.get("failed_nodes") or state.get("skipped_nodes"))
+    return {"final_labels": final_labels, "degraded": degraded}
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : tag_metrics.py
+# @Usage   : 多标签质量评估：逐标签 / 逐字段 P/R/F1、互斥字段混淆矩阵、bootstrap 置信区间
+"""
+``json_to_excel`` 的"是否包含"只看路径标签有没有出现在预测里，既不算误报，也看不出
+"人像-年龄" 里青年和中年互相混淆。本模块基于人工标注清单做完整的多标签评估：
+
+- 标签空间取自 ``TAG_WHITELIST``，字段为去掉最后一级的前缀（``人像-年龄``、``人像-服饰-风格``、``主体``）；
+- 标注与预测都转成 (图片 × 标签) 的 0/1 矩阵，TP/FP/FN 全部是 NumPy 列求和；
+- 指标：逐标签 P/R/F1，逐字段与整体的 micro（先汇总计数，误报全部计入）/ macro（有标注的标签 F1 的均值）；
+- ``EXCLUSIVE_FIELDS`` 中的单选字段给出 标注值 × 预测值 混淆矩阵（含"(空)"与"(多选)"）；
+- 按图片有放回重采样做 bootstrap，给出 95% 置信区间；传入 ``--compare`` 时两次运行用同一组重采样，
+  F1 差值的区间不含 0 才说明降分辨率 / One-Pass 之类的提速真的掉了质量。
+
+标注清单（JSON 列表或 JSONL），每条：
+    {"image_path": "a/b.jpg", "labels": ["主体-人像", "人像-年龄-青年", ...], "fields": ["主体", "人像-年龄"]}
+``image_path`` 也可写 ``image_url`` / ``image_info``，与结果记录的 image_path（为空时 image_url）对齐；
+``fields`` 可选，只标注了部分字段时填写，其余字段的预测不计入误报。
+
+运行示例：
+    python tag_metrics.py --truth manifest.jsonl --pred retest.jsonl --excel metrics.xlsx
+    python tag_metrics.py --truth manifest.jsonl --pred edge512.json --compare edge768.json --bootstrap 2000
+"""
+import json
+import argparse
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from logger import get_logger
+from tag_format import TAG_WHITELIST
+from eval_core import load_run
+
+logger = get_logger(service="tag_metrics")
+
+# 语义上单选的字段：同一张图只应有一个值，适合看混淆矩阵
+EXCLUSIVE_FIELDS = (
+    "人像-性别", "人像-年龄", "人像-人数", "人像-拍摄方式", "人像-构图", "人像-角度", "人像-用途",
+    "人像-发型长度", "人像-发型直卷", "人像-发型形式", "人像-姿态", "人像-服饰-眼镜",
+    "动物（宠物）-数量", "场景-空间", "场景-时间", "场景-光线",
+)
+EMPTY_VALUE = "(空)"
+MULTI_VALUE = "(多选)"
+
+
+# ==========================================
+# 标签空间
+# ==========================================
+def _whitelist_tags(node, prefix: str) -> list:
+    if isinstance(node, dict):
+        return [tag for key, child in node.items() for tag in _whitelist_tags(child, f"{prefix}-{key}")]
+    return [f"{prefix}-{value}" for value in node]
+
+
+@dataclass
+class TagSpace:
+    tags: list                # 标签编号 -> 标签
+    fields: list              # 字段编号 -> 字段
+    tag_field: np.ndarray     # 标签编号 -> 字段编号
+
+    @classmethod
+    def from_whitelist(cls, whitelist: dict = None) -> "TagSpace":
+        whitelist = whitelist or TAG_WHITELIST
+        tags = [tag for key, node in whitelist.items() for tag in _whitelist_tags(node, key)]
+        field_names = [tag.rsplit("-", 1)[0] for tag in tags]
+        fields = list(dict.fromkeys(field_names))
+        field_index = {field: i for i, field in enumerate(fields)}
+        return cls(tags, fields, np.array([field_index[f] for f in field_names]))
+
+    @property
+    def index(self) -> dict:
+        return {tag: i for i, tag in enumerate(self.tags)}
+
+    def field_tags(self, field: str) -> np.ndarray:
+        return np.flatnonzero(self.tag_field == self.fields.index(field))
+
+    def matrix(self, label_lists: list) -> np.ndarray:
+        """标签列表 -> (图片 × 标签) bool 矩阵；标签空间外的标签忽略"""
+        index = self.index
+        rows, cols = [], []
+        for row, labels in enumerate(label_lists):
+            for label in labels:
+                col = index.get(label)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+        matrix = np.zeros((len(label_lists), len(self.tags)), dtype=bool)
+        matrix[rows, cols] = True
+        return matrix
+
+    def scope(self, field_lists: list) -> np.ndarray:
+        """每张图片参与评估的标签：未声明 fields 的图片评估全部字段"""
+        field_index = {field: i for i, field in enumerate(self.fields)}
+        mask = np.ones((len(field_lists), len(self.tags)), dtype=bool)
+        for row, fields in enumerate(field_lists):
+            if fields:
+                annotated = np.zeros(len(self.fields), dtype=bool)
+                annotated[[field_index[f] for f in fields if f in field_index]] = True
+                mask[row] = annotated[self.tag_field]
+        return mask
+
+
+# ==========================================
+# 加载与对齐
+# ==========================================
+def _record_key(record: dict) -> str:
+    return record.get("image_path") or record.get("image_url") or record.get("image_info") or ""
+
+
+def load_truth(path: str) -> pd.DataFrame:
+    """标注清单 -> DataFrame(key, labels, fields)"""
+    with open(path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()] if path.endswith(".jsonl") else json.load(f)
+    return pd.DataFrame({
+        "key": [_record_key(r) for r in records],
+        "labels": [r.get("labels") or [] for r in records],
+        "fields": [r.get("fields") or [] for r in records],
+    })
+
+
+def align(truth: pd.DataFrame, run: pd.DataFrame, space: TagSpace, skip_failed: bool = False) -> tuple:
+    """按图片对齐标注与预测，返回 (y_true, y_pred, scope)；没有预测结果的标注图片按全空预测计"""
+    keys = run["image_path"].fillna("").mask(lambda s: s == "", run["image_url"]).fillna("")
+    if skip_failed:
+        keep = run["status"].fillna("") != "failed"
+        run, keys = run[keep], keys[keep]
+    predictions = dict(zip(keys, run["labels"]))
+    missing = sum(1 for key in truth["key"] if key not in predictions)
+    if missing:
+        logger.warning(f"{missing} 张标注图片没有预测结果，按空预测计入")
+    unknown = {label for labels in truth["labels"] for label in labels} - set(space.tags)
+    if unknown:
+        logger.warning(f"标注中 {len(unknown)} 个标签不在白名单内，已忽略：{sorted(unknown)[:10]}")
+    scope = space.scope(truth["fields"].tolist())
+    y_true = space.matrix(truth["labels"].tolist()) & scope
+    y_pred = space.matrix([list(predictions.get(key, [])) for key in truth["key"]]) & scope
+    return y_true, y_pred, scope
+
+
+# ==========================================
+# 指标
+# ==========================================
+def _divide(numerator, denominator):
+    numerator, denominator = np.asarray(numerator, dtype=float), np.asarray(denominator, dtype=float)
+    return np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape),
+                     where=denominator > 0)
+
+
+def prf(tp, fp, fn) -> tuple:
+    precision = _divide(tp, tp + fp)
+    recall = _divide(tp, tp + fn)
+    return precision, recall, _divide(2 * precision * recall, precision + recall)
+
+
+def counts(y_true: np.ndarray, y_pred: np.ndarray, weights: np.ndarray = None) -> tuple:
+    """逐标签 (tp, fp, fn)；weights 为 (重采样次数 × 图片) 的计数矩阵时返回 (重采样次数 × 标签)"""
+    tp, fp, fn = y_true & y_pred, ~y_true & y_pred, y_true & ~y_pred
+    if weights is None:
+        return tp.sum(axis=0), fp.sum(axis=0), fn.sum(axis=0)
+    weights = weights.astype(np.float32)
+    return (weights @ tp.astype(np.float32), weights @ fp.astype(np.float32), weights @ fn.astype(np.float32))
+
+
+def aggregate(tp, fp, fn, columns=None) -> dict:
+    """在标签维（最后一维）上汇总：micro 先求和再算，macro 对有标注的标签取 F1 均值"""
+    if columns is not None:
+        tp, fp, fn = tp[..., columns], fp[..., columns], fn[..., columns]
+    micro_p, micro_r, micro_f1 = prf(tp.sum(axis=-1), fp.sum(axis=-1), fn.sum(axis=-1))
+    _, _, f1 = prf(tp, fp, fn)
+    active = (tp + fn) > 0
+    macro_f1 = _divide((f1 * active).sum(axis=-1), active.sum(axis=-1))
+    return {"micro_p": micro_p, "micro_r": micro_r, "micro_f1": micro_f1, "macro_f1": macro_f1}
+
+
+def bootstrap_weights(n_images: int, n_boot: int, seed: int = 0, chunk: int = 64):
+    """按块生成有放回重采样的计数矩阵（块 × 图片），避免一次性占用 n_boot × n_images 内存"""
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_boot, chunk):
+        size = min(chunk, n_boot - start)
+        yield np.stack([np.bincount(rng.integers(0, n_images, n_images), minlength=n_images) for _ in range(size)])
+
+
+def bootstrap(y_true: np.ndarray, predictions: list, n_boot: int = 1000, seed: int = 0) -> list:
+    """每份预测一组 (tp, fp, fn) 的重采样结果（重采样次数 × 标签），所有预测共用同一组重采样"""
+    samples = [([], [], []) for _ in predictions]
+    for weights in bootstrap_weights(len(y_true), n_boot, seed):
+        for store, y_pred in zip(samples, predictions):
+            for bucket, values in zip(store, counts(y_true, y_pred, weights)):
+                bucket.append(values)
+    return [tuple(np.concatenate(bucket) for bucket in store) for store in samples]
+
+
+def _interval(values: np.ndarray, alpha: float) -> tuple:
+    low, high = np.nanpercentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return low, high
+
+
+# ==========================================
+# 报表
+# ==========================================
+def tag_table(space: TagSpace, y_true, y_pred, boot: tuple = None, alpha: float = 0.05) -> pd.DataFrame:
+    tp, fp, fn = counts(y_true, y_pred)
+    precision, recall, f1 = prf(tp, fp, fn)
+    table = pd.DataFrame({
+        "标签": space.tags, "字段": [space.fields[i] for i in space.tag_field],
+        "标注数": tp + fn, "预测数": tp + fp, "TP": tp, "FP": fp, "FN": fn,
+        "精确率": precision, "召回率": recall, "F1": f1,
+    })
+    if boot is not None:
+        table["F1下限"], table["F1上限"] = _interval(prf(*boot)[2], alpha)
+    return table[(table["标注数"] + table["预测数"]) > 0].reset_index(drop=True)
+
+
+def field_table(space: TagSpace, y_true, y_pred, boot: tuple = None, alpha: float = 0.05) -> pd.DataFrame:
+    tp, fp, fn = counts(y_true, y_pred)
+    rows = []
+    for field in [None] + space.fields:
+        columns = None if field is None else space.field_tags(field)
+        point = aggregate(tp, fp, fn, columns)
+        if field is not None and (tp[columns] + fn[columns] + fp[columns]).sum() == 0:
+            continue
+        row = {"字段": field or "全部", "标注数": int((tp + fn)[columns].sum() if field else (tp + fn).sum()),
+               "micro精确率": float(point["micro_p"]), "micro召回率": float(point["micro_r"]),
+               "microF1": float(point["micro_f1"]), "macroF1": float(point["macro_f1"])}
+        if boot is not None:
+            sampled = aggregate(*boot, columns)
+            row["microF1下限"], row["microF1上限"] = _interval(sampled["micro_f1"], alpha)
+            row["macroF1下限"], row["macroF1上限"] = _interval(sampled["macro_f1"], alpha)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def confusion_matrix(space: TagSpace, y_true, y_pred, field: str, scope: np.ndarray = None) -> pd.DataFrame:
+    """单选字段的 标注值 × 预测值 计数；未标注该字段的图片不计入"""
+    columns = space.field_tags(field)
+    values = [space.tags[c].rsplit("-", 1)[1] for c in columns] + [EMPTY_VALUE, MULTI_VALUE]
+
+    def _category(matrix):
+        sub = matrix[:, columns]
+        hits = sub.sum(axis=1)
+        return np.where(hits == 0, len(columns), np.where(hits > 1, len(columns) + 1, sub.argmax(axis=1)))
+
+    rows = np.ones(len(y_true), dtype=bool) if scope is None else scope[:, columns].any(axis=1)
+    truth, pred = _category(y_true[rows]), _category(y_pred[rows])
+    matrix = np.bincount(truth * len(values) + pred, minlength=len(values) ** 2).reshape(len(values), len(values))
+    table = pd.DataFrame(matrix, index=pd.Index(values, name="标注\\预测"), columns=values)
+    # 去掉全零的行列，保留对角线可读性
+    keep = (table.sum(axis=1) > 0) | (table.sum(axis=0) > 0)
+    return table.loc[keep, keep]
+
+
+def delta_table(space: TagSpace, y_true, y_old, y_new, boot_old: tuple = None, boot_new: tuple = None,
+                alpha: float = 0.05) -> pd.DataFrame:
+    """新 - 旧 的字段级 F1 变化；有 bootstrap 时为配对区间（同一组重采样）"""
+    tp_old, fp_old, fn_old = counts(y_true, y_old)
+    tp_new, fp_new, fn_new = counts(y_true, y_new)
+    rows = []
+    for field in [None] + space.fields:
+        columns = None if field is None else space.field_tags(field)
+        if field is not None and (tp_old + fp_old + fn_old + tp_new + fp_new)[columns].sum() == 0:
+            continue
+        old, new = aggregate(tp_old, fp_old, fn_old, columns), aggregate(tp_new, fp_new, fn_new, columns)
+        row = {"字段": field or "全部", "microF1_旧": float(old["micro_f1"]), "microF1_新": float(new["micro_f1"]),
+               "microF1变化": float(new["micro_f1"] - old["micro_f1"]),
+               "macroF1_旧": float(old["macro_f1"]), "macroF1_新": float(new["macro_f1"]),
+               "macroF1变化": float(new["macro_f1"] - old["macro_f1"])}
+        if boot_old is not None:
+            diff = aggregate(*boot_new, columns)["micro_f1"] - aggregate(*boot_old, columns)["micro_f1"]
+            row["变化下限"], row["变化上限"] = _interval(diff, alpha)
+            row["显著"] = bool(row["变化下限"] > 0 or row["变化上限"] < 0)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多标签 P/R/F1、混淆矩阵与 bootstrap 置信区间")
+    parser.add_argument("--truth", required=True, help="标注清单 JSON/JSONL")
+    parser.add_argument("--pred", required=True, help="结果 JSON/JSONL（batch_cli / 重测输出）")
+    parser.add_argument("--compare", default=None, help="另一份结果（旧版本），输出配对的 F1 变化")
+    parser.add_argument("--bootstrap", type=int, default=1000, help="重采样次数，0 表示不计算置信区间")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-failed", action="store_true", help="打标失败的图片不参与评估（默认按空预测计）")
+    parser.add_argument("--excel", default=None)
+    args = parser.parse_args()
+
+    space = TagSpace.from_whitelist()
+    truth = load_truth(args.truth)
+    y_true, y_pred, scope = align(truth, load_run(args.pred), space, args.skip_failed)
+    y_old = align(truth, load_run(args.compare), space, args.skip_failed)[1] if args.compare else None
+
+    boots = [None, None]
+    if args.bootstrap > 0:
+        predictions = [y_pred] + ([y_old] if y_old is not None else [])
+        boots[:len(predictions)] = bootstrap(y_true, predictions, args.bootstrap, args.seed)
+
+    fields = field_table(space, y_true, y_pred, boots[0], args.alpha)
+    tags = tag_table(space, y_true, y_pred, boots[0], args.alpha)
+    confusions = {field: confusion_matrix(space, y_true, y_pred, field, scope) for field in EXCLUSIVE_FIELDS
+                  if field in space.fields and (y_true | y_pred)[:, space.field_tags(field)].any()}
+    delta = delta_table(space, y_true, y_old, y_pred, boots[1], boots[0], args.alpha) if y_old is not None else None
+
+    pd.set_option("display.width", 200)
+    print(f"评估图片 {len(truth)} 张，标签 {len(tags)} 个")
+    print(fields.round(4).to_string(index=False))
+    if delta is not None:
+        print("\n===== 新 - 旧 =====")
+        print(delta.round(4).to_string(index=False))
+
+    if args.excel:
+        with pd.ExcelWriter(args.excel, engine='openpyxl') as writer:
+            fields.to_excel(writer, sheet_name='字段指标', index=False)
+            tags.to_excel(writer, sheet_name='标签指标', index=False)
+            if delta is not None:
+                delta.to_excel(writer, sheet_name='版本对比', index=False)
+            for field, table in confusions.items():
+                table.to_excel(writer, sheet_name=f"混淆_{field}"[:31])
+        print(f"[√] Excel 已生成: {args.excel}")
+
+
+if __name__ == "__main__":
+    main()
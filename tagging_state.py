@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : tagging_state.py
+# @Usage   : LangGraph 打标流程的精简状态定义
+"""
+图状态只保留每个请求真正需要的东西：
+
+- ``node_results``：各节点解析后的标签字典，按节点输出 key 归并（并行节点的更新互不覆盖）；
+- ``usage``：Token 用量累加器，reducer 为 ``operator.add``；
+- ``failed_nodes``：重试耗尽仍失败的节点名，reducer 为列表拼接；
+- ``deadline``：请求截止时间（``time.monotonic()``），由各节点传给 VLM 调用；
+  ``skipped_nodes`` 记录因预算不足被跳过的可选节点；
+- ``priority``：interactive / batch，决定 VLM 调用在调度器中的排队优先级；
+- 计价配置 ``Pricing`` 放在状态之外，只在请求结束时用一次。
+
+新增节点只需要往 ``node_results`` 写自己的 key，不用再改状态定义和初始化。
+"""
+import operator
+from dataclasses import dataclass
+from typing import Optional
+
+from typing_extensions import TypedDict, Annotated
+
+
+@dataclass(frozen=True)
+class Usage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    calls: int = 0
+
+    def __add__(self, other: "Usage") -> "Usage":
+        return Usage(
+            self.prompt_tokens + other.prompt_tokens,
+            self.completion_tokens + other.completion_tokens,
+            self.calls + other.calls,
+        )
+
+    @classmethod
+    def from_response(cls, response: dict) -> "Usage":
+        """由 CallVLMModel 的返回字典构造"""
+        return cls(response.get("prompt_tokens", 0), response.get("completion_tokens", 0), 1)
+
+
+@dataclass(frozen=True)
+class Pricing:
+    """元/千Token（qwen2.5-vl-3b-instruct 价格）"""
+    input_per_1k: float = 0.0012
+    output_per_1k: float = 0.0036
+
+    def cost(self, usage: Usage) -> float:
+        return (usage.prompt_tokens / 1000) * self.input_per_1k + (usage.completion_tokens / 1000) * self.output_per_1k
+
+
+DEFAULT_PRICING = Pricing()
+
+
+def merge_node_results(left: dict, right: dict) -> dict:
+    """node_results 的 reducer：浅合并，后到的同名 key 覆盖"""
+    if not right:
+        return left
+    merged = dict(left) if left else {}
+    merged.update(right)
+    return merged
+
+
+class ImageTaggingState(TypedDict, total=False):
+    image_info: str
+    image_variants: dict  # 可选：{max_edge: base64}，节点分辨率不一致时才有
+    debug_trace: bool
+    node_results: Annotated[dict, merge_node_results]
+    usage: Annotated[Usage, operator.add]
+    failed_nodes: Annotated[list, operator.add]
+    deadline: Optional[float]
+    priority: str
+    skipped_nodes: Annotated[list, operator.add]
+    final_labels: list[str]
+    degraded: bool  # 有节点失败或被跳过，final_labels 只是部分结果
+
+
+def new_state(image_info: str, debug: bool = False, deadline: Optional[float] = None,
+              priority: str = "interactive") -> ImageTaggingState:
+    """单个请求的初始状态"""
+    return {"image_info": image_info, "debug_trace": debug, "node_results": {}, "usage": Usage(),
+            "failed_nodes": [], "deadline": deadline, "skipped_nodes": [], "priority": priority}
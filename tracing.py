@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @File    : tracing.py
+# @Usage   : 轻量级 span 链路追踪，字段与 OpenTelemetry(OTLP/JSON) 对齐
+"""
+一次请求的链路：
+
+    POST /process_image
+      └─ process_single_image
+           ├─ preprocess.download / preprocess.resize_encode
+           └─ graph.invoke
+                ├─ node.first_level_classification
+                │    └─ vlm.chat_completion
+                ├─ node.second_level_person ...
+                └─ node.format_output
+
+trace_id 由请求里的 ``task_id`` 派生（uuid4 直接去掉横线，其他字符串取 md5），
+同一个 task_id 的所有 span 落在同一条 trace 上。当前 span 通过 contextvars 传递，
+``asyncio.to_thread`` 与 LangGraph 的线程池都会复制 context，父子关系可以自动串起来。
+
+导出方式由环境变量控制：
+    TRACE_EXPORTER=file    写入 TRACE_FILE（默认 logs/traces.jsonl），每行一个 OTLP 风格的 span
+    TRACE_EXPORTER=memory  保存在进程内（collector 替身，调试 / 压测时用）
+    TRACE_EXPORTER=none    关闭（默认）
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def trace_id_from_task_id(task_id: str = None) -> str:
+    """task_id -> 32 位十六进制 trace_id"""
+    if not task_id:
+        return uuid.uuid4().hex
+    compact = task_id.replace("-", "").lower()
+    if len(compact) == 32 and all(c in "0123456789abcdef" for c in compact):
+        return compact
+    return hashlib.md5(task_id.encode("utf-8")).hexdigest()
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_span_id", "name", "start_ns", "end_ns", "attributes", "status", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_span_id: str = None, attributes: dict = None):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.status = "OK"
+        self.error = ""
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def record_error(self, error: Exception):
+        self.status = "ERROR"
+        self.error = f"{type(error).__name__}: {str(error)[:200]}"
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def to_dict(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id or "",
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "durationMs": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "status": {"code": self.status, "message": self.error},
+        }
+
+
+# ==========================================
+# Exporters
+# ==========================================
+class NoopSpanExporter:
+    def export(self, span: Span):
+        pass
+
+
+class FileSpanExporter:
+    """每个 span 追加一行 JSON，可直接被 collector 的 filelog receiver 读取"""
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class InMemorySpanExporter:
+    """进程内的 collector 替身，保留最近 max_spans 个 span"""
+    def __init__(self, max_spans: int = 10000):
+        self.spans = deque(maxlen=max_spans)
+
+    def export(self, span: Span):
+        self.spans.append(span.to_dict())
+
+    def get_trace(self, trace_id: str) -> list:
+        return sorted((s for s in self.spans if s["traceId"] == trace_id), key=lambda s: s["startTimeUnixNano"])
+
+
+def _exporter_from_env():
+    kind = os.getenv("TRACE_EXPORTER", "none").lower()
+    if kind == "file":
+        return FileSpanExporter(os.getenv("TRACE_FILE", "logs/traces.jsonl"))
+    if kind == "memory":
+        return InMemorySpanExporter()
+    return NoopSpanExporter()
+
+
+_exporter = _exporter_from_env()
+
+
+def set_exporter(exporter):
+    global _exporter
+    _exporter = exporter
+
+
+def get_exporter():
+    return _exporter
+
+
+# ==========================================
+# Span API
+# ==========================================
+def current_span():
+    return _current_span.get()
+
+
+def current_trace_id() -> str:
+    span = _current_span.get()
+    return span.trace_id if span is not None else ""
+
+
+@contextmanager
+def start_span(name: str, attributes: dict = None, trace_id: str = None):
+    """开启一个 span；没有父 span 且未指定 trace_id 时新建一条 trace"""
+    parent = _current_span.get()
+    if trace_id is None:
+        trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+    parent_id = parent.span_id if parent is not None and parent.trace_id == trace_id else None
+    span = Span(name, trace_id, parent_id, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.record_error(e)
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        _current_span.reset(token)
+        _exporter.export(span)
+
+
+def traced(name: str):
+    """装饰器：函数执行期间包一层 span"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with start_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
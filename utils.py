@@ -2,6 +2,7 @@ import requests
 from PIL import Image
 import io
 import base64
+from tracing import start_span
 
 #  编码函数： 将本地文件转换为 Base64 编码的字符串
 def encode_image(image_path):
@@ -17,13 +18,15 @@ def process_url_image(image_url: str, max_edge: int = 768) -> str:
     """
     try:
         # 1. 下载图片 (设置超时防止卡死)
-        response = requests.get(image_url, timeout=10)
-        response.raise_for_status()  # 检查是否下载成功
+        with start_span("preprocess.download", {"url": image_url[:256]}) as span:
+            response = requests.get(image_url, timeout=10)
+            response.raise_for_status()  # 检查是否下载成功
+            span.set_attribute("bytes", len(response.content))
         
         # 2. 从内存字节读取图片
         image_bytes = io.BytesIO(response.content)
         
-        with Image.open(image_bytes) as img:
+        with start_span("preprocess.resize_encode", {"max_edge": max_edge}), Image.open(image_bytes) as img:
             # 转换为RGB (防止PNG透明通道报错)
             if img.mode != 'RGB':
                 img = img.convert('RGB')
@@ -51,7 +54,7 @@ def encode_image_resized(image_path, max_edge=768):
     Qwen2.5-VL 推荐 768px 或 1024px，对于分类任务 768px 绰绰有余且速度极快。
     """
     try:
-        with Image.open(image_path) as img:
+        with start_span("preprocess.resize_encode", {"max_edge": max_edge}), Image.open(image_path) as img:
             # 转换为RGB，防止PNG透明通道在保存为JPEG时报错
             if img.mode != 'RGB':
                 img = img.convert('RGB')
@@ -70,6 +73,38 @@ def encode_image_resized(image_path, max_edge=768):
     except Exception as e:
         print(f"❌ 图片处理失败: {e}")
         return None
+
+
+def _encode_jpeg(img):
+    """PIL图片 -> 带前缀的 Base64"""
+    buffered = io.BytesIO()
+    img.save(buffered, format="JPEG", quality=85)
+    return f"data:image/jpeg;base64,{base64.b64encode(buffered.getvalue()).decode('utf-8')}"
+
+
+def encode_image_variants(image_source: str, max_edges) -> dict:
+    """
+    URL 或本地路径 -> 只下载/解码一次 -> 按每个 max_edge 各编码一份
+    返回 {max_edge: base64}，供不同分辨率的节点复用。失败直接抛异常。
+    """
+    if image_source.strip().lower().startswith(("http://", "https://")):
+        with start_span("preprocess.download", {"url": image_source[:256]}) as span:
+            response = requests.get(image_source.strip(), timeout=10)
+            response.raise_for_status()
+            span.set_attribute("bytes", len(response.content))
+        source = io.BytesIO(response.content)
+    else:
+        source = image_source
+    with start_span("preprocess.resize_encode", {"max_edge": ",".join(str(e) for e in sorted(max_edges))}), \
+            Image.open(source) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        # 从大到小依次缩放，小图直接在上一张缩略图基础上生成，原图只解码一次
+        variants = {}
+        for max_edge in sorted(set(max_edges), reverse=True):
+            img.thumbnail((max_edge, max_edge))
+            variants[max_edge] = _encode_jpeg(img)
+        return variants
     
 
 if __name__ == '__main__':